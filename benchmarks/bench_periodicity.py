@@ -0,0 +1,121 @@
+"""Benchmark for normalizing accrual periodicity values.
+
+ Builds a synthetic catalog of update_frequency values, drawn from a few
+ hundred distinct strings with a skewed (Zipf-like) distribution, and
+ times the normalization engine in update_periodicity.py against the
+ original approach of rebuilding the lookup table and running every
+ substitution for every dataset. The original approach is timed on a
+ sample and extrapolated, since it takes minutes on a full catalog.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import update_periodicity
+
+VERBOSE_VALUES = ['Decennial', 'Quadrennial', 'Annually', 'Annual', 'Bimonthly', 'Semiweekly',
+                  'Daily', 'Biweekly', 'Semiannually', 'Biennially', 'Biannual', 'Triennial',
+                  'Three times a week', 'Three times a month', 'Continuously updated', 'Monthly',
+                  'Quarterly', 'Semimonthly', 'Three times a year', 'Weekly', 'Hourly', 'Other', 'None']
+VALID_VALUES = ['R/P1Y', 'R/P1M', 'R/P3M', 'R/P1W', 'R/P1D', 'irregular', 'R/PT1H', 'R/P6M']
+
+
+def legacy_normalize(accrual):
+    """The normalization as originally written in fix_periodicity, with its
+       own copy of the pattern and lookup table, so that the new engine is
+       checked against the original behavior rather than against itself.
+    """
+    periodicity_iso_8601_pattern = "^irregular|R\\/P(?:\\d+(?:\\.\\d+)?Y)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?W)?(?:\\d+(?:\\.\\d+)?D)?(?:T(?:\\d+(?:\\.\\d+)?H)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?S)?)?$"
+    periodicity_lookup = [
+        {"verbose": "Decennial(ly)*", "iso8601":"R/P10Y"},
+        {"verbose": "Quadrennial(ly)*", "iso8601":"R/P4Y"},
+        {"verbose": "Annual(ly)*", "iso8601":"R/P1Y"},
+        {"verbose": "Bimonthly", "iso8601":"R/P2M"},
+        {"verbose": "Semiweekly", "iso8601":"R/P3.5D"},
+        {"verbose": "Daily", "iso8601":"R/P1D"},
+        {"verbose": "Biweekly", "iso8601":"R/P2W"},
+        {"verbose": "Semiannual(ly)*", "iso8601":"R/P6M"},
+        {"verbose": "Biennial(ly)*", "iso8601":"R/P2Y"},
+        {"verbose": "Biannual(ly)*", "iso8601":"R/P2Y"},
+        {"verbose": "Triennial(ly)*", "iso8601":"R/P3Y"},
+        {"verbose": "Triannual(ly)*", "iso8601":"R/P3Y"},
+        {"verbose": "Three times a week", "iso8601":"R/P0.33W"},
+        {"verbose": "Three times a month", "iso8601":"R/P0.33M"},
+        {"verbose": "Continuously updated", "iso8601":"R/PT1S"},
+        {"verbose": "Monthly", "iso8601":"R/P1M"},
+        {"verbose": "Quarterly", "iso8601":"R/P3M"},
+        {"verbose": "Semimonthly", "iso8601":"R/P0.5M"},
+        {"verbose": "Three times a year", "iso8601":"R/P4M"},
+        {"verbose": "Weekly", "iso8601":"R/P1W"},
+        {"verbose": "Hourly", "iso8601":"R/PT1H"},
+        {"verbose": "Other", "iso8601":"irregular"},
+        {"verbose": "None", "iso8601": "" }
+        ]
+    if re.search(periodicity_iso_8601_pattern, accrual) is not None:
+        return accrual
+    for repl in periodicity_lookup:
+        accrual = re.sub(repl['verbose'], repl['iso8601'], accrual)
+    return accrual
+
+
+def distinct_values(count):
+    """Build the requested number of distinct raw values, including the
+       verbose and valid forms along with variants in case, spacing and
+       punctuation such as are found in harvested metadata.
+    """
+    values = VERBOSE_VALUES + VALID_VALUES
+    rnd = random.Random(1)
+    while len(values) < count:
+        base = rnd.choice(VERBOSE_VALUES)
+        variant = rnd.choice([base.lower(), base.upper(), f' {base}', f'{base} ', f'{base}.',
+                              f'{base} (see notes)', f'Updated {base.lower()}',
+                              f'{base} since {rnd.randint(1990, 2030)}'])
+        if variant not in values:
+            values.append(variant)
+    return values[:count]
+
+
+def synthetic_catalog(datasets, distinct):
+    """Return a list of update_frequency values for the requested number of datasets."""
+    values = distinct_values(distinct)
+    weights = [1.0 / (rank + 1) for rank in range(len(values))]
+    values.append(None)
+    weights.append(weights[0])
+    return random.Random(2).choices(values, weights=weights, k=datasets)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='Benchmark accrual periodicity normalization.')
+    ap.add_argument('-n','--datasets', type=int, default=1000000, help='Number of synthetic datasets.')
+    ap.add_argument('-d','--distinct', type=int, default=300, help='Number of distinct raw values.')
+    ap.add_argument('-s','--sample', type=int, default=20000, help='Number of datasets used to time the original approach.')
+    args = ap.parse_args()
+
+    catalog = synthetic_catalog(args.datasets, args.distinct)
+    print(f'{args.datasets} datasets, {len(set(catalog))} distinct values')
+
+    sample = catalog[:args.sample]
+    legacy, legacy_time = timed(lambda values: [None if v is None else legacy_normalize(v) for v in values], sample)
+    legacy_rate = len(sample) / legacy_time
+    print(f'original:  {legacy_time:.3f}s for {len(sample)} values, '
+          f'{args.datasets / legacy_rate:.1f}s extrapolated to the full catalog')
+
+    update_periodicity.normalize_periodicity.cache_clear()
+    update_periodicity.is_valid_periodicity.cache_clear()
+    result, batch_time = timed(update_periodicity.normalize_periodicities, catalog)
+    print(f'batch:     {batch_time:.3f}s for {len(catalog)} values ({args.datasets / legacy_rate / batch_time:.0f}x)')
+
+    if result[:len(sample)] != legacy:
+        sys.exit('Normalized values differ from the original approach.')
@@ -0,0 +1,141 @@
+"""Benchmark the administration scripts against a local fake CKAN server.
+
+ Each scenario builds a fresh synthetic catalog, serves it with the
+ server in fake_ckan.py, and runs one script against it in a separate
+ process, as it would be run by hand. The wall time, the peak resident
+ memory of the script process and the number of requests the server
+ answered for each action are reported, so the effect of a change can be
+ measured at catalog sizes that cannot be tried against a real instance.
+
+ The scenarios are:
+   periodicity - update_periodicity.py patching every dataset with a verbose frequency
+   fingerprint - set_resource_fingerprint.py hashing every resource file
+   batch       - the same, writing each dataset's hashes in one package_revise call
+   category    - ckan_set_category.py adding listed datasets to a category group
+   roles       - list_user_roles.py writing the account role report
+   accounts    - manage_user_accounts.py creating and updating accounts
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_ckan
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('periodicity', 'fingerprint', 'batch', 'category', 'roles', 'accounts')
+
+
+def category_input(catalog, directory, count):
+    """Write a DCAT-US catalog file listing some dataset titles, plus a few unknown ones."""
+    titles = [d['title'] for d in random.Random(3).sample(list(catalog.datasets.values()),
+                                                          min(count, len(catalog.datasets)))]
+    titles += [f'Missing dataset {i}' for i in range(max(1, count // 100))]
+    path = os.path.join(directory, 'category.json')
+    with open(path, 'w') as f:
+        json.dump({'dataset': [{'title': t} for t in titles]}, f)
+    return path
+
+
+def accounts_input(catalog, directory, count):
+    """Write a JSON Lines file creating new accounts and updating existing ones."""
+    existing = list(catalog.users.values())
+    path = os.path.join(directory, 'accounts.jsonl')
+    with open(path, 'w') as f:
+        for i in range(count):
+            if i % 2 and existing:
+                user = existing[i % len(existing)]
+                entry = {'action': 'update', 'id': user['id'], 'fullname': f'Renamed {i}'}
+            else:
+                entry = {'action': 'create', 'name': f'bench{i:06d}', 'email': f'bench{i}@example.com',
+                         'fullname': f'Bench User {i}'}
+            f.write(json.dumps(entry) + '\n')
+    return path
+
+
+def scenario_command(name, catalog, directory, args):
+    """Return the command line running a scenario's script."""
+    python = [sys.executable]
+    workers = str(args.workers)
+    match name:
+        case 'periodicity':
+            return python + ['update_periodicity.py', '-update', '-w', workers]
+        case 'fingerprint':
+            return python + ['set_resource_fingerprint.py', '-f', '-w', workers, '--per-host', workers]
+        case 'batch':
+            return python + ['set_resource_fingerprint.py', '-f', '-w', workers, '--per-host', workers, '--batch']
+        case 'category':
+            return python + ['ckan_set_category.py', '-c', fake_ckan.CATEGORY, '-w', workers,
+                             '-f', category_input(catalog, directory, args.titles)]
+        case 'roles':
+            return python + ['list_user_roles.py']
+        case 'accounts':
+            return python + ['manage_user_accounts.py', accounts_input(catalog, directory, args.accounts),
+                             '-w', workers, '-l', os.devnull]
+
+
+def run_scenario(name, args):
+    """Run one scenario and return its measurements."""
+    server = fake_ckan.make_server(args)
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            command = scenario_command(name, server.catalog, directory, args)
+            env = dict(os.environ, CKAN_URL=server.url, CKAN_KEY='benchmark', CKAN_METRICS='off')
+            for variable in ('ED_CKAN_URL', 'ED_CKAN_KEY', 'CKAN_CACHE', 'CKAN_MIRROR'):
+                env.pop(variable, None)
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=REPO, env=env, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            stderr = process.stderr.read()
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+        with urllib.request.urlopen(server.url + '/_stats') as response:
+            stats = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    if process.returncode:
+        print(f'{name} exited with status {process.returncode}:\n{stderr.decode(errors="replace")[-2000:]}',
+              file=sys.stderr)
+    return {'scenario': name, 'exit_status': process.returncode, 'wall_seconds': round(wall, 3),
+            'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3), 'peak_memory_mb': round(peak, 1),
+            'requests': stats['total_requests'], 'failed_requests': sum(stats['failures'].values()),
+            'bytes_received': stats['bytes_sent'], 'requests_by_action': stats['requests']}
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Benchmark the administration scripts against a local fake CKAN server.',
+        epilog=__doc__.split('\n\n')[1])
+    fake_ckan.add_catalog_arguments(ap)
+    ap.add_argument('-s','--scenarios', default=','.join(SCENARIOS),
+                    help='Comma-separated list of scenarios to run.')
+    ap.add_argument('-w','--workers', type=int, default=4, help='Worker count passed to the scripts.')
+    ap.add_argument('--titles', type=int, default=1000, help='Number of titles listed for the category scenario.')
+    ap.add_argument('--accounts', type=int, default=1000, help='Number of entries for the accounts scenario.')
+    ap.add_argument('-o','--output', help='File to write the results to as JSON.')
+    args = ap.parse_args()
+
+    results = []
+    print(f'{"scenario":<12} {"status":>6} {"wall s":>8} {"cpu s":>8} {"peak MB":>8} {"requests":>9} {"failed":>7}')
+    for name in args.scenarios.split(','):
+        if name not in SCENARIOS:
+            sys.exit(f'Unknown scenario: {name}')
+        result = run_scenario(name, args)
+        results.append(result)
+        print(f'{name:<12} {result["exit_status"]:>6} {result["wall_seconds"]:>8.2f} {result["cpu_seconds"]:>8.2f} '
+              f'{result["peak_memory_mb"]:>8.1f} {result["requests"]:>9} {result["failed_requests"]:>7}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,106 @@
+"""Measure the start-up time of the administration scripts.
+
+ Cron jobs run many short scripts, each of which pays for starting the
+ interpreter and importing ckanapi, requests and urllib3 before it makes
+ its first call. This benchmark times, as the median of several runs in
+ fresh processes:
+   interpreter - python doing nothing, the floor for any script
+   ckan-admin  - ckan_admin.py printing its help, which imports no script
+   <script>    - each script printing its help, run directly and as a
+                 ckan_admin.py subcommand
+   separate    - a small batch of read-only jobs run as separate scripts
+                 against the fake CKAN server in fake_ckan.py
+   batch       - the same jobs run as one ckan_admin.py batch
+
+ The catalog is kept small, so that the batch times are mostly start-up.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_ckan
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import ckan_admin
+
+# Subcommands whose scripts print their help without connecting to CKAN.
+HELP_COMMANDS = ('set-category', 'patch-group', 'fingerprint', 'periodicity', 'users', 'accounts', 'roles', 'mirror')
+# Read-only jobs run by the batch scenarios.
+JOBS = (['roles'], ['accounts'], ['periodicity'], ['query-group', fake_ckan.CATEGORY])
+
+
+def script_of(command):
+    """Return the file name of the script implementing a subcommand."""
+    return ckan_admin.COMMANDS[command][0] + '.py'
+
+
+def time_runs(commands, env, repeats):
+    """Run a list of command lines in turn, the whole list 'repeats' times,
+       and return the median seconds taken by the list.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for command in commands:
+            process = subprocess.run(command, cwd=REPO, env=env, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE)
+            if process.returncode:
+                sys.exit(f'{" ".join(command)} exited with status {process.returncode}:\n'
+                         f'{process.stderr.decode(errors="replace")[-2000:]}')
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Measure the start-up time of the administration scripts.',
+        epilog=__doc__.split('\n\n')[1])
+    fake_ckan.add_catalog_arguments(ap)
+    ap.set_defaults(datasets=50, users=50, organizations=5)
+    ap.add_argument('-r','--repeats', type=int, default=5, help='Number of runs to take the median of.')
+    ap.add_argument('-o','--output', help='File to write the results to as JSON.')
+    args = ap.parse_args()
+
+    python = sys.executable
+    admin = [python, 'ckan_admin.py']
+    env = dict(os.environ, CKAN_URL='http://127.0.0.1:9', CKAN_KEY='benchmark', CKAN_METRICS='off')
+    for variable in ('ED_CKAN_URL', 'ED_CKAN_KEY', 'CKAN_CACHE', 'CKAN_MIRROR'):
+        env.pop(variable, None)
+
+    results = {'interpreter': time_runs([[python, '-c', 'pass']], env, args.repeats),
+               'ckan-admin': time_runs([admin + ['--help']], env, args.repeats)}
+    print(f'{"run":<16} {"direct s":>9} {"ckan-admin s":>13}')
+    print(f'{"interpreter":<16} {results["interpreter"]:>9.3f}')
+    print(f'{"ckan-admin":<16} {"":>9} {results["ckan-admin"]:>13.3f}')
+    for command in HELP_COMMANDS:
+        direct = time_runs([[python, script_of(command), '--help']], env, args.repeats)
+        via = time_runs([admin + [command, '--help']], env, args.repeats)
+        results[command] = {'direct': direct, 'ckan-admin': via}
+        print(f'{command:<16} {direct:>9.3f} {via:>13.3f}')
+
+    server = fake_ckan.make_server(args)
+    server.start()
+    try:
+        env['CKAN_URL'] = server.url
+        with tempfile.TemporaryDirectory() as directory:
+            batch = os.path.join(directory, 'batch.txt')
+            with open(batch, 'w') as f:
+                f.write(''.join(' '.join(job) + '\n' for job in JOBS))
+            separate = time_runs([[python, script_of(job[0])] + job[1:] for job in JOBS], env, args.repeats)
+            together = time_runs([admin + ['--batch', batch]], env, args.repeats)
+    finally:
+        server.shutdown()
+        server.server_close()
+    results['jobs'] = {'separate': separate, 'batch': together, 'count': len(JOBS)}
+    print(f'{len(JOBS)} jobs: {separate:.3f}s as separate scripts, {together:.3f}s as one batch')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,540 @@
+"""Local stand-in for the CKAN action API, for benchmarking the scripts.
+
+ Serves a synthetic catalog of datasets with resources, organizations,
+ groups and users from memory, along with the resource data files, so
+ that the scripts can be run at scale without touching a real instance.
+ Only the actions and query forms the scripts use are supported, and
+ the answers follow CKAN's response format closely enough for ckanapi.
+
+ Each request can be delayed by a fixed latency, and a share of requests
+ can be failed with a 503 response to exercise the retry paths. The
+ server can also be given a capacity of concurrent action calls, beyond
+ which calls are refused with a 429 response and a Retry-After header,
+ to exercise the load controller. Dataset
+ records can be padded to a given size to model heavy metadata, a share
+ of resources can point at the data file of an earlier resource, and the
+ resource files support range requests. The server counts the requests
+ for each action and the bytes it sends, which are returned by a GET
+ request for '/_stats'.
+
+ Run on its own, the server prints its address and serves until stopped.
+"""
+import argparse
+import bisect
+import collections
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+FREQUENCIES = ['R/P1Y', 'R/P1M', 'Annually', 'Monthly', 'Quarterly', 'Weekly', 'Daily',
+               'irregular', 'Biennially', 'Semiannually', 'Continuously updated', None]
+CAPACITIES = ['admin', 'editor', 'member']
+CATEGORY = 'bench-category'
+
+FILE_BLOCK = hashlib.sha512(b'ckan-admin benchmark').digest() * 64
+
+
+def timestamp(offset):
+    """Return a CKAN-style timestamp some seconds after a fixed date."""
+    moment = datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=offset)
+    return moment.isoformat(timespec='microseconds')
+
+
+def display_name(user):
+    """Return a user's display name as CKAN does: the full name unless it is blank."""
+    fullname = user.get('fullname')
+    return fullname if fullname and fullname.strip() else user['name']
+
+
+class ActionError(Exception):
+    """Error reported to the client in CKAN's error response format."""
+
+    def __init__(self, status, error_type, message):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+
+def not_found(kind, key):
+    return ActionError(404, 'Not Found Error', f'{kind} not found: {key}')
+
+
+class Catalog:
+    """Synthetic catalog held in memory. All access is under a single lock."""
+
+    def __init__(self, datasets=1000, resources=2, organizations=20, users=500,
+                 payload=0, file_size=65536, shared_files=0.0, seed=1):
+        rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.file_size = file_size
+        self.clock = 0
+        self.organizations = {}
+        for i in range(organizations):
+            org_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+            self.organizations[org_id] = {'id': org_id, 'name': f'org-{i:04d}', 'title': f'Organization {i}',
+                                          'is_organization': True, 'type': 'organization', 'state': 'active'}
+        self.groups = {}
+        for i, name in enumerate([CATEGORY, 'topic-a', 'topic-b']):
+            group_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+            self.groups[group_id] = {'id': group_id, 'name': name, 'title': name.replace('-', ' ').title(),
+                                     'is_organization': False, 'type': 'group', 'state': 'active'}
+        org_ids = list(self.organizations)
+        self.datasets = {}
+        self.names = {}
+        file_ids = []
+        for i in range(datasets):
+            dataset_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+            name = f'dataset-{i:07d}'
+            dataset = {'id': dataset_id, 'name': name, 'title': f'Synthetic dataset {i}', 'type': 'dataset',
+                       'state': 'active', 'private': False, 'owner_org': rnd.choice(org_ids) if org_ids else None,
+                       'metadata_modified': self.tick(), 'notes': 'x' * payload, 'groups': [], 'resources': []}
+            frequency = rnd.choice(FREQUENCIES)
+            if frequency is not None:
+                dataset['update_frequency'] = frequency
+            for r in range(resources):
+                resource_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+                if shared_files and file_ids and rnd.random() < shared_files:
+                    file_id = rnd.choice(file_ids)
+                else:
+                    file_id = resource_id
+                    file_ids.append(file_id)
+                dataset['resources'].append({'id': resource_id, 'package_id': dataset_id, 'name': f'File {r}',
+                                             'url': f'/files/{file_id}', 'url_type': None,
+                                             'format': 'CSV', 'hash': ''})
+            self.datasets[dataset_id] = dataset
+            self.names[name] = dataset_id
+        self.order = sorted(self.datasets)
+        self.users = {}
+        self.user_names = {}
+        self.members = collections.defaultdict(dict)
+        for i in range(users):
+            user = self.new_user({'name': f'user{i:06d}', 'email': f'user{i}@example.com',
+                                  'fullname': f'User {i}' if i % 3 else ''}, sysadmin=(i % 97 == 0))
+            for org_id in rnd.sample(org_ids, min(len(org_ids), rnd.randint(0, 3))):
+                self.members[org_id][user['id']] = rnd.choice(CAPACITIES)
+
+    def tick(self):
+        self.clock += 1
+        return timestamp(self.clock)
+
+    def new_user(self, data, sysadmin=False):
+        user_id = str(uuid.uuid4())
+        user = {'id': user_id, 'name': data['name'], 'fullname': data.get('fullname') or None,
+                'display_name': display_name(data), 'email': data.get('email'),
+                'sysadmin': data.get('sysadmin', sysadmin), 'state': 'active', 'created': self.tick()}
+        self.users[user_id] = user
+        self.user_names[user['name']] = user_id
+        return user
+
+    def set_base_url(self, base_url):
+        for dataset in self.datasets.values():
+            for resource in dataset['resources']:
+                if resource['url'].startswith('/'):
+                    resource['url'] = base_url + resource['url']
+
+    def dataset(self, key):
+        dataset = self.datasets.get(key) or self.datasets.get(self.names.get(key))
+        if dataset is None:
+            raise not_found('Dataset', key)
+        return dataset
+
+    def group(self, key, organization):
+        table = self.organizations if organization else self.groups
+        for group in table.values():
+            if key in (group['id'], group['name']):
+                return group
+        raise not_found('Organization' if organization else 'Group', key)
+
+    def user(self, key):
+        user = self.users.get(key) or self.users.get(self.user_names.get(key))
+        if user is None:
+            raise not_found('User', key)
+        return user
+
+    def call(self, action, data):
+        """Run an action and return the response body. The body is encoded
+           under the lock, since the result can share records with the catalog.
+        """
+        handler = getattr(self, 'action_' + action, None)
+        if handler is None:
+            raise ActionError(400, 'Bad request', f'Action name not known: {action}')
+        with self.lock:
+            return json.dumps({'success': True, 'result': handler(data)}).encode()
+
+    # Dataset actions.
+
+    def action_package_show(self, data):
+        return self.dataset(data.get('id'))
+
+    def action_package_search(self, data):
+        sort = data.get('sort') or 'score desc, metadata_modified desc'
+        matches = self.search(data.get('q') or '*:*', data.get('fq') or '')
+        if sort == 'id asc':
+            # Already in identifier order.
+            pass
+        elif sort.startswith('id'):
+            matches.reverse()
+        else:
+            matches = sorted(matches, key=lambda d: d['metadata_modified'], reverse=not sort.endswith('asc'))
+        start = int(data.get('start', 0))
+        rows = int(data.get('rows', 10))
+        return {'count': len(matches),
+                'results': [project(d, data.get('fl')) for d in matches[start:start + rows]]}
+
+    def search(self, q, fq):
+        """Return the datasets matching a query and filter query, in identifier order."""
+        terms = re.findall(r'(id|metadata_modified|num_resources):([\[{])"?([^"\s\]}]+)"? TO \*[\]}]', fq)
+        if re.sub(r'(id|metadata_modified|num_resources):[\[{]"?[^"\s\]}]+"? TO \*[\]}]|[\s+()]', '', fq):
+            raise ActionError(409, 'Search Query Error', f'Filter not supported by the fake server: {fq}')
+        ids = self.order
+        for field, bound, value in terms:
+            if field == 'id':
+                find = bisect.bisect_left if bound == '[' else bisect.bisect_right
+                ids = ids[find(ids, value):]
+        matches = [self.datasets[i] for i in ids]
+        if q != '*:*':
+            titles = re.findall(r'title:"((?:[^"\\]|\\.)*)"', q)
+            if not titles:
+                raise ActionError(409, 'Search Query Error', f'Query not supported by the fake server: {q}')
+            wanted = {json.loads(f'"{t}"') for t in titles}
+            matches = [d for d in matches if d['title'] in wanted]
+        for field, bound, value in terms:
+            if field == 'metadata_modified':
+                value = value.rstrip('Z')
+                matches = [d for d in matches if d[field] > value or (bound == '[' and d[field] == value)]
+            elif field == 'num_resources':
+                count = int(value) + (bound == '{')
+                matches = [d for d in matches if len(d['resources']) >= count]
+        return matches
+
+    def action_package_patch(self, data):
+        dataset = self.dataset(data.get('id'))
+        dataset.update({k: v for k, v in data.items() if k != 'id'})
+        dataset['metadata_modified'] = self.tick()
+        return dataset
+
+    def action_package_revise(self, data):
+        """Apply 'update__resources__<id prefix>' changes to the matched
+           dataset. Other forms of revision are not supported.
+        """
+        dataset = self.dataset((data.get('match') or {}).get('id'))
+        updates = []
+        for key, changes in data.items():
+            if key == 'match':
+                continue
+            prefix = key.removeprefix('update__resources__')
+            matches = [r for r in dataset['resources'] if r['id'].startswith(prefix)]
+            if prefix == key or len(matches) != 1:
+                raise ActionError(409, 'Validation Error', f'Unsupported or ambiguous revision: {key}')
+            updates.append((matches[0], changes))
+        for resource, changes in updates:
+            resource.update(changes)
+        dataset['metadata_modified'] = self.tick()
+        return {'package': dataset}
+
+    def action_current_package_list_with_resources(self, data):
+        ordered = sorted(self.datasets.values(), key=lambda d: d['metadata_modified'], reverse=True)
+        offset = int(data.get('offset', 0))
+        return ordered[offset:offset + int(data.get('limit', 10))]
+
+    def action_resource_patch(self, data):
+        for dataset in self.datasets.values():
+            for resource in dataset['resources']:
+                if resource['id'] == data.get('id'):
+                    resource.update(data)
+                    dataset['metadata_modified'] = self.tick()
+                    return resource
+        raise not_found('Resource', data.get('id'))
+
+    # Group and organization actions.
+
+    def action_group_show(self, data):
+        return self.group(data.get('id'), organization=False)
+
+    def action_organization_show(self, data):
+        return self.group(data.get('id'), organization=True)
+
+    def group_list(self, table, data):
+        groups = sorted(table.values(), key=lambda g: g['name'])
+        offset = int(data.get('offset', 0))
+        limit = data.get('limit')
+        groups = groups[offset:offset + int(limit)] if limit else groups[offset:]
+        return groups if data.get('all_fields') else [g['name'] for g in groups]
+
+    def action_group_list(self, data):
+        return self.group_list(self.groups, data)
+
+    def action_organization_list(self, data):
+        return self.group_list(self.organizations, data)
+
+    def action_member_create(self, data):
+        try:
+            group = self.group(data.get('id'), organization=False)
+        except ActionError:
+            group = self.group(data.get('id'), organization=True)
+        dataset = self.dataset(data.get('object'))
+        if group['name'] not in [g['name'] for g in dataset['groups']]:
+            dataset['groups'].append({'id': group['id'], 'name': group['name']})
+            dataset['metadata_modified'] = self.tick()
+        return {'group_id': group['id'], 'table_id': dataset['id'], 'table_name': 'package',
+                'capacity': data.get('capacity', 'member'), 'state': 'active'}
+
+    def action_member_list(self, data):
+        try:
+            group = self.group(data.get('id'), organization=True)
+        except ActionError:
+            group = self.group(data.get('id'), organization=False)
+        return [[user_id, 'user', capacity] for user_id, capacity in self.members.get(group['id'], {}).items()]
+
+    # User actions.
+
+    def action_user_list(self, data):
+        users = [u for u in self.users.values() if u['state'] != 'deleted']
+        users.sort(key=lambda u: u.get(data.get('order_by') or 'name') or '')
+        offset = int(data.get('offset', 0))
+        limit = data.get('limit')
+        users = users[offset:offset + int(limit)] if limit else users[offset:]
+        return users if data.get('all_fields', True) else [u['name'] for u in users]
+
+    def action_user_show(self, data):
+        return self.user(data.get('id'))
+
+    def action_user_create(self, data):
+        if data.get('name') in self.user_names:
+            raise ActionError(409, 'Validation Error', 'That login name is not available.')
+        return self.new_user(data)
+
+    def action_user_update(self, data):
+        user = self.user(data.get('id'))
+        user.update({k: v for k, v in data.items() if k in ('fullname', 'about', 'sysadmin')})
+        user['display_name'] = display_name(user)
+        return user
+
+    def action_user_delete(self, data):
+        self.user(data.get('id'))['state'] = 'deleted'
+        return None
+
+    def action_user_generate_apikey(self, data):
+        user = self.user(data.get('id'))
+        return dict(user, apikey=str(uuid.uuid4()))
+
+
+def project(record, fl):
+    """Keep the requested fields of a record. As in CKAN, a field named
+       'extras_<key>' is returned under the name '<key>'.
+    """
+    if not fl:
+        return record
+    fields = [f.strip() for f in (fl.split(',') if isinstance(fl, str) else fl)]
+    result = {}
+    for field in fields:
+        key = field[len('extras_'):] if field.startswith('extras_') else field
+        if key in record:
+            result[key] = record[key]
+    return result
+
+
+class FakeCKANServer(http.server.ThreadingHTTPServer):
+    """HTTP server answering CKAN action calls from a Catalog."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, catalog, address=('127.0.0.1', 0), latency=0.0, error_rate=0.0, capacity=0, seed=1):
+        super().__init__(address, FakeCKANHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.active = 0
+        self.random = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+        catalog.set_base_url(self.url)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = collections.Counter()
+            self.failures = collections.Counter()
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self.stats_lock:
+            return {'requests': dict(self.requests), 'failures': dict(self.failures),
+                    'total_requests': sum(self.requests.values()), 'bytes_sent': self.bytes_sent}
+
+    def count(self, name, nbytes, failed=False):
+        with self.stats_lock:
+            self.requests[name] += 1
+            self.failures[name] += failed
+            self.bytes_sent += nbytes
+
+    def admit(self):
+        """Start an action call, returning False if the server is at capacity."""
+        with self.stats_lock:
+            if self.capacity and self.active >= self.capacity:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.stats_lock:
+            self.active -= 1
+
+    def inject_failure(self):
+        with self.stats_lock:
+            return self.random.random() < self.error_rate
+
+    def handle_error(self, request, client_address):
+        # Clients may close a download early, such as after the first
+        # segment of a file fetched with range requests.
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self):
+        """Serve requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeCKANHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm
+    # would hold back for the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_POST(self):
+        action = self.path.rstrip('/').rsplit('/', 1)[-1]
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.server.admit():
+            body = b'Too many requests'
+            self.server.count(action, len(body), failed=True)
+            return self.send(429, body, 'text/plain', {'Retry-After': '1'})
+        try:
+            status, body, content_type = self.answer(action, raw)
+        finally:
+            # Leave before replying, so a client that waits for the reply
+            # before its next call is never counted twice.
+            self.server.leave()
+        self.server.count(action, len(body), failed=status != 200)
+        self.send(status, body, content_type)
+
+    def answer(self, action, raw):
+        """Return the status, body and content type of the response to an action call."""
+        self.delay()
+        if self.server.inject_failure():
+            return 503, b'Service temporarily unavailable', 'text/plain'
+        try:
+            return 200, self.server.catalog.call(action, json.loads(raw or b'{}')), 'application/json'
+        except ActionError as e:
+            body = json.dumps({'success': False, 'error': {'__type': e.error_type, 'message': str(e)}}).encode()
+            return e.status, body, 'application/json'
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/_stats':
+            return self.send(200, json.dumps(self.server.stats()).encode())
+        if not path.startswith('/files/'):
+            return self.send(404, b'Not found', 'text/plain')
+        self.delay()
+        if self.server.inject_failure():
+            self.server.count('file', 0, failed=True)
+            return self.send(503, b'Service temporarily unavailable', 'text/plain')
+        resource_id = path[len('/files/'):]
+        etag = f'"{resource_id}"'
+        headers = {'ETag': etag, 'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('file', 0)
+            return self.send(304, b'', headers=headers)
+        size = self.server.catalog.file_size
+        start, end = 0, size - 1
+        status = 200
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag and int(match.group(1)) < size:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1), size - 1)
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        # The file is the block repeated, so any range can be produced from it.
+        block = resource_id.encode() + FILE_BLOCK
+        position = start
+        while position <= end:
+            offset = position % len(block)
+            chunk = block[offset:offset + end - position + 1]
+            self.wfile.write(chunk)
+            position += len(chunk)
+        self.server.count('file', end - start + 1)
+
+
+def add_catalog_arguments(ap):
+    """Add the options describing the synthetic catalog and server behavior."""
+    ap.add_argument('--datasets', type=int, default=10000, help='Number of synthetic datasets.')
+    ap.add_argument('--resources', type=int, default=2, help='Number of resources per dataset.')
+    ap.add_argument('--organizations', type=int, default=50, help='Number of organizations.')
+    ap.add_argument('--users', type=int, default=5000, help='Number of user accounts.')
+    ap.add_argument('--payload', type=int, default=0, help='Bytes of padding added to each dataset record.')
+    ap.add_argument('--file-size', type=int, default=65536, help='Size in bytes of each resource data file.')
+    ap.add_argument('--shared-files', type=float, default=0.0,
+                    help='Share of resources pointing at the data file of an earlier resource.')
+    ap.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    ap.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failed with a 503 response.')
+    ap.add_argument('--capacity', type=int, default=0,
+                    help='Concurrent action calls served before refusing calls with a 429 response.')
+
+
+def make_server(args, port=0):
+    """Build a catalog and server from parsed catalog options."""
+    catalog = Catalog(args.datasets, args.resources, args.organizations, args.users,
+                      args.payload, args.file_size, args.shared_files)
+    return FakeCKANServer(catalog, ('127.0.0.1', port), args.latency, args.error_rate, args.capacity)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='Serve a synthetic CKAN catalog for benchmarking.')
+    add_catalog_arguments(ap)
+    ap.add_argument('--port', type=int, default=8800, help='Port to listen on.')
+    args = ap.parse_args()
+
+    server = make_server(args, args.port)
+    print(f'Serving {args.datasets} datasets at {server.url}')
+    server.serve_forever()
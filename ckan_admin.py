@@ -0,0 +1,165 @@
+"""Single entry point for the CKAN administration scripts.
+
+ Each script can still be run on its own, but every run of one starts a
+ new interpreter and imports ckanapi, requests and urllib3 again, which
+ takes longer than many of the calls the script then makes. This script
+ runs the others as subcommands, importing only the one that is asked
+ for, so listing the subcommands or asking for the help of one does not
+ load the rest.
+
+ A batch file names several subcommands, one to a line, with their
+ arguments quoted as they would be in the shell. They are all run in one
+ process, so the interpreter and the modules shared by the scripts are
+ loaded once for the whole batch. Blank lines and text after '#' are
+ ignored. The batch stops at the first subcommand that fails, unless
+ '--keep-going' is passed, and the exit status is that of the first one
+ that failed.
+
+ Each subcommand of a batch gets its own metrics summary, as described
+ in ckan_metrics. A metrics file named by 'CKAN_METRICS' is rewritten
+ after each one, so it holds the metrics of the last.
+
+ Sample batch file:
+   # Nightly catalog maintenance
+   periodicity -update -w 8
+   fingerprint -i state.json --batch
+   roles
+"""
+import argparse
+import logging
+import runpy
+import shlex
+import sys
+
+# Subcommand name, the module that implements it, and its description.
+COMMANDS = {
+    'set-category': ('ckan_set_category', 'Add the datasets listed in a file to a category group.'),
+    'delete-group': ('ckan_delete_group', 'Delete a group.'),
+    'patch-group': ('patch_ckan_group', 'Change parameters of an existing group.'),
+    'fingerprint': ('set_resource_fingerprint', 'Set resource fingerprints.'),
+    'periodicity': ('update_periodicity', 'Correct accrual periodicity values.'),
+    'users': ('manage_user_accounts', 'Create, update, delete or reset user accounts from a file.'),
+    'accounts': ('list_user_accounts', 'List user accounts.'),
+    'roles': ('list_user_roles', 'List user accounts with their most privileged organization role.'),
+    'query': ('query_ckan_fields_p3', 'Print the datasets matching a title.'),
+    'query-group': ('query_ckan_group', 'Print the details of a group.'),
+    'mirror': ('ckan_mirror', 'Mirror the catalog into a local SQLite file.'),
+}
+
+
+def exit_status(code):
+    """Return the exit status for the code passed to sys.exit, printing a message passed instead."""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def run_command(command, args):
+    """Run a subcommand with its arguments as its module would be run as a
+       script, and return its exit status.
+    """
+    module = COMMANDS[command][0]
+    saved_argv = sys.argv
+    # runpy replaces the first item with the path of the module.
+    sys.argv = [module] + list(args)
+    try:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+    except SystemExit as e:
+        return exit_status(e.code)
+    finally:
+        sys.argv = saved_argv
+    return 0
+
+
+def reset_logging():
+    """Remove the logging set up by the last subcommand, so that the next
+       one's call to logging.basicConfig takes effect.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging.WARNING)
+
+
+def report_metrics():
+    """Report and clear the metrics of the last subcommand, if it made any calls."""
+    metrics = sys.modules.get('ckan_metrics')
+    if metrics:
+        metrics.report()
+        metrics.METRICS.reset()
+
+
+def read_batch(path):
+    """Return the (subcommand, arguments) pairs listed in a batch file, '-' for
+       the standard input. All lines are read and checked before any is run.
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        lines = f.readlines()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    batch = []
+    for number, line in enumerate(lines, 1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError(f'{path}, line {number}: {e}')
+        if not words:
+            continue
+        if words[0] not in COMMANDS:
+            raise ValueError(f'{path}, line {number}: unknown subcommand {words[0]!r}')
+        batch.append((words[0], words[1:]))
+    return batch
+
+
+def run_batch(batch, keep_going=False):
+    """Run the subcommands of a batch in turn and return the exit status of
+       the first that failed, or 0 if all succeeded.
+    """
+    failed = 0
+    for command, args in batch:
+        reset_logging()
+        try:
+            status = run_command(command, args)
+        except Exception:
+            logging.exception('%s failed', command)
+            status = 1
+        report_metrics()
+        if status:
+            print(f'ckan-admin: {shlex.join([command] + args)} exited with status {status}', file=sys.stderr)
+            failed = failed or status
+            if not keep_going:
+                break
+    return failed
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(prog='ckan-admin', formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Run one of the CKAN administration scripts, or a batch of them in one process.',
+        epilog='subcommands (pass -h after one for its own help):\n' +
+               '\n'.join(f'  {name:<14}{description}' for name, (_, description) in COMMANDS.items()))
+    ap.add_argument('-b','--batch', metavar='FILE',
+                    help="Run the subcommands listed in a file, one to a line, or '-' for the standard input.")
+    ap.add_argument('-k','--keep-going', action='store_true',
+                    help='Carry on with the rest of a batch after a subcommand fails.')
+    ap.add_argument('command', nargs='?', choices=COMMANDS, metavar='subcommand', help='The subcommand to run.')
+    ap.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the subcommand.')
+    args = ap.parse_args()
+
+    if args.batch:
+        if args.command:
+            ap.error('a subcommand cannot be combined with --batch')
+        try:
+            batch = read_batch(args.batch)
+        except (OSError, ValueError) as e:
+            ap.error(str(e))
+        sys.exit(run_batch(batch, args.keep_going))
+    if not args.command:
+        ap.print_help()
+        sys.exit(2)
+    sys.exit(run_command(args.command, args.args))
@@ -0,0 +1,255 @@
+"""Response cache for read-only CKAN actions.
+
+ Scripts that ask for the same group, dataset, search or user list over and
+ over can wrap their connection in a CachedCKAN. Results of read-only
+ actions are kept in a size-bounded, least-recently-used memory cache, and
+ optionally in a SQLite file so that they can be reused by later runs.
+ Each action has its own time to live, and actions without one are never
+ cached.
+
+ Other actions are passed straight through, and write actions drop the
+ cached results they could have changed. Results for a single object
+ (such as package_show) are dropped only for the object that was written,
+ when it can be identified, while lists and searches are dropped entirely.
+
+ Results can depend on who asks, since private datasets and organizations
+ are only returned to accounts allowed to see them. Each entry is keyed by
+ a hash of the site URL and API key as well as by the call, so a cache file
+ shared by several accounts or sites never answers one with the results
+ fetched for another.
+
+ Caching is turned on for the scripts by setting the 'CKAN_CACHE'
+ environment variable, either to 'memory' or to the name of a cache file.
+"""
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# Time to live, in seconds, for the results of each cacheable action.
+DEFAULT_TTLS = {
+    'group_show': 3600,
+    'organization_show': 3600,
+    'group_list': 3600,
+    'organization_list': 3600,
+    'member_list': 600,
+    'package_show': 300,
+    'package_search': 300,
+    'current_package_list_with_resources': 300,
+    'user_show': 600,
+    'user_list': 600,
+}
+
+# For each kind of object written, the read-only actions whose results can change.
+INVALIDATES = {
+    'package': ('package_show', 'package_search', 'current_package_list_with_resources',
+                'group_show', 'organization_show'),
+    'group': ('group_show', 'group_list', 'member_list', 'package_show', 'package_search',
+              'current_package_list_with_resources'),
+    'organization': ('organization_show', 'organization_list', 'member_list', 'package_show',
+                     'package_search', 'current_package_list_with_resources'),
+    'user': ('user_show', 'user_list', 'member_list', 'group_show', 'organization_show'),
+}
+INVALIDATES['resource'] = INVALIDATES['package']
+INVALIDATES['member'] = tuple(sorted(set(INVALIDATES['group'] + INVALIDATES['organization'])))
+
+MEMORY_BYTES = 64 * 1024 * 1024
+DISK_BYTES = 512 * 1024 * 1024
+
+
+def object_kind(action):
+    """Return the kind of object an action works on, such as 'package' for package_patch."""
+    return action.split('_', 1)[0]
+
+
+def is_read_only(action):
+    """Return True if an action only reads from CKAN, going by the naming used by CKAN actions."""
+    return action.endswith(('_show', '_list', '_search', '_autocomplete', '_list_with_resources'))
+
+
+def identifiers(data_dict, result=None):
+    """Return the identifiers and names that a call or its result refer to."""
+    ids = set()
+    for source in (data_dict or {}, result if isinstance(result, dict) else {}):
+        for field in ('id', 'name', 'object', 'package_id'):
+            value = source.get(field)
+            if isinstance(value, str):
+                ids.add(value)
+    return ids
+
+
+def cache_scope(url, api_key):
+    """Return the part of the cache keys that ties entries to a site and account."""
+    return hashlib.sha256(f'{url}\n{api_key or ""}'.encode()).hexdigest()[:32]
+
+
+class ResponseCache:
+    """Two-tier store of action results. Entries are kept as JSON text, so
+       each hit returns a fresh copy that the caller can change freely.
+    """
+
+    def __init__(self, path=None, ttls=None, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES, scope=''):
+        self.scope = scope
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        # key -> (action, ids, expires, text), in least- to most-recently used order.
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, action TEXT, '
+                             'ids TEXT, expires REAL, accessed REAL, value TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_action ON responses (action)')
+            self._db.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+            self._db.commit()
+            self._disk_size = self._db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses').fetchone()[0]
+
+    def key(self, action, data_dict):
+        return f'{self.scope} {action} ' + json.dumps(data_dict or {}, sort_keys=True, default=str)
+
+    def get(self, action, data_dict):
+        """Return the cached result for a call, or None if there is no current entry."""
+        key = self.key(action, data_dict)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[2] >= now:
+                    self._memory.move_to_end(key)
+                    return json.loads(entry[3])
+                self._drop_memory(key)
+            if self._db is None:
+                return None
+            row = self._db.execute('SELECT ids, expires, value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._drop_disk([key])
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self._put_memory(key, action, set(json.loads(row[0])), row[1], row[2])
+            return json.loads(row[2])
+
+    def put(self, action, data_dict, result):
+        ttl = self.ttls.get(action)
+        if not ttl:
+            return
+        key = self.key(action, data_dict)
+        text = json.dumps(result)
+        ids = identifiers(data_dict, result)
+        expires = time.time() + ttl
+        with self._lock:
+            self._put_memory(key, action, ids, expires, text)
+            if self._db is not None:
+                self._drop_disk([key])
+                self._db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                 (key, action, json.dumps(sorted(ids)), expires, time.time(), text))
+                self._disk_size += len(text)
+                self._evict_disk()
+                self._db.commit()
+
+    def invalidate(self, action, data_dict):
+        """Drop the cached results that a write action could have changed."""
+        kind = object_kind(action)
+        ids = identifiers(data_dict)
+        # A write to an unknown kind of object could change anything.
+        read_actions = INVALIDATES.get(kind, tuple(self.ttls))
+        with self._lock:
+            for read_action in read_actions:
+                # A single-object result only needs dropping for the written object.
+                by_id = bool(ids) and read_action.endswith('_show') and object_kind(read_action) == kind
+                stale = [k for k, e in self._memory.items()
+                         if e[0] == read_action and (not by_id or e[1] & ids)]
+                for k in stale:
+                    self._drop_memory(k)
+                if self._db is not None:
+                    rows = self._db.execute('SELECT key, ids FROM responses WHERE action = ?', (read_action,)).fetchall()
+                    self._drop_disk([k for k, row_ids in rows if not by_id or ids & set(json.loads(row_ids))])
+            if self._db is not None:
+                self._db.commit()
+
+    def _put_memory(self, key, action, ids, expires, text):
+        self._drop_memory(key)
+        self._memory[key] = (action, ids, expires, text)
+        self._memory_size += len(text)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            self._drop_memory(next(iter(self._memory)))
+
+    def _drop_memory(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_size -= len(entry[3])
+
+    def _drop_disk(self, keys):
+        for key in keys:
+            row = self._db.execute('SELECT LENGTH(value) FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._disk_size -= row[0]
+
+    def _evict_disk(self):
+        if self._disk_size <= self.disk_bytes:
+            return
+        for (key,) in self._db.execute('SELECT key FROM responses ORDER BY accessed').fetchall():
+            if self._disk_size <= self.disk_bytes:
+                return
+            self._drop_disk([key])
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class CachedCKAN:
+    """Connection wrapper that answers read-only actions from a ResponseCache
+       and invalidates cached results after write actions. Other attributes
+       are passed through to the wrapped connection.
+    """
+
+    def __init__(self, connection, cache):
+        self.connection = connection
+        self.cache = cache
+
+    def call_action(self, action, data_dict=None, **kwargs):
+        # A call made with another API key is outside the scope of the cache.
+        if action in self.cache.ttls and not kwargs.get('apikey'):
+            result = self.cache.get(action, data_dict)
+            if result is not None:
+                logging.debug('Cache hit for %s', action)
+                return result
+            result = self.connection.call_action(action, data_dict=data_dict, **kwargs)
+            self.cache.put(action, data_dict, result)
+            return result
+        if is_read_only(action):
+            return self.connection.call_action(action, data_dict=data_dict, **kwargs)
+        try:
+            return self.connection.call_action(action, data_dict=data_dict, **kwargs)
+        finally:
+            # Even a failed write may have been applied on the server.
+            self.cache.invalidate(action, data_dict)
+
+    def iter_action(self, action, data_dict=None, path=()):
+        """Yield the items of a list result as the wrapped connection does.
+           The result of a cached action is held whole in the cache anyway,
+           so it is decoded whole and answered from the cache when it can be.
+        """
+        if action not in self.cache.ttls:
+            yield from self.connection.iter_action(action, data_dict, path)
+            return
+        result = self.call_action(action, data_dict=data_dict)
+        for key in path:
+            result = result[key]
+        yield from result
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
@@ -0,0 +1,236 @@
+"""Shared connection setup for the CKAN administration scripts.
+
+ The base URL for the API to use (without the trailing "/api/action" text)
+ can be specified in an environment variable named 'CKAN_URL'. The older
+ name 'ED_CKAN_URL' is also accepted. The value for the URL will be
+ prompted for input if neither environment variable is set.
+
+ The API key to use for authentication can be specified in an environment
+ variable named 'CKAN_KEY'. The older name 'ED_CKAN_KEY' is also accepted.
+ The value for the API key will be prompted for input if it is not set.
+
+ The URL and key are taken from the same family of variables, so that the
+ key for one instance is never sent to another: 'CKAN_URL' and 'CKAN_KEY'
+ if 'CKAN_URL' is set, and otherwise 'ED_CKAN_URL' and 'ED_CKAN_KEY'.
+
+ Every connection uses a keep-alive HTTP session with a connection pool,
+ so a long run reuses its TCP and TLS connections instead of opening one
+ per call, and asks for gzip-compressed responses. The connect and read
+ timeouts for API calls can be set in environment variables named
+ 'CKAN_CONNECT_TIMEOUT' and 'CKAN_READ_TIMEOUT', in seconds.
+
+ Every action call is timed and its payload sizes recorded, as described
+ in ckan_metrics.py.
+
+ The number of calls in flight at once and the page size of catalog walks
+ adapt to the load on the server, as described in ckan_throttle.py. Their
+ ceilings can be set in environment variables named 'CKAN_MAX_CONCURRENCY'
+ (by default the connection pool size) and 'CKAN_MAX_PAGE_SIZE', and the
+ latency above which calls count as slow in 'CKAN_TARGET_LATENCY', in
+ seconds.
+
+ Actions that return long lists can also be called through iter_action,
+ which yields the items of the list one at a time as they are decoded
+ from the response, as described in ckan_stream.py.
+
+ Results of read-only actions are cached if the 'CKAN_CACHE' environment
+ variable is set, to 'memory' for a cache that lasts for the run, or to
+ the name of a file for a cache that is also kept between runs.
+
+ If the 'CKAN_MIRROR' environment variable names a mirror file made by
+ ckan_mirror.py, read-only actions are answered from that file and the
+ CKAN instance is not contacted at all.
+"""
+import contextlib
+import functools
+import getpass
+import json
+import os
+import tempfile
+import time
+
+import ckanapi
+import ckanapi.common
+import requests
+import requests.adapters
+
+from ckan_cache import CachedCKAN, ResponseCache, cache_scope
+from ckan_metrics import METRICS
+from ckan_stream import READ_SIZE, SPOOL_SIZE, iter_json_array
+from ckan_throttle import MAX_PAGE_SIZE, TARGET_LATENCY, LoadController
+
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 120.0
+
+# The URL and key variables of each family, in order of preference.
+CREDENTIAL_VARIABLES = (('CKAN_URL', 'CKAN_KEY'), ('ED_CKAN_URL', 'ED_CKAN_KEY'))
+
+
+class PooledCKAN(ckanapi.RemoteCKAN):
+    """RemoteCKAN that applies default timeouts to every action call and
+       records the metrics for each call. With a LoadController, each call
+       waits for one of the concurrent calls it allows, and reports how the
+       server responded so the controller can adapt.
+    """
+
+    def __init__(self, address, apikey=None, session=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 metrics=METRICS, controller=None):
+        super().__init__(address, apikey, session=session)
+        self.timeout = timeout
+        self.metrics = metrics
+        self.controller = controller
+
+    def _slot(self):
+        return self.controller.slot() if self.controller else contextlib.nullcontext()
+
+    def _observe(self, action, seconds, response=None):
+        if self.controller:
+            self.controller.observe(action, seconds, response.status_code if response is not None else None,
+                                    response.headers.get('Retry-After') if response is not None else None)
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None,
+                    files=None, requests_kwargs=None):
+        requests_kwargs = dict(requests_kwargs or {})
+        requests_kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().call_action(action, data_dict=data_dict, context=context, apikey=apikey,
+                                         files=files, requests_kwargs=requests_kwargs)
+            failed = False
+            return result
+        finally:
+            self.metrics.record_call(action, time.perf_counter() - start, failed)
+
+    def _request_fn(self, url, data, headers, files, requests_kwargs):
+        # As in RemoteCKAN, but keeping the response headers for the controller.
+        action = url.rsplit('/', 1)[-1]
+        with self._slot():
+            start = time.perf_counter()
+            try:
+                r = self.session.post(url, data=data, headers=headers, files=files,
+                                      allow_redirects=False, **requests_kwargs)
+            except requests.exceptions.RequestException:
+                self._observe(action, time.perf_counter() - start)
+                raise
+            self._observe(action, time.perf_counter() - start, r)
+        text = r.text
+        self.metrics.record_payload(action, len(data or ''), len(text))
+        return r.status_code, text
+
+    def iter_action(self, action, data_dict=None, path=()):
+        """Call an action and yield the items of the list in its result one
+           at a time, as they are decoded. The keys in 'path' lead from the
+           result to the list, such as ('results',) for package_search.
+           Errors are raised as call_action raises them.
+
+           The response is read into a spool file before it is decoded, so
+           the connection is not held open while the caller works through
+           the items. The spool stays in memory up to SPOOL_SIZE bytes.
+        """
+        url, data, headers = ckanapi.common.prepare_action(action, data_dict, self.apikey, None,
+                                                           base_url=self.base_url)
+        headers['User-Agent'] = self.user_agent
+        url = self.address.rstrip('/') + '/' + url
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            start = time.perf_counter()
+            failed = True
+            received = 0
+            response = None
+            try:
+                with self._slot():
+                    try:
+                        with self.session.post(url, data=data, headers=headers, allow_redirects=False,
+                                               timeout=self.timeout, stream=True) as response:
+                            if response.status_code != 200:
+                                # Error responses are small, and raised as ckanapi raises them.
+                                text = response.text
+                                received = len(text)
+                                ckanapi.common.reverse_apicontroller_action(url, response.status_code, text)
+                                raise ckanapi.errors.CKANAPIError(repr([url, response.status_code, text]))
+                            for block in response.iter_content(READ_SIZE):
+                                spool.write(block)
+                                received += len(block)
+                    finally:
+                        self._observe(action, time.perf_counter() - start, response)
+                failed = False
+            finally:
+                self.metrics.record_call(action, time.perf_counter() - start, failed)
+                self.metrics.record_payload(action, len(data or ''), received)
+            spool.seek(0)
+            members = {}
+            found = yield from iter_json_array(iter(functools.partial(spool.read, READ_SIZE), b''),
+                                               ('result',) + tuple(path), members)
+            if members.get('success') is not True or not found:
+                ckanapi.common.reverse_apicontroller_action(url, 200, json.dumps(members))
+                raise ckanapi.errors.CKANAPIError(f'No list in the result of {action}')
+
+
+def credential_variables():
+    """Return the names of the URL and key variables of the family to use:
+       the first whose URL is set, or else the first whose key is set.
+    """
+    for index in (0, 1):
+        for variables in CREDENTIAL_VARIABLES:
+            if os.getenv(variables[index]):
+                return variables
+    return CREDENTIAL_VARIABLES[0]
+
+
+def get_credentials(prompt=True):
+    """Return the CKAN URL and API key from the environment, prompting for
+       any that are missing unless prompting is turned off.
+    """
+    url_variable, key_variable = credential_variables()
+    url = os.getenv(url_variable)
+    api_key = os.getenv(key_variable)
+
+    # Prompt for the API connection details if missing.
+    if prompt:
+        if not url:
+            url = input('Enter CKAN URL:')
+        if not api_key:
+            api_key = getpass.getpass('Enter CKAN API key:')
+    return url, api_key
+
+
+def make_session(pool_size=POOL_SIZE):
+    """Build a keep-alive HTTP session whose connection pool can hold
+       'pool_size' open connections to the CKAN host.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def connect(url=None, api_key=None, pool_size=POOL_SIZE, prompt=True):
+    """Return a pooled connection to the CKAN instance.
+       The URL and API key are taken from the environment if not passed.
+       The pool size should be at least the number of threads that will
+       make calls through the connection at the same time.
+    """
+    mirror = os.getenv('CKAN_MIRROR')
+    if mirror:
+        # Imported here, since the mirror script itself connects through this module.
+        from ckan_mirror import CatalogMirror, MirrorCKAN
+        return MirrorCKAN(CatalogMirror(mirror))
+    if not url or not api_key:
+        env_url, env_key = get_credentials(prompt)
+        url = url or env_url
+        api_key = api_key or env_key
+    timeout = (float(os.getenv('CKAN_CONNECT_TIMEOUT', CONNECT_TIMEOUT)),
+               float(os.getenv('CKAN_READ_TIMEOUT', READ_TIMEOUT)))
+    controller = LoadController(int(os.getenv('CKAN_MAX_CONCURRENCY', pool_size)),
+                                int(os.getenv('CKAN_MAX_PAGE_SIZE', MAX_PAGE_SIZE)),
+                                float(os.getenv('CKAN_TARGET_LATENCY', TARGET_LATENCY)))
+    connection = PooledCKAN(url, api_key, session=make_session(pool_size), timeout=timeout,
+                            controller=controller)
+    cache = os.getenv('CKAN_CACHE')
+    if cache:
+        connection = CachedCKAN(connection, ResponseCache(None if cache == 'memory' else cache,
+                                                          scope=cache_scope(url, api_key)))
+    return connection
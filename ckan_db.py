@@ -0,0 +1,48 @@
+"""Read-only access to the CKAN Postgres database for reporting scripts.
+
+ Some reports, such as the account and role listings, need data that the
+ API only returns through many calls but that the database holds in a few
+ tables. The scripts that offer a '--db' option use this module to run a
+ single query instead, with the rows streamed from a server-side cursor
+ so that a large result is never held in memory.
+
+ The connection is made with psycopg, which is only needed when a '--db'
+ option is used. The connection string can be passed to the option, or
+ set in an environment variable named 'CKAN_DB'. Any part not given there
+ is taken from the standard libpq variables such as 'PGHOST', 'PGDATABASE',
+ 'PGUSER' and 'PGPASSWORD'. Every session is set read-only, so a report
+ cannot change the database even with a privileged account.
+
+ The API leaves the site user, which CKAN names after its ckan.site_id
+ setting, out of user_list, and the reports leave it out of their queries
+ too. Its name is taken from the 'CKAN_SITE_ID' environment variable, or
+ is 'default', CKAN's own default for that setting.
+"""
+import os
+
+# Rows fetched from the server per round trip.
+FETCH_SIZE = 2000
+
+# The ckan.site_id setting, which names the site user.
+SITE_ID = os.getenv('CKAN_SITE_ID') or 'default'
+
+
+def connect(dsn=None):
+    """Return a read-only connection to the CKAN database."""
+    # Imported here, so that the scripts work without psycopg installed
+    # unless the database is actually used.
+    import psycopg
+    connection = psycopg.connect(dsn or os.getenv('CKAN_DB', ''))
+    connection.read_only = True
+    return connection
+
+
+def iter_rows(connection, sql, params=None, fetch_size=FETCH_SIZE):
+    """Run a query and yield the result rows as tuples, fetching them
+       from a server-side cursor a batch at a time.
+    """
+    with connection.transaction():
+        with connection.cursor(name='ckan_admin_report') as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(sql, params)
+            yield from cursor
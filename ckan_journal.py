@@ -0,0 +1,78 @@
+"""Checkpoint journal for long catalog runs.
+
+ Scripts that work through every dataset or resource in a catalog record
+ the outcome for each item in a journal file as they go. If a run is
+ interrupted, running it again with '--resume' skips the items the
+ journal shows as completed, so only the remaining work is done. Items
+ that failed are tried again.
+
+ The journal is a SQLite file holding one row per item, keyed by the
+ 16-byte form of the CKAN identifier, so it stays small for catalogs with
+ millions of resources. Each row is committed as it is written, to a
+ write-ahead log without waiting for the disk, so a killed run loses
+ nothing and writing the journal does not slow the run down.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+
+# Outcomes that mean an item does not need to be done again.
+COMPLETED = ('done', 'unchanged', 'skipped')
+
+
+def encode_key(key):
+    """Return the compact stored form of an identifier."""
+    try:
+        return uuid.UUID(key).bytes
+    except ValueError:
+        return key.encode()
+
+
+class Journal:
+    """Record of the items processed by a run. The journal is tied to the
+       settings of the job that wrote it, so that a resumed run does not
+       skip items that were done with different settings.
+    """
+
+    def __init__(self, path, job, resume=False):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS items (key BLOB PRIMARY KEY, outcome TEXT) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self._lock = threading.Lock()
+        job_text = json.dumps(job, sort_keys=True)
+        stored = self._db.execute("SELECT value FROM state WHERE key = 'job'").fetchone()
+        if resume and stored and stored[0] != job_text:
+            self._db.close()
+            raise ValueError(f'The journal {path} was written by a run with different settings: {stored[0]}')
+        if not resume:
+            self._db.execute('DELETE FROM items')
+        self._db.execute("INSERT OR REPLACE INTO state VALUES ('job', ?)", (job_text,))
+        self._db.commit()
+        if resume:
+            logging.info('Resuming with %d completed items in %s', self.count_completed(), path)
+
+    def completed(self, key):
+        """Return True if the journal shows the item as completed."""
+        with self._lock:
+            row = self._db.execute('SELECT outcome FROM items WHERE key = ?', (encode_key(key),)).fetchone()
+        return row is not None and row[0] in COMPLETED
+
+    def record(self, key, outcome):
+        """Record the outcome for an item."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO items VALUES (?, ?)', (encode_key(key), outcome))
+            self._db.commit()
+
+    def count_completed(self):
+        placeholders = ','.join('?' * len(COMPLETED))
+        with self._lock:
+            return self._db.execute(f'SELECT COUNT(*) FROM items WHERE outcome IN ({placeholders})',
+                                    COMPLETED).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
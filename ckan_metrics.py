@@ -0,0 +1,215 @@
+"""Run metrics for the CKAN administration scripts.
+
+ Every connection made through ckan_client records, for each CKAN action,
+ the number of calls, a histogram of their latency, the number that failed
+ or were repeated after a transient failure, and the bytes sent and
+ received. The fingerprinting script also records the bytes downloaded
+ from resource URLs, the time spent downloading them, and the downloads
+ saved by reusing the hash of a URL shared by several resources.
+
+ A summary is written to the standard error when the script exits. The
+ 'CKAN_METRICS' environment variable can name a file to also write the
+ metrics to, as JSON if the name ends in '.json' and otherwise in the
+ Prometheus text format (for the node exporter textfile collector), so
+ that runs can be compared. Setting it to 'off' turns the report off.
+"""
+import atexit
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class ActionStats:
+    """Counters for one CKAN action."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sent = 0
+        self.received = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the passed quantile of latencies."""
+        rank = q * self.calls
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            if total >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+    def as_dict(self):
+        return {'calls': self.calls, 'errors': self.errors, 'retries': self.retries,
+                'seconds': round(self.seconds, 6), 'max_seconds': round(self.max_seconds, 6),
+                'bytes_sent': self.sent, 'bytes_received': self.received,
+                'buckets': {('+Inf' if b == float('inf') else str(b)): c for b, c in zip(BUCKETS, self.buckets)}}
+
+
+class Metrics:
+    """Thread-safe store of the metrics for one run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.actions = collections.defaultdict(ActionStats)
+        self.downloads = 0
+        self.download_bytes = 0
+        self.download_seconds = 0.0
+        self.downloads_saved = 0
+
+    def record_call(self, action, seconds, failed=False):
+        with self._lock:
+            stats = self.actions[action]
+            stats.calls += 1
+            stats.errors += failed
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def record_payload(self, action, sent, received):
+        with self._lock:
+            stats = self.actions[action]
+            stats.sent += sent
+            stats.received += received
+
+    def record_retry(self, action):
+        with self._lock:
+            self.actions[action].retries += 1
+
+    def record_download(self, nbytes, seconds):
+        with self._lock:
+            self.downloads += 1
+            self.download_bytes += nbytes
+            self.download_seconds += seconds
+
+    def record_download_saved(self):
+        with self._lock:
+            self.downloads_saved += 1
+
+    def reset(self):
+        """Clear the metrics, so those of the next run in the same process are counted from zero."""
+        with self._lock:
+            self.started = time.time()
+            self.actions.clear()
+            self.downloads = 0
+            self.download_bytes = 0
+            self.download_seconds = 0.0
+            self.downloads_saved = 0
+
+    def is_empty(self):
+        return not self.actions and not self.downloads and not self.downloads_saved
+
+    def as_dict(self):
+        with self._lock:
+            return {'script': script_name(),
+                    'started': self.started,
+                    'elapsed_seconds': round(time.time() - self.started, 6),
+                    'actions': {a: s.as_dict() for a, s in sorted(self.actions.items())},
+                    'downloads': {'count': self.downloads, 'bytes': self.download_bytes,
+                                  'seconds': round(self.download_seconds, 6),
+                                  'saved': self.downloads_saved}}
+
+    def summary(self):
+        """Return a table of the metrics for printing."""
+        lines = [f'{"action":<40} {"calls":>7} {"errors":>6} {"retries":>7} {"mean ms":>8} '
+                 f'{"p95 ms":>8} {"max ms":>8} {"sent":>10} {"received":>12}']
+        with self._lock:
+            for action, s in sorted(self.actions.items()):
+                mean = s.seconds / s.calls * 1000 if s.calls else 0.0
+                lines.append(f'{action:<40} {s.calls:>7} {s.errors:>6} {s.retries:>7} {mean:>8.1f} '
+                             f'{s.quantile(0.95) * 1000:>8.1f} {s.max_seconds * 1000:>8.1f} '
+                             f'{s.sent:>10} {s.received:>12}')
+            if self.downloads:
+                rate = self.download_bytes / self.download_seconds if self.download_seconds else 0.0
+                lines.append(f'downloads: {self.downloads} files, {self.download_bytes} bytes '
+                             f'in {self.download_seconds:.1f}s ({rate / 1e6:.2f} MB/s per download thread)')
+            if self.downloads_saved:
+                lines.append(f'downloads saved: {self.downloads_saved} resources shared the data file of another resource')
+        lines.append(f'elapsed: {time.time() - self.started:.1f}s')
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        script = script_name()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in (('script', script),) + labels)
+                lines.append(f'{name}{{{label_text}}} {value}')
+
+        with self._lock:
+            items = sorted(self.actions.items())
+            metric('ckan_action_calls_total', 'counter', 'CKAN action calls made.',
+                   [((('action', a),), s.calls) for a, s in items])
+            metric('ckan_action_errors_total', 'counter', 'CKAN action calls that failed.',
+                   [((('action', a),), s.errors) for a, s in items])
+            metric('ckan_action_retries_total', 'counter', 'CKAN action calls repeated after a transient failure.',
+                   [((('action', a),), s.retries) for a, s in items])
+            metric('ckan_action_request_bytes_total', 'counter', 'Bytes sent in CKAN action requests.',
+                   [((('action', a),), s.sent) for a, s in items])
+            metric('ckan_action_response_bytes_total', 'counter', 'Bytes received in CKAN action responses.',
+                   [((('action', a),), s.received) for a, s in items])
+            lines.append('# HELP ckan_action_duration_seconds Latency of CKAN action calls.')
+            lines.append('# TYPE ckan_action_duration_seconds histogram')
+            for a, s in items:
+                total = 0
+                for bound, count in zip(BUCKETS, s.buckets):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'ckan_action_duration_seconds_bucket{{script="{script}",action="{a}",le="{le}"}} {total}')
+                lines.append(f'ckan_action_duration_seconds_sum{{script="{script}",action="{a}"}} {s.seconds}')
+                lines.append(f'ckan_action_duration_seconds_count{{script="{script}",action="{a}"}} {s.calls}')
+            metric('ckan_downloads_total', 'counter', 'Resource files downloaded for fingerprinting.',
+                   [((), self.downloads)])
+            metric('ckan_download_bytes_total', 'counter', 'Bytes of resource files downloaded.',
+                   [((), self.download_bytes)])
+            metric('ckan_download_seconds_total', 'counter', 'Time spent downloading resource files.',
+                   [((), self.download_seconds)])
+            metric('ckan_downloads_saved_total', 'counter', 'Resources given the hash of a data file shared with another resource.',
+                   [((), self.downloads_saved)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to a file, as JSON if the name ends in '.json' and
+           otherwise in the Prometheus text format. The file is replaced in one
+           step, so a collector never reads a partly written file.
+        """
+        text = json.dumps(self.as_dict(), indent=2) if path.endswith('.json') else self.prometheus()
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, path)
+
+
+def script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+
+METRICS = Metrics()
+
+
+def report(metrics=METRICS, setting=None):
+    """Print the summary and write the metrics file, as configured by 'CKAN_METRICS'."""
+    setting = os.getenv('CKAN_METRICS', '') if setting is None else setting
+    if setting == 'off' or metrics.is_empty():
+        return
+    print(metrics.summary(), file=sys.stderr)
+    if setting:
+        metrics.write(setting)
+
+
+atexit.register(report)
@@ -0,0 +1,329 @@
+"""Python command-line script for mirroring a CKAN catalog into a local
+SQLite file, and module for querying that mirror in place of the live API.
+
+ The mirror holds datasets, resources, groups, organizations and users.
+ The first run copies the whole catalog. Later runs fetch only the
+ datasets modified since the newest metadata_modified value already in
+ the mirror, and refresh the groups, organizations and users, which have
+ no modification filter but are far fewer than datasets.
+
+ A deleted dataset is only in the search index if the site keeps deleted
+ datasets there, so later runs also fetch the identifiers of every dataset
+ and remove the datasets the instance no longer has. An interrupted full
+ copy leaves the mirror without a watermark, so the next run starts the
+ full copy again.
+
+ Setting the 'CKAN_MIRROR' environment variable to the name of a mirror
+ file makes the other scripts read from the mirror instead of the CKAN
+ instance. Only read-only actions can be answered from the mirror, and
+ package_search only supports the query forms these scripts use:
+ 'field:value' queries on id, name or title, and identifier or
+ metadata_modified ranges as filter queries. The user members of each
+ group and organization are mirrored for member_list, which costs one
+ call per group when the mirror is refreshed.
+
+ The base URL for the API to use (without the trailing "/api/action" text)
+ can be specified in an environment variable named 'CKAN_URL' (or 'ED_CKAN_URL').
+ The value for the URL will be prompted for input if the environment
+ variable is not set.
+
+ The API key to use for authentication can be specified in an environment
+ variable named 'CKAN_KEY' (or 'ED_CKAN_KEY'). The value for the API key will
+ be prompted for input if the environment variable is not set.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+
+import ckanapi
+
+import ckan_client
+from ckan_paging import iter_datasets, iter_users, latest_modified, solr_date
+
+MIRROR_FILE = 'ckan_mirror.db'
+# CKAN caps the page size of group and organization lists that include all fields.
+GROUP_PAGE_SIZE = 25
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (id TEXT PRIMARY KEY, name TEXT, title TEXT, type TEXT,
+                                     metadata_modified TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets (name);
+CREATE INDEX IF NOT EXISTS datasets_title ON datasets (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS datasets_modified ON datasets (metadata_modified);
+CREATE TABLE IF NOT EXISTS resources (id TEXT PRIMARY KEY, package_id TEXT, url TEXT, hash TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS resources_package ON resources (package_id);
+CREATE INDEX IF NOT EXISTS resources_url ON resources (url);
+CREATE TABLE IF NOT EXISTS groups (id TEXT PRIMARY KEY, name TEXT, is_organization INTEGER, data TEXT);
+CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+CREATE TABLE IF NOT EXISTS members (group_id TEXT, user_id TEXT, capacity TEXT, PRIMARY KEY (group_id, user_id));
+CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT, created TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS users_name ON users (name);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+class CatalogMirror:
+    """Local copy of a CKAN catalog, stored in a SQLite file."""
+
+    def __init__(self, path=MIRROR_FILE):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get_state(self, key):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def store_dataset(self, dataset):
+        self._db.execute('DELETE FROM resources WHERE package_id = ?', (dataset['id'],))
+        if dataset.get('state', 'active') == 'deleted':
+            self._db.execute('DELETE FROM datasets WHERE id = ?', (dataset['id'],))
+            return
+        self._db.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?)',
+                         (dataset['id'], dataset.get('name'), dataset.get('title'), dataset.get('type'),
+                          dataset.get('metadata_modified'), json.dumps(dataset)))
+        for resource in dataset.get('resources', []):
+            self._db.execute('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)',
+                             (resource['id'], dataset['id'], resource.get('url'), resource.get('hash'),
+                              json.dumps(resource)))
+
+    def sync_datasets(self, connection, full=False):
+        """Copy the datasets modified since the last sync, or every dataset.
+           Returns the number of datasets copied.
+        """
+        data_dict = {'include_private': True, 'include_drafts': True}
+        watermark = None if full else self.get_state('watermark')
+        # Datasets changed while this sync runs are picked up by the next one.
+        latest = latest_modified(connection)
+        if watermark:
+            data_dict.update({'include_deleted': True, 'fq': f'metadata_modified:[{solr_date(watermark)} TO *]'})
+        else:
+            # Without a watermark, an interrupted copy is started again in full by the next run.
+            self._db.execute("DELETE FROM state WHERE key = 'watermark'")
+            self._db.execute('DELETE FROM datasets')
+            self._db.execute('DELETE FROM resources')
+            self._db.commit()
+        count = 0
+        for dataset in iter_datasets(connection, action='package_search', data_dict=data_dict):
+            self.store_dataset(dataset)
+            count += 1
+            if count % 1000 == 0:
+                self._db.commit()
+        # The watermark only moves once the whole walk has finished, since
+        # the walk is in identifier order rather than modification order.
+        if latest:
+            self.set_state('watermark', latest)
+        self._db.commit()
+        return count
+
+    def prune_datasets(self, connection):
+        """Remove the datasets that are no longer in the CKAN instance.
+           Returns the number removed.
+        """
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS live (id TEXT PRIMARY KEY)')
+        self._db.execute('DELETE FROM live')
+        data_dict = {'fl': 'id', 'include_private': True, 'include_drafts': True}
+        for dataset in iter_datasets(connection, action='package_search', data_dict=data_dict):
+            self._db.execute('INSERT OR IGNORE INTO live VALUES (?)', (dataset['id'],))
+        self._db.execute('DELETE FROM resources WHERE package_id NOT IN (SELECT id FROM live)')
+        removed = self._db.execute('DELETE FROM datasets WHERE id NOT IN (SELECT id FROM live)').rowcount
+        self._db.execute('DELETE FROM live')
+        self._db.commit()
+        return removed
+
+    def sync_groups(self, connection):
+        """Replace the groups and organizations, and their user members, with
+           the current ones. Returns the number of groups and organizations copied.
+        """
+        groups = []
+        for action in ('group_list', 'organization_list'):
+            offset = 0
+            while True:
+                page = connection.call_action(action=action, data_dict={
+                    'all_fields': True, 'include_extras': True, 'limit': GROUP_PAGE_SIZE, 'offset': offset})
+                groups.extend(page)
+                if len(page) < GROUP_PAGE_SIZE:
+                    break
+                offset += GROUP_PAGE_SIZE
+        members = {group['id']: connection.call_action(action='member_list', data_dict={
+                       'id': group['id'], 'object_type': 'user'}) for group in groups}
+        self._db.execute('DELETE FROM groups')
+        self._db.execute('DELETE FROM members')
+        for group in groups:
+            self._db.execute('INSERT OR REPLACE INTO groups VALUES (?, ?, ?, ?)',
+                             (group['id'], group.get('name'), int(bool(group.get('is_organization'))),
+                              json.dumps(group)))
+            for user_id, _, capacity in members[group['id']]:
+                self._db.execute('INSERT OR REPLACE INTO members VALUES (?, ?, ?)', (group['id'], user_id, capacity))
+        self.set_state('members', 'user')
+        self._db.commit()
+        return len(groups)
+
+    def sync_users(self, connection):
+        """Replace the users with the current ones. Returns the number copied."""
+        self._db.execute('DELETE FROM users')
+        count = 0
+        for user in iter_users(connection, {'all_fields': True, 'order_by': 'created'}):
+            self._db.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                             (user['id'], user.get('name'), user.get('created'), json.dumps(user)))
+            count += 1
+        self._db.commit()
+        return count
+
+    def sync(self, connection, full=False):
+        """Bring the mirror up to date. Returns the number of records copied of
+           each kind, and the number of datasets removed.
+        """
+        incremental = not full and self.get_state('watermark') is not None
+        counts = {'datasets': self.sync_datasets(connection, full),
+                  'removed': self.prune_datasets(connection) if incremental else 0}
+        counts.update(groups=self.sync_groups(connection), users=self.sync_users(connection))
+        return counts
+
+    def query(self, sql, params=()):
+        return self._db.execute(sql, params).fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+def project(record, fl):
+    """Keep only the requested fields of a record, as package_search does for 'fl'."""
+    if not fl:
+        return record
+    fields = [f.strip() for f in (fl.split(',') if isinstance(fl, str) else fl)]
+    return {f: record[f] for f in fields if f in record}
+
+
+class MirrorCKAN:
+    """Read-only stand-in for a CKAN connection that answers actions from a CatalogMirror."""
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def _load(self, sql, params=()):
+        return [json.loads(row[0]) for row in self.mirror.query(sql, params)]
+
+    def _show(self, table, data_dict, where=''):
+        key = data_dict.get('id')
+        found = self._load(f'SELECT data FROM {table} WHERE (id = ? OR name = ?){where}', (key, key))
+        if not found:
+            raise ckanapi.errors.NotFound(f'{key} not found in mirror')
+        return found[0]
+
+    def _page(self, sql, params, data_dict):
+        """Load the rows of a list action, applying any limit and offset in the data dictionary."""
+        limit = data_dict.get('limit')
+        if limit is None:
+            return self._load(sql, params)
+        return self._load(f'{sql} LIMIT ? OFFSET ?', tuple(params) + (int(limit), int(data_dict.get('offset', 0))))
+
+    def member_list(self, data_dict):
+        key = data_dict.get('id')
+        found = self.mirror.query('SELECT id FROM groups WHERE id = ? OR name = ?', (key, key))
+        if not found:
+            raise ckanapi.errors.NotFound(f'{key} not found in mirror')
+        if data_dict.get('object_type') != 'user':
+            raise ckanapi.errors.CKANAPIError('Only user members can be listed from the mirror')
+        if self.mirror.get_state('members') is None:
+            raise ckanapi.errors.CKANAPIError('The mirror holds no members until it is refreshed')
+        sql = 'SELECT user_id, capacity FROM members WHERE group_id = ?'
+        params = [found[0][0]]
+        if data_dict.get('capacity'):
+            sql += ' AND capacity = ?'
+            params.append(data_dict['capacity'])
+        return [[user_id, 'user', capacity] for user_id, capacity in self.mirror.query(sql, params)]
+
+    def package_search(self, data_dict):
+        clauses = []
+        params = []
+        q = (data_dict.get('q') or '*:*').strip()
+        if q != '*:*':
+            match = re.fullmatch(r'(id|name|title):(.+)', q)
+            if not match:
+                raise ckanapi.errors.CKANAPIError(f'Query not supported by the mirror: {q}')
+            field, value = match.groups()
+            if value.startswith('"') and value.endswith('"'):
+                clauses.append(f'{field} = ? COLLATE NOCASE')
+                params.append(json.loads(value))
+            elif field == 'title':
+                clauses.append('title LIKE ?')
+                params.append(f'%{value}%')
+            else:
+                clauses.append(f'{field} = ?')
+                params.append(value)
+        fq = data_dict.get('fq') or ''
+        ranges = re.findall(r'(id|metadata_modified):([\[{])"?([^"\s]+)"? TO \*[\]}]', fq)
+        if re.sub(r'(id|metadata_modified):[\[{]"?[^"\s]+"? TO \*[\]}]|[\s+()]', '', fq):
+            raise ckanapi.errors.CKANAPIError(f'Filter not supported by the mirror: {fq}')
+        for field, bound, value in ranges:
+            if field == 'metadata_modified':
+                value = value.rstrip('Z')
+            clauses.append(f'{field} {">=" if bound == "[" else ">"} ?')
+            params.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        sort = {'id asc': 'id', 'metadata_modified desc': 'metadata_modified DESC',
+                'metadata_modified asc': 'metadata_modified'}.get(data_dict.get('sort'), 'id')
+        count = self.mirror.query(f'SELECT COUNT(*) FROM datasets{where}', params)[0][0]
+        rows = int(data_dict.get('rows', 10))
+        start = int(data_dict.get('start', 0))
+        results = self._load(f'SELECT data FROM datasets{where} ORDER BY {sort} LIMIT ? OFFSET ?',
+                             params + [rows, start])
+        return {'count': count, 'results': [project(r, data_dict.get('fl')) for r in results]}
+
+    def call_action(self, action, data_dict=None, **kwargs):
+        data_dict = data_dict or {}
+        match action:
+            case 'package_show':
+                return self._show('datasets', data_dict)
+            case 'package_search':
+                return self.package_search(data_dict)
+            case 'current_package_list_with_resources':
+                return self._load('SELECT data FROM datasets ORDER BY metadata_modified DESC LIMIT ? OFFSET ?',
+                                  (int(data_dict.get('limit', 10)), int(data_dict.get('offset', 0))))
+            case 'group_show':
+                return self._show('groups', data_dict, ' AND is_organization = 0')
+            case 'organization_show':
+                return self._show('groups', data_dict, ' AND is_organization = 1')
+            case 'group_list' | 'organization_list':
+                groups = self._page('SELECT data FROM groups WHERE is_organization = ? ORDER BY name',
+                                    (int(action == 'organization_list'),), data_dict)
+                return groups if data_dict.get('all_fields') else [g['name'] for g in groups]
+            case 'member_list':
+                return self.member_list(data_dict)
+            case 'user_show':
+                return self._show('users', data_dict)
+            case 'user_list':
+                users = self._page('SELECT data FROM users ORDER BY created, id', (), data_dict)
+                # CKAN returns whole user records unless told otherwise.
+                return users if data_dict.get('all_fields', True) else [u['name'] for u in users]
+            case _:
+                raise ckanapi.errors.CKANAPIError(f'Action {action} cannot be answered from the mirror')
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Mirror the datasets, resources, groups and users of a CKAN instance into a local SQLite file.''',
+        epilog='''The program uses the following environment variables:
+  CKAN_URL (or ED_CKAN_URL): The web address to use for API calls.
+  CKAN_KEY (or ED_CKAN_KEY): The authentication key value to use for API calls.
+''')
+    ap.add_argument('-o','--output', default=MIRROR_FILE, help='The mirror file to create or update.')
+    ap.add_argument('--full', action='store_true', help='Copy every dataset instead of only those changed since the last run.')
+    args = ap.parse_args()
+
+    remote = ckan_client.connect()
+    mirror = CatalogMirror(args.output)
+    counts = mirror.sync(remote, args.full)
+    mirror.close()
+    print(f'Mirrored {counts["datasets"]} changed datasets, {counts["groups"]} groups and organizations, '
+          f'and {counts["users"]} users to {args.output}, removing {counts["removed"]} deleted datasets.')
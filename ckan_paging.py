@@ -0,0 +1,338 @@
+"""Paginated iteration over the datasets and users in a CKAN instance.
+
+ The scripts that walk the whole catalog or user list share the generators
+ in this module instead of hand-rolling offset pagination. Records are
+ yielded one at a time. Over a connection that can decode responses
+ incrementally (see iter_action in ckan_client.py), each record is yielded
+ as it is decoded from the response, so only one record of a page is held
+ in memory at a time. Otherwise the next page is fetched in a background
+ thread while the caller processes the current one.
+
+ Walks paged by limit and offset also request the next page in a
+ background thread while the caller works through a streamed one, as
+ described in iter_offset_pages. A package_search page cannot be asked
+ for until the identifier it starts after has been decoded, which is the
+ last one on the current page, so those pages are requested one after
+ another and only one response is held at a time.
+
+ Unless a page size is passed, each page asks for the number of records
+ set by the connection's LoadController (see ckan_throttle.py), which
+ shrinks pages while the server is under load, or for PAGE_SIZE records
+ over a connection without one.
+
+ package_search results are sorted by dataset identifier, and each page
+ asks only for identifiers after the last one already seen. Datasets added
+ or removed during the walk therefore cannot shift the pages, so nothing
+ is skipped or repeated.
+
+ current_package_list_with_resources only supports offsets, and returns
+ datasets in order of modification, so a dataset changed during the walk
+ can move to another page. Identifiers already yielded are remembered so
+ that such datasets are not yielded twice.
+"""
+import concurrent.futures
+
+PAGE_SIZE = 1000
+
+# Marker returned by the background fetch when there are no more pages.
+_DONE = object()
+
+
+def solr_date(value):
+    """Convert a CKAN metadata_modified value into the date syntax used in Solr queries."""
+    value = value.rstrip('Z')
+    if '.' in value:
+        seconds, fraction = value.split('.', 1)
+        value = f'{seconds}.{fraction[:3]}'
+    return f'{value}Z'
+
+
+def latest_modified(connection):
+    """Return the newest metadata_modified value in the catalog, or None if it is empty.
+       Taken before a walk of the datasets modified since some earlier value,
+       it marks where the next walk has to start so no change is missed.
+    """
+    result = connection.call_action(action='package_search', data_dict={
+        'rows': 1, 'sort': 'metadata_modified desc', 'fl': 'metadata_modified',
+        'include_private': True, 'include_drafts': True})
+    latest = result.get('results', []) if result else []
+    return latest[0].get('metadata_modified') if latest else None
+
+
+def prefetch(pages):
+    """Yield the items of the passed iterable, producing the next item in a
+       background thread while the caller works on the current one.
+    """
+    pages = iter(pages)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, pages, _DONE)
+        while True:
+            page = future.result()
+            if page is _DONE:
+                return
+            future = executor.submit(next, pages, _DONE)
+            yield page
+
+
+def next_page_size(connection, page_size=None):
+    """Return the passed page size, or else the one to ask for next over the connection."""
+    if page_size:
+        return page_size
+    controller = getattr(connection, 'controller', None)
+    return controller.page_size() if controller else PAGE_SIZE
+
+
+def can_stream(connection):
+    """Return True if the connection can decode list results one item at a time."""
+    return hasattr(connection, 'iter_action')
+
+
+def iter_result_items(connection, action, data_dict, path=()):
+    """Yield the items of the list in the result of an action. The keys in
+       'path' lead from the result to the list. Over a connection that can
+       stream, each item is yielded as it is decoded from the response.
+    """
+    if can_stream(connection):
+        yield from connection.iter_action(action, data_dict, path)
+        return
+    result = connection.call_action(action=action, data_dict=data_dict)
+    for key in path:
+        result = result.get(key) if result else None
+    yield from result or []
+
+
+def iter_offset_pages(connection, action, data_dict=None, page_size=None, path=(), limit_honoured=False):
+    """Yield, for each page of an action paged by limit and offset, the
+       number of items asked for and an iterator over the items, decoded
+       as the caller reads them. The walk ends when the caller stops asking
+       for pages.
+
+       The next page is requested in a background thread as soon as the
+       caller starts reading the current one, so that its response is spooled
+       while the current one is decoded. A server that ignores the limit
+       would send its whole list again, so this starts once a page has come
+       back full, or at once if 'limit_honoured' is passed. The request made
+       ahead of the page that ends the walk is not needed, and its response
+       is discarded.
+    """
+    data_dict = dict(data_dict or {})
+
+    def request(offset):
+        size = next_page_size(connection, page_size)
+        items = iter_result_items(connection, action, {**data_dict, 'limit': size, 'offset': offset}, path)
+        return size, items, executor.submit(next, items, _DONE)
+
+    def read(first, items, counts):
+        item = first.result()
+        while item is not _DONE:
+            counts.append(None)
+            yield item
+            item = next(items, _DONE)
+
+    def discard(page):
+        if page:
+            concurrent.futures.wait([page[2]])
+            page[1].close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        page = ahead = None
+        offset = 0
+        try:
+            while True:
+                page, ahead = ahead or request(offset), None
+                size, items, first = page
+                offset += size
+                if limit_honoured:
+                    ahead = request(offset)
+                counts = []
+                yield size, read(first, items, counts)
+                limit_honoured = limit_honoured or len(counts) == size
+                discard(page)
+                page = None
+        finally:
+            discard(page)
+            discard(ahead)
+
+
+def search_query(data_dict):
+    """Return the package_search data dictionary used for each page, and the
+       filter query to combine with the range selecting the next page.
+    """
+    data_dict = dict(data_dict or {})
+    fl = data_dict.get('fl')
+    if fl:
+        # The identifier is needed to select the next page.
+        fields = fl.split(',') if isinstance(fl, str) else list(fl)
+        if 'id' not in [f.strip() for f in fields]:
+            data_dict['fl'] = fields + ['id']
+    data_dict.update({'start': 0, 'sort': 'id asc'})
+    return data_dict, data_dict.get('fq')
+
+
+def search_page(data_dict, fq, after, page_size):
+    """Return the data dictionary for the page of identifiers after the passed one."""
+    page_dict = dict(data_dict, rows=page_size)
+    if after is not None:
+        keyset = f'id:{{"{after}" TO *]'
+        page_dict['fq'] = f'+({fq}) +{keyset}' if fq else keyset
+    return page_dict
+
+
+def iter_search_pages(connection, data_dict=None, page_size=None):
+    """Yield pages of package_search results in identifier order.
+       Any filter query in the passed data dictionary is kept, and combined
+       with a range on the identifier to select the next page.
+    """
+    data_dict, fq = search_query(data_dict)
+    after = None
+    while True:
+        size = next_page_size(connection, page_size)
+        result = connection.call_action(action='package_search',
+                                        data_dict=search_page(data_dict, fq, after, size))
+        page = result.get('results', []) if result else []
+        if not page:
+            return
+        yield page
+        if len(page) < size:
+            return
+        after = page[-1]['id']
+
+
+def iter_search_results(connection, data_dict=None, page_size=None):
+    """Yield package_search results one at a time in identifier order,
+       paging as iter_search_pages does.
+    """
+    data_dict, fq = search_query(data_dict)
+    after = None
+    while True:
+        size = next_page_size(connection, page_size)
+        count = 0
+        for dataset in iter_result_items(connection, 'package_search',
+                                         search_page(data_dict, fq, after, size), ('results',)):
+            count += 1
+            after = dataset['id']
+            yield dataset
+        if count < size:
+            return
+
+
+def iter_package_list_pages(connection, page_size=None):
+    """Yield pages of current_package_list_with_resources results,
+       leaving out datasets already returned on an earlier page.
+    """
+    seen = set()
+    offset = 0
+    while True:
+        size = next_page_size(connection, page_size)
+        page = connection.call_action(action='current_package_list_with_resources',
+                                      data_dict={'limit': size, 'offset': offset})
+        if not page:
+            return
+        offset += size
+        new = [d for d in page if d.get('id') not in seen]
+        seen.update(d.get('id') for d in new)
+        yield new
+
+
+def iter_package_list(connection, page_size=None):
+    """Yield current_package_list_with_resources results one at a time,
+       paging as iter_package_list_pages does.
+    """
+    seen = set()
+    # The walk only ends at an empty page, so the next one is always wanted.
+    for size, datasets in iter_offset_pages(connection, 'current_package_list_with_resources',
+                                            page_size=page_size, limit_honoured=True):
+        count = 0
+        for dataset in datasets:
+            count += 1
+            if dataset.get('id') not in seen:
+                seen.add(dataset.get('id'))
+                yield dataset
+        if not count:
+            return
+
+
+def iter_datasets(connection, action='package_search', data_dict=None, page_size=None):
+    """Yield every dataset returned by a paginated catalog action.
+       The action can be package_search, in which case the passed data
+       dictionary supplies the query, or current_package_list_with_resources.
+    """
+    if action == 'package_search':
+        if can_stream(connection):
+            yield from iter_search_results(connection, data_dict, page_size)
+            return
+        pages = iter_search_pages(connection, data_dict, page_size)
+    elif action == 'current_package_list_with_resources':
+        if can_stream(connection):
+            yield from iter_package_list(connection, page_size)
+            return
+        pages = iter_package_list_pages(connection, page_size)
+    else:
+        raise ValueError(f'Unsupported catalog action {action}')
+    for page in prefetch(pages):
+        yield from page
+
+
+def iter_user_pages(connection, data_dict=None, page_size=None):
+    """Yield pages of user_list results using limit and offset.
+       CKAN versions before 2.10 ignore the limit and return every user at
+       once, in which case that single response is the only page.
+    """
+    data_dict = dict(data_dict or {})
+    offset = 0
+    first_id = None
+    while True:
+        size = next_page_size(connection, page_size)
+        page = connection.call_action(action='user_list',
+                                      data_dict={**data_dict, 'limit': size, 'offset': offset})
+        if not page or page[0].get('id') == first_id:
+            return
+        first_id = page[0].get('id')
+        yield page
+        if len(page) != size:
+            return
+        offset += size
+
+
+def iter_users(connection, data_dict=None, page_size=None):
+    """Yield every user account returned by user_list, one at a time.
+       Over a connection that can stream, even the single unpaged response
+       of an older CKAN version is decoded one account at a time.
+    """
+    if not can_stream(connection):
+        for page in prefetch(iter_user_pages(connection, data_dict, page_size)):
+            yield from page
+        return
+    first_id = None
+    for size, users in iter_offset_pages(connection, 'user_list', data_dict, page_size):
+        count = 0
+        for user in users:
+            if not count:
+                if user.get('id') == first_id:
+                    # The limit was ignored and this page repeats the first.
+                    return
+                first_id = user.get('id')
+            count += 1
+            yield user
+        if count != size:
+            return
+
+
+def iter_organization_names(connection, page_size=None):
+    """Yield the name of every organization, paging through organization_list.
+       A server that ignores the limit returns every organization at once,
+       which is then the only page.
+    """
+    first_name = None
+    for size, names in iter_offset_pages(connection, 'organization_list', page_size=page_size):
+        count = 0
+        for name in names:
+            if not count:
+                if name == first_name:
+                    # The limit was ignored and this page repeats the first.
+                    return
+                first_name = name
+            count += 1
+            yield name
+        if count != size:
+            return
@@ -1,11 +1,19 @@
 import argparse
-import getpass
+import concurrent.futures
 import logging
 import os
+import sqlite3
 
 import ckanapi
 import json
 
+import ckan_client
+from ckan_paging import iter_datasets, latest_modified, solr_date
+from ckan_throttle import RateLimiter, call_with_retry
+
+WORKERS = 4
+BATCH_SIZE = 100
+
 
 def find_dataset(connection, title):
     
@@ -21,8 +29,8 @@ def find_dataset(connection, title):
         logging.error('No package found with title %s', title)
         return None
 
-def set_category(connection, package_name, category_name):
-    category_id = None
+def find_category(connection, category_name):
+    """Return the identifier of the named category group, or None if there is no such group."""
     try:
         result = connection.call_action(action='group_show', data_dict={'id':category_name,
                                                                         'include_datasets': False, 
@@ -32,50 +40,210 @@ def set_category(connection, package_name, category_name):
                                                                         'include_groups': False, 
                                                                         'include_tags': False, 
                                                                         'include_followers': False})
-        category_id = result.get('id')
-        result = connection.call_action(action='member_create', data_dict={'id': category_id, 'object': package_name, 'object_type': 'package', 'capacity': 'member'})
+        return result.get('id')
     except ckanapi.errors.NotFound:
         logging.info('Cannot find group %s', category_name)
+        return None
 
-    
-if __name__ == '__main__':
+def add_to_category(connection, package_name, category_id, limiter=None):
+    call_with_retry(connection, 'member_create', {'id': category_id, 'object': package_name, 'object_type': 'package', 'capacity': 'member'},
+                    limiter=limiter)
 
-    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+def set_category(connection, package_name, category_name):
+    category_id = find_category(connection, category_name)
+    if category_id is not None:
+        try:
+            add_to_category(connection, package_name, category_id)
+        except ckanapi.errors.NotFound:
+            logging.info('Cannot find package %s', package_name)
+
+def quote_phrase(text):
+    """Quote text as an exact phrase for a Solr query."""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def search_titles(connection, titles):
+    """Return the datasets whose title exactly matches one of the passed titles.
+       The titles are combined into a single query of exact phrases, and the
+       results are filtered again here because the search matches phrases
+       inside longer titles as well.
+    """
+    wanted = set(titles)
+    query = ' OR '.join(f'title:{quote_phrase(t)}' for t in titles)
+    return [p for p in iter_datasets(connection, action='package_search',
+                                     data_dict={'q': query, 'fl': 'id,title,metadata_modified',
+                                                'include_private': True})
+            if p.get('title') in wanted]
+
+class TitleIndex:
+    """Map from dataset title to dataset identifier, kept in a SQLite file
+       between runs. Before titles are resolved, datasets modified since
+       the last run are fetched so that renamed or deleted datasets are
+       brought up to date, and titles already in the index then need no
+       further API calls. If several datasets share a title, the most
+       recently modified one is used.
+    """
+
+    def __init__(self, path=':memory:'):
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY, id TEXT, modified TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.commit()
+
+    def _get_state(self, key):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
 
-    url = os.getenv('ED_CKAN_URL', None)
-    apiKey = os.getenv('ED_CKAN_KEY', None)
+    def store(self, datasets):
+        for d in datasets:
+            # Drop any entry left from an earlier title of the dataset.
+            self._db.execute('DELETE FROM titles WHERE id = ? AND title != ?', (d['id'], d.get('title')))
+            if d.get('state', 'active') != 'active' or not d.get('title'):
+                self._db.execute('DELETE FROM titles WHERE id = ?', (d['id'],))
+                continue
+            self._db.execute('INSERT INTO titles VALUES (?, ?, ?) ON CONFLICT(title) DO UPDATE '
+                             'SET id = excluded.id, modified = excluded.modified '
+                             'WHERE excluded.modified >= titles.modified',
+                             (d['title'], d['id'], d.get('metadata_modified', '')))
+        self._db.commit()
 
-    if not url:
-        url = input('Enter CKAN URL:')
-    if not apiKey:
-        api_key = getpass.getpass('Enter CKAN API key:')
+    def refresh(self, connection):
+        """Bring the index up to date with the datasets modified since the last refresh."""
+        watermark = self._get_state('watermark')
+        # Datasets changed while this refresh runs are picked up by the next one.
+        latest = latest_modified(connection)
+        if watermark is not None:
+            changed = list(iter_datasets(connection, action='package_search', data_dict={
+                'fq': f'metadata_modified:[{solr_date(watermark)} TO *]',
+                'fl': 'id,title,metadata_modified,state',
+                'include_private': True,
+                'include_deleted': True}))
+            logging.info('Refreshing title index with %d changed datasets', len(changed))
+            self.store(changed)
+        # A new index only needs changes made from now on.
+        if latest:
+            self._set_state('watermark', latest)
+            self._db.commit()
 
-    remote = ckanapi.RemoteCKAN(url, apiKey)
+    def lookup(self, title):
+        row = self._db.execute('SELECT id FROM titles WHERE title = ?', (title,)).fetchone()
+        return row[0] if row else None
+
+    def resolve(self, connection, titles, batch_size=BATCH_SIZE, workers=WORKERS):
+        """Return a dictionary mapping each passed title that matches a dataset
+           to the dataset identifier, and a list of the titles that could not
+           be searched for. Titles missing from the index are searched for in
+           batches, with the batches run concurrently. Entries without a
+           title match no dataset.
+        """
+        self.refresh(connection)
+        titles = {t for t in titles if isinstance(t, str) and t}
+        found = {}
+        for title in titles:
+            pkg_id = self.lookup(title)
+            if pkg_id is not None:
+                found[title] = pkg_id
+        unknown = sorted(titles - found.keys())
+        batches = [unknown[i:i + batch_size] for i in range(0, len(unknown), batch_size)]
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(search_titles, connection, batch): batch for batch in batches}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    self.store(future.result())
+                except Exception as e:
+                    logging.error('Could not search for %d titles: %s', len(futures[future]), e)
+                    failed.extend(futures[future])
+        for title in unknown:
+            pkg_id = self.lookup(title)
+            if pkg_id is not None:
+                found[title] = pkg_id
+        return found, failed
+
+    def close(self):
+        self._db.close()
+
+def set_category_bulk(connection, titles, category_name, workers=WORKERS, limiter=None, index=None, batch_size=BATCH_SIZE):
+    """Associate every dataset with one of the passed titles to the named category.
+       The category is looked up once, the titles are resolved in batches
+       through the title index, and the membership writes run concurrently
+       on a bounded pool of worker threads.
+       Returns a dictionary listing the titles that were assigned, the titles
+       with no matching dataset, and the titles whose assignment failed.
+    """
+    report = {'assigned': [], 'missing': [], 'failed': []}
+    category_id = find_category(connection, category_name)
+    if category_id is None:
+        report['failed'] = list(titles)
+        return report
+
+    try:
+        found, failed = (index or TitleIndex()).resolve(connection, titles, batch_size, workers)
+    except Exception as e:
+        logging.error('Could not resolve dataset titles: %s', e)
+        report['failed'] = list(titles)
+        return report
+    failed = set(failed)
+
+    def assign(title):
+        if title in failed:
+            return 'failed'
+        pkg_id = found.get(title)
+        if pkg_id is None:
+            return 'missing'
+        try:
+            logging.info('Setting category for package id %s to %s', pkg_id, category_name)
+            add_to_category(connection, pkg_id, category_id, limiter)
+            return 'assigned'
+        except Exception as e:
+            logging.error('Could not set category for dataset %s: %s', title, e)
+            return 'failed'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for title, outcome in zip(titles, executor.map(assign, titles)):
+            report[outcome].append(title)
+    return report
+
+    
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
 
     ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
         description='''Set category associations in a CKAN instance for every dataset listed in an input file to the category name specified on the command line.''',
         epilog='''The program expects the input file to be compliant with the DCAT-US version 1.1 schema, and looks for title fields in the dataset list.
         The program creates the category as a type of CKAN group if it does not already exist in the instance.
         The program uses the following environment variables to identify and authenticate to the CKAN instance, prompting for their values if not set:
-  ED_CKAN_URL: The web address to use for API calls.
-  ED_CKAN_KEY: The authentication key value to use for API calls.
+  CKAN_URL (or ED_CKAN_URL): The web address to use for API calls.
+  CKAN_KEY (or ED_CKAN_KEY): The authentication key value to use for API calls.
 ''')
     ap.add_argument('-f','--filename', 
         help='Use the data in the specified file to identify the datasets to change.')
     ap.add_argument('-c','--category', required=True, help='The name of the category group to associate with the datasets.')
     ap.add_argument('-i','--id',help='The identifier for a specific package to change.')
+    ap.add_argument('-w','--workers', type=int, default=WORKERS, help='Number of datasets from the input file to process concurrently.')
+    ap.add_argument('--rate', type=float, default=None, help='Maximum number of membership changes per second.')
+    ap.add_argument('--index', help='File for keeping the dataset title index between runs.')
+    ap.add_argument('--batch', type=int, default=BATCH_SIZE, help='Number of titles to look up in each search request.')
     args = ap.parse_args()
 
+    remote = ckan_client.connect(pool_size=args.workers)
+
     if args.filename is not None:
         with open(args.filename) as ifp:
             input_dict = json.load(ifp)
-            for dataset in input_dict.get('dataset'):
-                dataset_title = dataset.get('title')
-                logging.info('Searching for dataset %s', dataset_title)
-                pkg_id = find_dataset(remote,dataset_title)
-                if pkg_id is not None:
-                    logging.info('Setting category for package id %s to %s', pkg_id, args.category)
-                    set_category(remote, pkg_id, args.category)
+        titles = [dataset.get('title') for dataset in input_dict.get('dataset')]
+        index = TitleIndex(args.index) if args.index else TitleIndex()
+        report = set_category_bulk(remote, titles, args.category, args.workers, RateLimiter(args.rate), index, args.batch)
+        index.close()
+        print(f'Assigned {len(report["assigned"])} datasets to {args.category}.')
+        for outcome in ('missing', 'failed'):
+            if report[outcome]:
+                print(f'{outcome.capitalize()} ({len(report[outcome])}):')
+                for title in report[outcome]:
+                    print(f'  {title if title is not None else "(no title)"}')
     if args.id is not None:
         set_category(remote, args.id, args.category)
         
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""Incremental decoding of large CKAN action responses.
+
+ A page of current_package_list_with_resources, or an unpaged user_list,
+ can be hundreds of megabytes of JSON. Decoding it with json.loads holds
+ the whole text and the whole decoded result in memory at once. The
+ generator in this module instead reads the response a block at a time
+ and yields the items of the list in the result as each one is complete,
+ so only one item and one block of text are held at a time.
+
+ The response is first copied as it arrives into a spool file, which is
+ held in memory only while it is small, and the items are decoded from
+ there. The connection is then free again, however long the caller takes
+ over the items, and does not time out partway through a page.
+
+ The members of the response around the list, such as 'success' and
+ 'error', are decoded whole, so that errors can still be reported as
+ ckanapi would.
+"""
+import codecs
+import json
+import re
+
+READ_SIZE = 65536
+# Largest response held in memory while it is decoded; larger ones are spooled to disk.
+SPOOL_SIZE = 8 * 1024 * 1024
+WHITESPACE = ' \t\n\r'
+# Text at the end of a block that may be the rest of a number cut short.
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+_decoder = json.JSONDecoder()
+
+
+class TextStream:
+    """Text decoded from an iterable of UTF-8 byte blocks, read from the
+       front. Text before the current position is dropped as more is read.
+    """
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.text = ''
+        self.pos = 0
+        self.ended = False
+
+    def more(self):
+        """Read another block. Returns False if the stream has already ended."""
+        if self.ended:
+            return False
+        block = next(self._blocks, None)
+        self.ended = block is None
+        self.text = self.text[self.pos:] + self._decode(block or b'', final=self.ended)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return ''
+
+    def expect(self, characters):
+        """Consume and return the next character, which must be one of those passed."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f'Expected one of {characters!r} at {character!r} in the response')
+        self.pos += 1
+        return character
+
+    def value(self):
+        """Decode and return the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # A number ending with the text, or followed only by what
+                # could be more of it, may continue in the next block.
+                if (self.ended or not isinstance(value, (int, float)) or isinstance(value, bool)
+                        or not NUMBER_TAIL.match(self.text, end)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.ended:
+                    raise
+            self.more()
+
+
+def iter_members(stream, path, members):
+    """Walk the object at the current position of the stream, yielding the
+       items of the array reached by following the keys in 'path'. Other
+       members are decoded whole and stored in 'members'. Returns True if
+       the array was found.
+    """
+    found = False
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.pos += 1
+        return found
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if path and key == path[0] and stream.peek() == ('[' if len(path) == 1 else '{'):
+            if len(path) == 1:
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.pos += 1
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.expect(',]') == ']':
+                            break
+                found = True
+            else:
+                found = yield from iter_members(stream, path[1:], {})
+        else:
+            members[key] = stream.value()
+        if stream.expect(',}') == '}':
+            return found
+
+
+def iter_json_array(blocks, path, members):
+    """Yield the items of the array at 'path' in a JSON object read from an
+       iterable of byte blocks. Top-level members not on the path are stored
+       in 'members'. Returns True if the array was found.
+    """
+    return (yield from iter_members(TextStream(blocks), tuple(path), members))
@@ -0,0 +1,197 @@
+"""Pacing and retry for CKAN API calls.
+
+ Scripts that issue many write calls share the helpers in this module so
+ that a large run neither floods the CKAN server nor gives up on a dataset
+ because of one transient failure. A RateLimiter spaces out the start of
+ calls across all worker threads, and call_with_retry repeats calls that
+ failed with a server error or a network timeout, backing off between
+ attempts.
+
+ Every connection made through ckan_client also has a LoadController,
+ which adapts the number of calls in flight at once and the page size of
+ catalog walks to how the server is coping. Both grow while calls succeed
+ within a target latency, and are halved when calls fail with a server
+ error, are throttled, or are slower than the target. A Retry-After
+ header on a 429 or 503 response pauses all calls for the time it gives.
+ Neither ever exceeds its ceiling, so a job runs as fast as the server
+ tolerates without slowing it down for everyone else.
+"""
+import contextlib
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+
+import ckanapi
+import requests
+
+from ckan_metrics import METRICS
+
+RETRIES = 3
+BACKOFF = 1.0
+# Default ceilings and target for a LoadController.
+MAX_PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 25
+TARGET_LATENCY = 5.0
+# Actions whose page size the LoadController sets.
+PAGED_ACTIONS = ('package_search', 'current_package_list_with_resources', 'user_list', 'organization_list')
+
+
+class RateLimiter:
+    """Limit the number of calls started per second, shared by all threads.
+       A rate of zero or None means calls are not limited.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        """Block until the next call is allowed to start."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def retry_after_seconds(value):
+    """Return the delay in seconds given by a Retry-After header value, or None.
+       The value can be a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, moment.timestamp() - time.time())
+
+
+class LoadController:
+    """Adapt the number of concurrent calls and the page size of catalog
+       walks to the load on the server, shared by all threads, in the way
+       TCP adapts its window. Each call that succeeds within the target
+       latency raises the concurrency by one per round of calls, and each
+       fast page raises the page size by a tenth of its ceiling (additive
+       increase). A call that fails with a server error or no response, is
+       throttled, or is slower than the target halves both (multiplicative
+       decrease). Calls already in flight when the server slows down are
+       likely to fail together, so only calls started after the last
+       decrease can cause another one. After a decrease, neither grows again
+       for the target latency, or any longer pause the server asked for, so
+       the server is not probed again straight away.
+    """
+
+    def __init__(self, max_concurrency, max_page_size=MAX_PAGE_SIZE, target_latency=TARGET_LATENCY,
+                 min_page_size=MIN_PAGE_SIZE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_page_size = max(1, max_page_size)
+        self.min_page_size = min(min_page_size, self.max_page_size)
+        self.target_latency = target_latency
+        # Start at the ceilings, which are what the job is allowed to use.
+        self.concurrency = float(self.max_concurrency)
+        self._page_size = float(self.max_page_size)
+        self._in_flight = 0
+        self._resume_at = 0.0
+        self._last_decrease = 0.0
+        self._hold_until = 0.0
+        self._condition = threading.Condition()
+
+    def page_size(self):
+        """Return the number of records to ask for in the next page."""
+        with self._condition:
+            return int(self._page_size)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one of the allowed concurrent calls for the duration of a call,
+           waiting for one to be free and for any Retry-After pause to end.
+        """
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait <= 0 and self._in_flight < int(self.concurrency):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def observe(self, action, seconds, status=None, retry_after=None):
+        """Adjust the limits after a call to an action that took 'seconds'.
+           The status is None for a call that got no response.
+        """
+        throttled = status in (429, 503)
+        overloaded = status is None or throttled or status >= 500 or seconds > self.target_latency
+        delay = retry_after_seconds(retry_after) if throttled else None
+        with self._condition:
+            now = time.monotonic()
+            if delay:
+                self._resume_at = max(self._resume_at, now + delay)
+            if overloaded:
+                if now - seconds >= self._last_decrease:
+                    self._last_decrease = now
+                    self._hold_until = now + max(delay or 0.0, self.target_latency)
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self._page_size = max(self.min_page_size, self._page_size / 2)
+                    logging.info('Server under load after %s (status %s, %.1fs): '
+                                 'reducing to %d concurrent calls and pages of %d',
+                                 action, status, seconds, self.concurrency, self._page_size)
+            elif status < 400 and now >= self._hold_until:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                if action in PAGED_ACTIONS:
+                    self._page_size = min(self.max_page_size, self._page_size + self.max_page_size / 10)
+            self._condition.notify_all()
+
+
+def error_status(error):
+    """Return the HTTP status for an error that ckanapi did not recognize, or None.
+       ckanapi reports such errors with the URL, status and response text
+       as the message.
+    """
+    if type(error) is not ckanapi.errors.CKANAPIError:
+        return None
+    match = re.match(r"\[.*?, (\d{3}), ", str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_transient(error):
+    """Return True if a failed call is worth repeating."""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    status = error_status(error)
+    return status is not None and (status >= 500 or status == 429)
+
+
+def call_with_retry(connection, action, data_dict, limiter=None, retries=RETRIES, backoff=BACKOFF):
+    """Call a CKAN action, repeating it after transient failures.
+       The delay before each repeat doubles, with some jitter so that
+       workers failing together do not retry together.
+    """
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.wait()
+        try:
+            return connection.call_action(action=action, data_dict=data_dict)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            METRICS.record_retry(action)
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.warning('Retrying %s in %.1f seconds after error: %s', action, delay, e)
+            time.sleep(delay)
@@ -1,45 +1,67 @@
 """Python command-line script for listing CKAN user accounts.
  
  The base URL for the API to use (without the trailing "/api/action" text)
- can be specified in an environment variable named 'CKAN_URL'. The value for the
+ can be specified in an environment variable named 'CKAN_URL' (or 'ED_CKAN_URL'). The value for the
  URL will be prompted for input if the environment variable is not set.
 
  The API key to use for authentication can be specified in an environment
- variable named 'CKAN_KEY'. The value for the API key will be prompted for input
+ variable named 'CKAN_KEY' (or 'ED_CKAN_KEY'). The value for the API key will be prompted for input
  if the environment variable is not set.
 
- 
+ With the '--db' option the accounts are read from the CKAN database
+ instead of through the API, using the connection settings described in
+ ckan_db.py. The output is the same either way.
 """
+import argparse
 import logging
 import os
 import string
 import sys
 
-import ckanapi
 import json
 
+import ckan_client
+import ckan_db
+from ckan_paging import iter_users
 
-    
-if __name__ == '__main__':
+ACCOUNTS_SQL = '''
+SELECT email, sysadmin, created FROM "user"
+WHERE state != 'deleted' AND name != %(site_id)s
+ORDER BY created, id
+'''
 
-    logging.basicConfig(level=logging.INFO)
-    
-    # Retrieve the URL and API Key from environment variables, if set.
-    url = os.getenv('CKAN_URL', None)
-    api_key = os.getenv('CKAN_KEY', None)
+def api_accounts(connection):
+    """Yield the email address, sysadmin flag and creation date of each account."""
+    for user in iter_users(connection, {'order_by': 'created'}):
+        yield user["email"], user["sysadmin"], user["created"]
 
-    # Prompt for the API connection details if missing.
-    if not url:
-        url = raw_input('Enter CKAN URL:')
-    if not api_key:
-        api_key = getpass.getpass('Enter CKAN API key:')
+def db_accounts(db, site_id=ckan_db.SITE_ID):
+    """Yield the same values as api_accounts from the CKAN database.
+       The site user, which the API leaves out of user_list, is skipped if its name is passed.
+    """
+    for email, sysadmin, created in ckan_db.iter_rows(db, ACCOUNTS_SQL, {'site_id': site_id}):
+        yield email, sysadmin, created.isoformat()
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+def print_accounts(accounts):
+    print('User ID,role,account created date')
+    for email, sysadmin, created in accounts:
+        print(f'{email},{"admin" if sysadmin else "user"},{created}')
 
-    dd = {'order_by': 'created'}
-    result = remote.call_action(action='user_list', data_dict=dd)
+if __name__ == '__main__':
 
-    print('User ID,role,account created date')
-    for user in result:
-        print(f'{user["email"]},{"admin" if user["sysadmin"] else "user"},{user["created"]}')
-    
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    
+    ap = argparse.ArgumentParser(description='List CKAN user accounts.')
+    ap.add_argument('--db', nargs='?', const='', metavar='DSN',
+                    help='Read from the CKAN database instead of the API, optionally with a connection string.')
+    ap.add_argument('--site-id', default=ckan_db.SITE_ID,
+                    help="The ckan.site_id setting, naming the site user to leave out when reading from the database "
+                         "(default: $CKAN_SITE_ID or 'default').")
+    args = ap.parse_args()
+
+    if args.db is not None:
+        with ckan_db.connect(args.db) as db:
+            print_accounts(db_accounts(db, args.site_id))
+    else:
+        # Connect using the URL and API key from the environment, prompting for any that are missing.
+        print_accounts(api_accounts(ckan_client.connect()))
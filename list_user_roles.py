@@ -1,34 +1,95 @@
 """Python command-line script for listing CKAN groups and associated user accounts.
  
  The base URL for the API to use (without the trailing "/api/action" text)
- can be specified in an environment variable named 'CKAN_URL'. The value for the
+ can be specified in an environment variable named 'CKAN_URL' (or 'ED_CKAN_URL'). The value for the
  URL will be prompted for input if the environment variable is not set.
 
  The API key to use for authentication can be specified in an environment
- variable named 'CKAN_KEY'. The value for the API key will be prompted for input
+ variable named 'CKAN_KEY' (or 'ED_CKAN_KEY'). The value for the API key will be prompted for input
  if the environment variable is not set.
 
- 
+ With the '--db' option the report is computed by a single query on the
+ CKAN database instead of through the API, using the connection settings
+ described in ckan_db.py. The output is the same either way.
 """
+import argparse
+import concurrent.futures
+import csv
 import logging
 import os
 import string
 import sys
 
-import ckanapi
 import json
 
+import ckan_client
+import ckan_db
+from ckan_paging import iter_organization_names, iter_users
+
+# Organization roles, in decreasing order of privilege.
+ROLE_RANK = {'admin': 0, 'editor': 1, 'member': 2}
+
+WORKERS = 4
+
+# Each active user with their most privileged role in an active organization. The
+# display name falls back to the user name for a blank full name, as in CKAN.
+ROLE_REPORT_SQL = '''
+SELECT u.id, CASE WHEN u.fullname ~ '\\S' THEN u.fullname ELSE u.name END, u.sysadmin, u.created, r.capacity
+FROM "user" u
+LEFT JOIN (
+    SELECT DISTINCT ON (m.table_id) m.table_id AS user_id, m.capacity
+    FROM member m JOIN "group" g ON g.id = m.group_id
+    WHERE m.table_name = 'user' AND m.state = 'active' AND g.is_organization AND g.state = 'active'
+    ORDER BY m.table_id, CASE m.capacity {ranks} ELSE {unranked} END
+) r ON r.user_id = u.id
+WHERE u.state != 'deleted' AND u.name != %(site_id)s
+ORDER BY u.created, u.id
+'''
+
+def role_rank(role):
+    """Return the precedence of an organization role, where lower is more privileged.
+       Roles not known here rank below all the known ones.
+    """
+    return ROLE_RANK.get(role, len(ROLE_RANK))
+
+def add_user_role(roles, user_id, capacity):
+    """Record a role for a user, keeping the most privileged role seen."""
+    if user_id not in roles or role_rank(capacity) < role_rank(roles[user_id]):
+        roles[user_id] = capacity
+
 def build_user_role_list(org_response):
     roles = {}
     for org in org_response:
         for user in org["users"]:
-            if user["id"] in roles:
-                # The three roles expected are admin, editor, and member, which are in decreasing order or privilege.
-                # Since the role names are alphabetical, capture the highest privilege by storing the lower role name.
-                if user["capacity"] < roles[user["id"]]:
-                    roles[user["id"]] = user["capacity"]
-            else:
-                roles[user["id"]] = user["capacity"]
+            add_user_role(roles, user["id"], user["capacity"])
+    return roles
+
+def fetch_user_roles(connection, workers=WORKERS):
+    """Build the map from user id to most privileged organization role.
+       Only the organization names are listed up front, and the members of
+       each organization are fetched concurrently and merged as each
+       response arrives, so no full organization records are held.
+       Raises RuntimeError if the members of any organization could not
+       be listed, since the roles would otherwise be reported wrongly.
+    """
+    roles = {}
+    failed = []
+
+    def members(org_name):
+        return connection.call_action(action='member_list', data_dict={'id': org_name, 'object_type': 'user'})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(members, name): name for name in iter_organization_names(connection)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                for user_id, object_type, capacity in future.result():
+                    add_user_role(roles, user_id, capacity)
+            except Exception as e:
+                logging.error('Could not list members of %s: %s', futures[future], e)
+                failed.append(futures[future])
+            del futures[future]
+    if failed:
+        raise RuntimeError(f'Could not list the members of {len(failed)} organizations')
     return roles
 
 def get_role(user_id, user_roles):
@@ -36,35 +97,61 @@ def get_role(user_id, user_roles):
         return user_roles[user_id]
     else:
         return "public"
-    
-if __name__ == '__main__':
 
-    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
-    
-    # Retrieve the URL and API Key from environment variables, if set.
-    url = os.getenv('CKAN_URL', None)
-    api_key = os.getenv('CKAN_KEY', None)
+def role_report_rows(connection, workers=WORKERS):
+    """Return the account role report rows, produced one per user as each page
+       of users arrives. The roles are fetched before this returns, so a
+       failure to fetch them ends the report before anything is written.
+    """
+    user_role_list = fetch_user_roles(connection, workers)
+    logging.info(user_role_list)
 
-    # Prompt for the API connection details if missing.
-    if not url:
-        url = raw_input('Enter CKAN URL:')
-    if not api_key:
-        api_key = getpass.getpass('Enter CKAN API key:')
+    def rows():
+        for user in iter_users(connection, {'all_fields': True, 'order_by': 'created'}):
+            role = 'admin' if user["sysadmin"] else get_role(user["id"], user_role_list)
+            yield [user["id"], user["display_name"], role, user["created"]]
+    return rows()
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+def db_role_report_rows(db, site_id=ckan_db.SITE_ID):
+    """Yield the account role report rows from the CKAN database, matching role_report_rows.
+       The site user, which the API leaves out of user_list, is skipped if its name is passed.
+    """
+    ranks = ' '.join(f"WHEN '{role}' THEN {rank}" for role, rank in ROLE_RANK.items())
+    sql = ROLE_REPORT_SQL.format(ranks=ranks, unranked=len(ROLE_RANK))
+    for user_id, display_name, sysadmin, created, capacity in ckan_db.iter_rows(db, sql, {'site_id': site_id}):
+        role = 'admin' if sysadmin else capacity or 'public'
+        yield [user_id, display_name, role, created.isoformat()]
 
-    dd = {'all_fields': True, 'include_users': True}
-    result = remote.call_action(action='organization_list', data_dict=dd)
-    user_role_list = build_user_role_list(result)
-    logging.info(user_role_list)
+def write_report(rows, output):
+    """Write the account role report rows as CSV."""
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(['account_id', 'account_name', 'role', 'creation_date'])
+    writer.writerows(rows)
 
-    dd = {'all_fields': True, 'order_by':'created'}
-    result = remote.call_action(action='user_list', data_dict=dd)
+def write_role_report(connection, output, workers=WORKERS):
+    """Write the account role report as CSV, one row per user as each page of users arrives."""
+    write_report(role_report_rows(connection, workers), output)
+    
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+    
+    ap = argparse.ArgumentParser(description='List CKAN user accounts with their most privileged organization role.')
+    ap.add_argument('--db', nargs='?', const='', metavar='DSN',
+                    help='Read from the CKAN database instead of the API, optionally with a connection string.')
+    ap.add_argument('--site-id', default=ckan_db.SITE_ID,
+                    help="The ckan.site_id setting, naming the site user to leave out when reading from the database "
+                         "(default: $CKAN_SITE_ID or 'default').")
+    args = ap.parse_args()
 
-    print('account_id,account_name,role,creation_date')
-    for user in result:
-        if user["sysadmin"]:
-            print(f'{user["id"]},{user["display_name"]},admin,{user["created"]}')
-        else:
-            print(f'{user["id"]},{user["display_name"]},{get_role(user["id"], user_role_list)},{user["created"]}')
-    
\ No newline at end of file
+    if args.db is not None:
+        with ckan_db.connect(args.db) as db:
+            write_report(db_role_report_rows(db, args.site_id), sys.stdout)
+    else:
+        # Connect using the URL and API key from the environment, prompting for any that are missing.
+        remote = ckan_client.connect(pool_size=WORKERS + 1)
+        try:
+            write_role_report(remote, sys.stdout)
+        except RuntimeError as e:
+            logging.error(e)
+            sys.exit(1)
@@ -3,11 +3,11 @@
  manage memberships in groups or roles.
 
  The base URL for the API to use (without the trailing "/api/action" text)
- can be specified in an environment variable named 'CKAN_URL'. The value for the
+ can be specified in an environment variable named 'CKAN_URL' (or 'ED_CKAN_URL'). The value for the
  URL will be prompted for input if the environment variable is not set.
 
  The API key to use for authentication can be specified in an environment
- variable named 'CKAN_KEY'. The value for the API key will be prompted for input
+ variable named 'CKAN_KEY' (or 'ED_CKAN_KEY'). The value for the API key will be prompted for input
  if the environment variable is not set.
 
  The script expects a single command-line argument, specifying the name
@@ -54,16 +54,35 @@
     }
 ]
 
+ The file can also be in JSON Lines format, with one user account data
+ dictionary per line. Either format is read incrementally, so the whole
+ file is never held in memory.
+
+ Entries are run concurrently by a pool of workers, whose size can be set
+ on the command line. Entries that share an 'id' or 'name' value still
+ run in file order, so an entry naming an account by its identifier waits
+ for an earlier one naming it by the same identifier, and one giving both
+ waits for earlier entries giving either. The outcome of every entry is
+ written as a line of JSON to the result log, which is the standard output
+ unless a file is named on the command line. The exit status is 1 if any
+ entry failed.
 """
-import getpass
+import argparse
+import concurrent.futures
+import functools
+import itertools
 import json
 import logging
 import os
 import random
 import string
 import sys
+import threading
+
+import ckan_client
 
-import ckanapi
+WORKERS = 4
+READ_SIZE = 65536
 
 
 def create_user_account(connection, user_data_dict):
@@ -87,6 +106,7 @@ def create_user_account(connection, user_data_dict):
 
     except:
         logging.exception('Exception creating user account for %s',user_data_dict['name'])
+        raise
 
 def update_user_account(connection, user_data_dict):
     """Update an existing user account."""
@@ -102,6 +122,7 @@ def update_user_account(connection, user_data_dict):
             logging.info("Nothing left to update for %s", user_data_dict['id'])
     except:
         logging.exception('Error attempting to update user account for %s', user_data_dict['id'])
+        raise
     
 def reset_user_apikey(connection, user_data_dict):
     """Regenerate the API key for an existing user account.
@@ -111,6 +132,7 @@ def reset_user_apikey(connection, user_data_dict):
         logging.info('Regenerated API Key for %s', user_data_dict['id'])
     except:
         logging.exception('Error attempting to regenerate API key for %s', user_data_dict['id'])
+        raise
     
 def delete_user_account(connection, user_data_dict):
     """Delete an existing user account.
@@ -120,49 +142,215 @@ def delete_user_account(connection, user_data_dict):
         logging.info("Deleted user account for %s", user_data_dict['id'])
     except:
         logging.exception('Error attempting to delete user account for %s', user_data_dict['id'])
+        raise
+
+def iter_json_entries(input_file):
+    """Yield the entries of a JSON array, or of a JSON Lines file, one at a time.
+       An array is decoded incrementally from chunks of the file, so only the
+       entry being decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = input_file.read(READ_SIZE)
+    stripped = buffer.lstrip()
+    while not stripped and buffer:
+        buffer = input_file.read(READ_SIZE)
+        stripped = buffer.lstrip()
+    if not stripped.startswith('['):
+        # JSON Lines: one entry per line.
+        for line in itertools.chain((buffer + input_file.readline()).splitlines(), input_file):
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    buffer = stripped[1:]
+    eof = False
+    while True:
+        # Skip the separators between entries.
+        pos = 0
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+            pos += 1
+        buffer = buffer[pos:]
+        if buffer.startswith(']'):
+            return
+        if not buffer:
+            if eof:
+                raise ValueError('Unterminated JSON array in input file')
+            chunk = input_file.read(READ_SIZE)
+            eof = not chunk
+            buffer += chunk
+            continue
+        try:
+            entry, end = decoder.raw_decode(buffer)
+            # A value that ends exactly at the end of the buffer may continue in the next chunk.
+            complete = end < len(buffer) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if complete:
+            yield entry
+            buffer = buffer[end:]
+        else:
+            chunk = input_file.read(READ_SIZE)
+            eof = not chunk
+            buffer += chunk
+
+def run_entry(connection, user_entry):
+    """Run the action named in a user entry. Returns the status to record in the result log."""
+    action = user_entry.pop('action', None)
+    match action:
+        case None:
+            logging.info('Missing action in %s', user_entry)
+            return 'skipped'
+        case 'create':
+            create_user_account(connection, user_entry)
+        case 'delete':
+            delete_user_account(connection, user_entry)
+        case 'reset':
+            reset_user_apikey(connection, user_entry)
+        case 'update':
+            update_user_account(connection, user_entry)
+        case _:
+            logging.error('Unknown action: %s', action)
+            return 'skipped'
+    return 'done'
+
+class OrderedTask:
+    """A task for OrderedExecutor, with the later tasks that wait for it."""
+
+    def __init__(self, fn, keys):
+        self.fn = fn
+        self.keys = set(keys)
+        self.waiting = 0
+        self.followers = []
+
+class OrderedExecutor:
+    """Run tasks on a pool of worker threads, keeping tasks that share any
+       of their keys in the order they were submitted. Submission blocks
+       once a bounded number of tasks are waiting, so input can be streamed
+       into the pool.
+    """
+
+    def __init__(self, workers):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Condition()
+        self._slots = threading.BoundedSemaphore(workers * 4)
+        # The last task submitted for each key that has not finished yet.
+        self._last = {}
+        # Tasks submitted and not finished, some of which may not be in the pool yet.
+        self._unfinished = 0
+
+    def submit(self, keys, fn):
+        """Submit a task, to run after every earlier task sharing one of the keys."""
+        self._slots.acquire()
+        task = OrderedTask(fn, keys)
+        with self._lock:
+            earlier = {self._last[key] for key in task.keys if key in self._last}
+            for previous in earlier:
+                previous.followers.append(task)
+            task.waiting = len(earlier)
+            self._unfinished += 1
+            for key in task.keys:
+                self._last[key] = task
+            if task.waiting:
+                return
+        self._executor.submit(self._run, task)
+
+    def _run(self, task):
+        try:
+            task.fn()
+        except Exception:
+            logging.exception('Unexpected error running task for %s', task.keys)
+        finally:
+            self._slots.release()
+        with self._lock:
+            for key in task.keys:
+                if self._last.get(key) is task:
+                    del self._last[key]
+            ready = []
+            for follower in task.followers:
+                follower.waiting -= 1
+                if not follower.waiting:
+                    ready.append(follower)
+            # Followers are submitted before this task counts as finished,
+            # so the pool is not shut down while they still need it.
+            for follower in ready:
+                self._executor.submit(self._run, follower)
+            self._unfinished -= 1
+            self._lock.notify_all()
+
+    def shutdown(self):
+        with self._lock:
+            self._lock.wait_for(lambda: not self._unfinished)
+        self._executor.shutdown(wait=True)
+
+def entry_keys(user_entry):
+    """Return the identifiers a user entry names its account by, which order
+       it against other entries. Entries naming none share a single key.
+    """
+    keys = {user_entry[field] for field in ('id', 'name') if user_entry.get(field)}
+    return keys or {None}
+
+def run_entries(connection, entries, result_log, workers=WORKERS):
+    """Run every entry, writing one line of JSON per entry to the result log.
+       Returns the number of entries that failed.
+    """
+    log_lock = threading.Lock()
+    failed = 0
+
+    def run(index, user_entry):
+        nonlocal failed
+        record = {'entry': index, 'action': user_entry.get('action'),
+                  'user': user_entry.get('id', user_entry.get('name'))}
+        try:
+            record['status'] = run_entry(connection, user_entry)
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e)
+        with log_lock:
+            if record['status'] == 'failed':
+                failed += 1
+            result_log.write(json.dumps(record) + '\n')
+            result_log.flush()
+
+    executor = OrderedExecutor(workers)
+    try:
+        for index, user_entry in enumerate(entries):
+            executor.submit(entry_keys(user_entry), functools.partial(run, index, user_entry))
+    finally:
+        executor.shutdown()
+    return failed
 
 if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
-    
-    # Retrieve the URL and API Key from environment variables, if set.
-    url = os.getenv('CKAN_URL', None)
-    api_key = os.getenv('CKAN_KEY', None)
-
-    # Prompt for the API connection details if missing.
-    if not url:
-        url = input('Enter CKAN URL:')
-    if not api_key:
-        api_key = getpass.getpass('Enter CKAN API key:')
-
-    remote = ckanapi.RemoteCKAN(url, api_key)
-
-    if len(sys.argv) > 1:
-        input_file_name = sys.argv[1]
-        with open(input_file_name) as input_file:
-            try:
-                user_entries = json.load(input_file)
-                for user_entry in user_entries:
-                    action = user_entry.get('action', None)
-                    if action is not None:
-                        user_entry.pop('action')
-                        
-                        match action:
-
-                            case 'create':
-                                create_user_account(remote, user_entry)
-                            case 'delete':
-                                delete_user_account(remote, user_entry)
-                            case 'reset':
-                                reset_user_apikey(remote, user_entry)
-                            case 'update':
-                                update_user_account(remote, user_entry)
-                            case _:
-                                logging.error('Unknown action: %s', action)
-                    else:
-                        logging.info('Missing action in %s', user_entry)
-            except:
-                logging.exception('Exception reading input file.')
-    else:
+
+    ap = argparse.ArgumentParser(description='Create, update, delete or reset CKAN user accounts from a file of user entries.')
+    ap.add_argument('filename', nargs='?', help='File of JSON user entries, as an array or as JSON Lines.')
+    ap.add_argument('-w','--workers', type=int, default=WORKERS, help='Number of entries to run concurrently.')
+    ap.add_argument('-l','--log', help='File for the per-entry result log. Defaults to the standard output.')
+    args = ap.parse_args()
+
+    if args.filename is None:
         print('Provide a file name containing JSON user entries as the only command argument.')
+        sys.exit(1)
+    if args.workers < 1:
+        ap.error('--workers must be at least 1.')
+    
+    # Connect using the URL and API key from the environment, prompting for any that are missing.
+    remote = ckan_client.connect(pool_size=args.workers)
 
+    result_log = open(args.log, 'a') if args.log else sys.stdout
+    status = 0
+    with open(args.filename) as input_file:
+        try:
+            failed = run_entries(remote, iter_json_entries(input_file), result_log, args.workers)
+            if failed:
+                logging.error('%d entries failed.', failed)
+                status = 1
+        except:
+            logging.exception('Exception reading input file.')
+            status = 1
+    if args.log:
+        result_log.close()
+    sys.exit(status)
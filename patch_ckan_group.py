@@ -1,10 +1,11 @@
 import argparse
-import getpass
 import logging
 import os
 
 import ckanapi
 
+import ckan_client
+
 def find_group_by_name(connection, group_name):
     
     try:
@@ -31,21 +32,13 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
 
-    url = os.getenv('ED_CKAN_URL', None)
-    apiKey = os.getenv('ED_CKAN_KEY', None)
-
-    if not url:
-        url = input('Enter CKAN URL:')
-    if not apiKey:
-        api_key = getpass.getpass('Enter CKAN API key:')
-
-    remote = ckanapi.RemoteCKAN(url, apiKey)
+    remote = ckan_client.connect()
 
     ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
         description='''Change parameters in an existing CKAN group.''',
         epilog='''The program uses the following environment variables for CKAN authentication credentials:
-  ED_CKAN_URL: The Internet address to use for CKAN API calls
-  ED_CKAN_KEY: The access key to use for authenticating CKAN API calls
+  CKAN_URL (or ED_CKAN_URL): The Internet address to use for CKAN API calls
+  CKAN_KEY (or ED_CKAN_KEY): The access key to use for authenticating CKAN API calls
 ''')
     ap.add_argument('-i','--id', 
         help='The identifier of the group to change.') 
@@ -1,4 +1,3 @@
-import getpass
 import logging
 import os
 import sys
@@ -6,10 +5,9 @@ import sys
 import ckanapi
 import json
 
-from collections import OrderedDict
+import ckan_client
 
-url = os.getenv('ED_CKAN_URL', None)
-apiKey = os.getenv('ED_CKAN_KEY', None)
+from collections import OrderedDict
 
 def dump_dataset(connection, id):
     
@@ -27,12 +25,7 @@ if __name__ == '__main__':
 
     errors = []
 
-    if not url:
-        url = raw_input('Enter CKAN URL:')
-    if not apiKey:
-        api_key = getpass.getpass('Enter CKAN API key:')
-
-    remote = ckanapi.RemoteCKAN(url, apiKey)
+    remote = ckan_client.connect()
 
     id = ''
     if len(sys.argv) > 1:
@@ -1,4 +1,3 @@
-import getpass
 import logging
 import os
 import sys
@@ -6,6 +5,8 @@ import sys
 import ckanapi
 import json
 
+import ckan_client
+
 
 def dump_group(connection, group_name):
     
@@ -29,15 +30,7 @@ def dump_group(connection, group_name):
     
 if __name__ == '__main__':
 
-    url = os.getenv('ED_CKAN_URL', None)
-    apiKey = os.getenv('ED_CKAN_KEY', None)
-
-    if not url:
-        url = input('Enter CKAN URL:')
-    if not apiKey:
-        api_key = getpass.getpass('Enter CKAN API key:')
-
-    remote = ckanapi.RemoteCKAN(url, apiKey)
+    remote = ckan_client.connect()
 
     id = ''
     if len(sys.argv) > 1:
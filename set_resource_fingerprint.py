@@ -4,11 +4,11 @@ for the resource. The sha512 algorithm is used, in an attempt to
 avoid collisions on large resources.
 
  The base URL for the API to use (without the trailing "/api/action" text)
- can be specified in an environment variable named 'CKAN_URL'. The value for the
+ can be specified in an environment variable named 'CKAN_URL' (or 'ED_CKAN_URL'). The value for the
  URL will be prompted for input if the environment variable is not set.
 
  The API key to use for authentication can be specified in an environment
- variable named 'CKAN_KEY'. The value for the API key will be prompted for input
+ variable named 'CKAN_KEY' (or 'ED_CKAN_KEY'). The value for the API key will be prompted for input
  if the environment variable is not set.
 
  A command line switch can be specified to force recalculation of all
@@ -16,95 +16,930 @@ avoid collisions on large resources.
 
  A command line argument can set the size of the buffer to use for
  retrieving files for hash calculation.
+
+ Command line arguments can set the number of files to retrieve
+ concurrently, and the maximum number of those that can come from
+ the same host.
+
+ A command line argument can name a cache file that records the HTTP
+ validators and hash for each retrieved URL. Later runs send conditional
+ requests and reuse the cached hash for files that have not changed.
+
+ The local CKAN storage path can be specified on the command line or in an
+ environment variable named 'CKAN_STORAGE_PATH'. Uploaded resources, and
+ file:// URLs inside that path, are then hashed from the local file instead
+ of being retrieved over HTTP.
+
+ A command line argument can request additional digests, such as sha256 or
+ md5, which are calculated in the same pass as the sha512 fingerprint and
+ stored in resource fields named 'hash_<algorithm>'.
+
+ A command line argument can switch the fingerprint to a tree hash, stored
+ in the 'hash' field as 'sha512-tree-<chunk size>-<root>'. Chunks of the
+ file are hashed in parallel, which is much faster for very large files,
+ and the chunk digests are kept in the cache file so that later runs can
+ report which byte ranges of a file changed.
+
+ Each file is read into a small ring of reused buffers by one thread while
+ another hashes them, so downloading and hashing overlap. A command line
+ argument can also split large files across parallel HTTP range requests,
+ which are hashed in order as they arrive.
+
+ Resources that share a download URL, after normalizing the scheme, host
+ and port, are hashed once while any of them is waiting to be hashed, and
+ the digests are given to each of them. The number of downloads saved is
+ reported in the run summary.
+
+ A command line switch writes the hashes for all the resources of a
+ dataset in one package_revise call, instead of one resource_patch call
+ per resource, falling back to patching each resource if the revision is
+ rejected.
+
+ A command line argument can name a state file for incremental runs. The
+ first run walks the whole catalog as usual. Later runs ask the search
+ index for just the identifiers of the datasets modified since the last
+ run, and fetch the full records of those and of datasets with resources
+ that failed, so a nightly run transfers little more than what changed.
+
+ A command line argument can name a journal file that records each
+ resource as it is processed. If a run is interrupted, running it again
+ with the resume switch skips the resources already completed.
 """
 import argparse
-import getpass
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import queue
 import requests
+import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
 import urllib3
 
+import ckan_client
 import ckanapi
+from ckan_journal import Journal
+from ckan_metrics import METRICS
+from ckan_paging import iter_datasets, latest_modified, solr_date
+from ckan_throttle import call_with_retry
+from tree_hash import TreeHash, changed_ranges, chunk_size_of, is_tree_algorithm, tree_algorithm
 
 BUFFER_SIZE = 16777216
 CONNECT_TIMEOUT = 5.0
 READ_TIMEOUT = 20.0
+WORKERS = 1
+PER_HOST = 2
+ALGORITHMS = ('sha512',)
+# Number of read buffers per download, so reading can run ahead of hashing.
+RING_SIZE = 3
+# Journal used by --resume when no journal file is named.
+JOURNAL_FILE = 'set_resource_fingerprint.journal'
+# Ports dropped from normalized URLs, as they are implied by the scheme.
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+def digest_field(algorithm):
+    """Return the resource field that stores the digest for the passed algorithm.
+       The sha512 digest is the fingerprint kept in the 'hash' field, and any
+       other digest is stored in a field named for its algorithm.
+    """
+    return 'hash' if algorithm == 'sha512' or is_tree_algorithm(algorithm) else f'hash_{algorithm}'
+
+
+def new_hash(algorithm):
+    """Return a hash object for the passed algorithm, which may be a tree hash."""
+    if is_tree_algorithm(algorithm):
+        return TreeHash(chunk_size_of(algorithm))
+    return hashlib.new(algorithm)
+
+
+def digest_algorithm(name):
+    """Return the name hashlib uses for a digest algorithm given on the command
+       line, in any case. Raises ValueError for an unknown algorithm, or for
+       one without a fixed length, such as shake_128, whose digest needs one.
+    """
+    try:
+        h = hashlib.new(name.strip().lower())
+    except ValueError:
+        raise ValueError(f'Unsupported digest algorithm {name.strip()}.')
+    if not h.digest_size:
+        raise ValueError(f'Digest algorithm {name.strip()} has no fixed length.')
+    return h.name
+
+
+def has_digest(digests, algorithm):
+    """Return True if the passed digests include one made with the passed algorithm.
+       A plain sha512 fingerprint and a tree hash fingerprint share a field,
+       so the value has to be checked as well.
+    """
+    value = digests.get(digest_field(algorithm), '')
+    return value.startswith(f'{algorithm}-') and (is_tree_algorithm(algorithm) or not is_tree_algorithm(value))
+
+
+def format_digests(hashes):
+    """Convert the passed hash objects into resource field values."""
+    return {digest_field(h.name): f'{h.name}-{h.hexdigest()}' for h in hashes}
+
+
+class ValidatorCache:
+    """Persistent record of the HTTP validators (ETag, Last-Modified and
+       Content-Length) seen for each URL, with the digests calculated from the
+       content that carried them. Entries are stored in a SQLite file so
+       they survive between runs, and access is serialized so the cache can
+       be shared by concurrent downloads.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS validators ('
+                         'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                         'content_length TEXT, digests TEXT)')
+        if 'hash' in [column[1] for column in self._db.execute('PRAGMA table_info(validators)')]:
+            # Cache files written before extra digests were supported hold only the fingerprint.
+            self._db.execute('ALTER TABLE validators RENAME COLUMN hash TO digests')
+            rows = self._db.execute('SELECT url, digests FROM validators').fetchall()
+            self._db.executemany('UPDATE validators SET digests = ? WHERE url = ?',
+                                 [(json.dumps({'hash': value} if value else {}), url) for url, value in rows])
+        self._db.execute('CREATE TABLE IF NOT EXISTS leaves (url TEXT PRIMARY KEY, chunk_size INTEGER, digests BLOB)')
+        self._db.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified, content_length, digests '
+                                   'FROM validators WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'content_length': row[2], 'digests': json.loads(row[3])}
+
+    def put(self, url, headers, digests):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?)',
+                             (url, headers.get('ETag'), headers.get('Last-Modified'),
+                              headers.get('Content-Length'), json.dumps(digests)))
+            self._db.commit()
+
+    def get_leaves(self, url):
+        """Return the chunk size and leaf digests of the last tree hash of a URL, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT chunk_size, digests FROM leaves WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], [row[1][i:i + 64] for i in range(0, len(row[1]), 64)]
+
+    def put_leaves(self, url, chunk_size, leaves):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO leaves VALUES (?, ?, ?)', (url, chunk_size, b''.join(leaves)))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def record_leaves(cache, url, hashes):
+    """Store the leaf digests of any tree hash in the cache, logging the
+       byte ranges that changed since the last tree hash of the same URL.
+    """
+    for h in hashes:
+        if not isinstance(h, TreeHash):
+            continue
+        leaves = h.leaf_digests()
+        previous = cache.get_leaves(url)
+        if previous and previous[0] == h.chunk_size:
+            for start, end in changed_ranges(previous[1], leaves, h.chunk_size):
+                logging.info(f'Bytes {start}-{end - 1} of {url} changed since the last tree hash')
+        cache.put_leaves(url, h.chunk_size, leaves)
+
+
+def conditional_headers(entry):
+    """Build the request headers that ask the server to skip sending
+       content that has not changed since the passed cache entry was stored.
+    """
+    headers = {}
+    if entry:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def validators_match(entry, headers):
+    """Return True if the response headers identify the same content as the cache entry.
+       A matching ETag is sufficient. Otherwise both Last-Modified and
+       Content-Length have to be present and match.
+    """
+    if entry['etag'] and entry['etag'] == headers.get('ETag'):
+        return True
+    return bool(entry['last_modified'] and entry['content_length']
+                and entry['last_modified'] == headers.get('Last-Modified')
+                and entry['content_length'] == headers.get('Content-Length'))
+
+
+class BufferRing:
+    """Preallocated buffers passed between the threads reading a file and the
+       thread hashing it. Readers take a free buffer, fill it with a numbered
+       segment of the file and publish it, and the hasher takes the segments
+       in order and returns each buffer once it has been hashed.
+    """
+
+    def __init__(self, buffers):
+        self.buffers = buffers
+        self._free = queue.SimpleQueue()
+        for index in range(len(buffers)):
+            self._free.put(index)
+        self._filled = {}
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def acquire(self):
+        """Wait for a free buffer and return its index, or None once the ring is closed."""
+        index = self._free.get()
+        return None if self._closed else index
+
+    def release(self, index):
+        self._free.put(index)
+
+    def publish(self, segment, entry):
+        """Hand over a segment, as a (buffer index, length) pair or the exception that stopped the read.
+           A buffer index of None marks the end of the file.
+        """
+        with self._condition:
+            self._filled[segment] = entry
+            self._condition.notify_all()
+
+    def take(self, segment):
+        with self._condition:
+            self._condition.wait_for(lambda: segment in self._filled)
+            entry = self._filled.pop(segment)
+        if isinstance(entry, Exception):
+            raise entry
+        return entry
+
+    def close(self):
+        """Stop the readers, including any waiting for a buffer."""
+        self._closed = True
+        for _ in self.buffers:
+            self._free.put(None)
+
+
+def body_stream(response):
+    """Return a file object that reads the body of a urllib3 response into a
+       buffer. The underlying http.client response fills the buffer straight
+       from the socket, while urllib3 would copy each read, but it can only
+       be used when the body is not content-encoded. It does not check the
+       length of the body, so its callers have to.
+    """
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return response
+    return getattr(response, '_fp', None) or response
+
+
+def fill(stream, view):
+    """Read from a stream until the buffer view is full or the stream ends. Returns the length read."""
+    length = 0
+    while length < len(view):
+        count = stream.readinto(view[length:])
+        if not count:
+            break
+        length += count
+    return length
+
+
+def read_segments(ring, stream, segments=None):
+    """Read a stream into the ring as consecutive segments, from the first,
+       until the stream ends or the passed number of segments has been read.
+    """
+    segment = 0
+    try:
+        while segments is None or segment < segments:
+            index = ring.acquire()
+            if index is None:
+                return
+            with memoryview(ring.buffers[index]) as view:
+                length = fill(stream, view)
+            if segments is not None and length < len(ring.buffers[index]):
+                # The segments that follow start where this one should have ended.
+                ring.release(index)
+                raise ValueError('Response ended before the expected length')
+            if length == 0:
+                ring.release(index)
+                ring.publish(segment, (None, 0))
+                return
+            ring.publish(segment, (index, length))
+            segment += 1
+    except Exception as e:
+        ring.publish(segment, e)
+
+
+def fetch_ranges(ring, http_pool, url, validator, size, segments, counter):
+    """Fetch segments of a file with HTTP range requests, taking the next
+       unclaimed segment number from the shared counter each time a buffer
+       is free. The validator is sent as If-Range, so a file that changes
+       part way through is reported as an error rather than mixed up.
+    """
+    while True:
+        index = ring.acquire()
+        if index is None:
+            return
+        segment = next(counter)
+        if segment >= segments:
+            ring.release(index)
+            return
+        try:
+            buffer_size = len(ring.buffers[index])
+            start = segment * buffer_size
+            end = min(size, start + buffer_size) - 1
+            headers = {'Range': f'bytes={start}-{end}', 'If-Range': validator}
+            with http_pool.request('GET', url, headers=headers, preload_content=False) as part:
+                if part.status != 206 or not part.headers.get('Content-Range', '').startswith(f'bytes {start}-{end}/'):
+                    raise ValueError(f'Range request for {url} returned status {part.status}')
+                with memoryview(ring.buffers[index]) as view:
+                    length = fill(body_stream(part), view[:end - start + 1])
+            if length != end - start + 1:
+                raise ValueError(f'Range response for {url} ended early')
+            ring.publish(segment, (index, length))
+        except Exception as e:
+            ring.publish(segment, e)
+            return
+
+
+def check_length(url, stream, response, size, received):
+    """Raise ValueError if a body read from the raw stream of a response
+       does not match its Content-Length, as happens when the server closes
+       the connection early. urllib3 makes the same check when it decodes
+       the body itself.
+    """
+    if stream is not response and size >= 0 and received != size:
+        raise ValueError(f'Received {received} of {size} bytes from {url}')
+
+
+def hash_response(http_pool, url, response, hashes, buffer_size, ring_size=RING_SIZE, ranges=1):
+    """Hash the body of a response, returning the number of bytes hashed.
+       With a ring of more than one buffer, a reader thread fills the
+       buffers while this thread hashes them, so the download and the
+       hashing overlap. With more than one range, and a server that supports
+       range requests for a large enough file, the rest of the file after
+       the first segment is fetched over parallel range requests. Raises
+       ValueError if the body is shorter or longer than its Content-Length.
+
+       A body that fits in one buffer is read in this thread into a buffer
+       no larger than the body. The buffers are allocated for each file and
+       freed once it is hashed, so idle download threads hold no memory.
+    """
+    size = int(response.headers.get('Content-Length') or -1)
+    stream = body_stream(response)
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    segments = -(-size // buffer_size) if size >= 0 else None
+    use_ranges = (ranges > 1 and response.status == 200 and segments is not None and segments > 2
+                  and validator and stream is not response
+                  and response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+    ring_size = max(ring_size, ranges + 1) if use_ranges else ring_size
+    one_buffer = segments is not None and segments <= 1
+
+    if ring_size < 2 or one_buffer:
+        # Nothing to overlap, so read and hash in this thread.
+        received = 0
+        with memoryview(bytearray(size if one_buffer else buffer_size)) as view:
+            while (length := fill(stream, view)):
+                with view[:length] as chunk:
+                    for h in hashes:
+                        h.update(chunk)
+                received += length
+        check_length(url, stream, response, size, received)
+        return received
 
-def get_hash(http_pool, buffer_size, url):
+    ring = BufferRing([bytearray(buffer_size) for _ in range(ring_size)])
+    if use_ranges:
+        # The open response supplies the first segment, and is then closed.
+        counter = itertools.count(1)
+        readers = [threading.Thread(target=read_segments, args=(ring, stream, 1), daemon=True)]
+        readers += [threading.Thread(target=fetch_ranges, args=(ring, http_pool, url, validator, size, segments, counter),
+                                     daemon=True) for _ in range(ranges - 1)]
+    else:
+        readers = [threading.Thread(target=read_segments, args=(ring, stream), daemon=True)]
+    for reader in readers:
+        reader.start()
+    received = 0
     try:
-        # Initialize the hash object.
-        hash = hashlib.sha512()
+        for segment in itertools.count() if not use_ranges else range(segments):
+            index, length = ring.take(segment)
+            if index is None:
+                break
+            with memoryview(ring.buffers[index]) as view, view[:length] as chunk:
+                for h in hashes:
+                    h.update(chunk)
+            ring.release(index)
+            received += length
+    finally:
+        ring.close()
+    for reader in readers:
+        reader.join()
+    check_length(url, stream, response, size, received)
+    return received
+
+
+def get_hash(http_pool, buffer_size, url, cache=None, algorithms=ALGORITHMS, ring_size=RING_SIZE, ranges=1):
+    """Retrieve the file at the passed URL and return its digests for the
+       passed algorithms, keyed by the resource field that stores each one.
+    """
+    try:
+        entry = cache.get(url) if cache else None
+        if entry and not all(has_digest(entry['digests'], a) for a in algorithms):
+            # The cached entry lacks a requested digest, so the content has to be read again.
+            entry = None
+        # Initialize the hash objects.
+        hashes = [new_hash(a) for a in algorithms]
+        start = time.perf_counter()
         # Retrieve the file at the passed URL as a stream, 
         # in case it is larger than will fit in memory.
-        with http_pool.request('GET',url,preload_content=False) as response:
-            # Read the stream, updating the hash object for each chunk received.
-            for buff in response.stream(buffer_size):
-                if buff:
-                    hash.update(buff)
-        return f'sha512-{hash.hexdigest()}'
+        with http_pool.request('GET',url,headers=conditional_headers(entry),preload_content=False) as response:
+            if entry and (response.status == 304 or (response.status == 200 and validators_match(entry, response.headers))):
+                # The content is unchanged since it was last hashed, so skip reading it.
+                logging.info(f'Reusing cached hash for unchanged {url}')
+                return entry['digests']
+            received = hash_response(http_pool, url, response, hashes, buffer_size, ring_size, ranges)
+        METRICS.record_download(received, time.perf_counter() - start)
+        digests = format_digests(hashes)
+        if cache and response.status == 200:
+            cache.put(url, response.headers, digests)
+            record_leaves(cache, url, hashes)
+        return digests
     except Exception as e:
         logging.error(e)
         return None
 
 
-def set_resource_fingerprints(connection, force_update, buffer_size, http_pool, pkg_id):
-    """Retrieve the metadata for all datasets in the connected CKAN repository.
-       Update the resource entries for each to contain the fingerprint for
-       the referenced data file.
+def get_local_path(resource, storage_path):
+    """Return the local file holding the data for the passed resource, or None
+       if the data has to be retrieved over HTTP. Uploaded resources are found
+       in the CKAN filestore layout under the storage path, and file:// URLs
+       are only honored if they point inside the storage path.
+    """
+    if not storage_path:
+        return None
+    root = os.path.realpath(storage_path)
+    if resource.get('url_type') == 'upload':
+        res_id = resource['id']
+        path = os.path.join(root, 'resources', res_id[0:3], res_id[3:6], res_id[6:])
+    else:
+        parts = urllib.parse.urlsplit(resource['url'])
+        if parts.scheme != 'file':
+            return None
+        path = os.path.realpath(urllib.request.url2pathname(parts.path))
+        if os.path.commonpath([root, path]) != root:
+            logging.warning(f'Ignoring {resource["url"]} outside the storage path')
+            return None
+    return path if os.path.isfile(path) else None
+
+
+def get_local_hash(buffer_size, path, algorithms=ALGORITHMS):
+    """Calculate the digests for a local file in a single pass. The file is
+       memory-mapped so chunks are hashed without being copied. Files that
+       cannot be mapped, such as empty files, are read into one reused buffer.
+    """
+    try:
+        hashes = [new_hash(a) for a in algorithms]
+        with open(path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                mapped = None
+            if mapped is not None:
+                # Tree hashes hash each slice's chunks in parallel, so give them
+                # enough chunks at a time to keep every core busy.
+                step = max([buffer_size] + [h.chunk_size * (os.cpu_count() or 1)
+                                            for h in hashes if isinstance(h, TreeHash)])
+                with mapped, memoryview(mapped) as view:
+                    for offset in range(0, len(view), step):
+                        with view[offset:offset + step] as chunk:
+                            for h in hashes:
+                                h.update(chunk)
+            else:
+                buff = bytearray(buffer_size)
+                with memoryview(buff) as view:
+                    while (size := f.readinto(buff)):
+                        for h in hashes:
+                            h.update(view[:size])
+        return format_digests(hashes)
+    except Exception as e:
+        logging.error(e)
+        return None
+
+
+def get_resource_hash(http_pool, buffer_size, resource, cache=None, algorithms=ALGORITHMS, storage_path=None,
+                      ring_size=RING_SIZE, ranges=1):
+    """Calculate the digests for a resource, reading the local filestore copy if there is one."""
+    path = get_local_path(resource, storage_path)
+    if path:
+        logging.info(f'Calulating hash for {resource["url"]} from {path}')
+        return get_local_hash(buffer_size, path, algorithms)
+    logging.info(f'Calulating hash for {resource["url"]}')
+    return get_hash(http_pool, buffer_size, resource['url'], cache, algorithms, ring_size, ranges)
+
+
+def iter_dataset_resources(connection, force_update, pkg_id):
+    """Yield the identifier of each dataset in the connected CKAN repository
+       with a list of its resource records that need a fingerprint. When a
+       package identifier is passed, only the resources for that package are
+       yielded, whether or not they already have a hash.
+    """
+    if pkg_id:
+        # Retrieve only the package specified in the pass ID, and yield its resources.
+        pkg_result = connection.call_action(action='package_show', data_dict={'id': pkg_id})
+        logging.info(pkg_result)
+        if pkg_result.get('type','') == 'dataset':
+            yield pkg_result['id'], [r for r in pkg_result.get('resources', []) if 'url' in r]
+        return
+
+    # Iterate over the datasets in the catalog.
+    for dataset in iter_datasets(connection, action='current_package_list_with_resources'):
+        if ('type' in dataset and dataset['type'] == 'dataset'):
+            yield dataset['id'], resources_to_hash(dataset, force_update)
+
+
+def resources_to_hash(dataset, force_update):
+    """Return the resources of a dataset that have a URL and, unless
+       forced, do not already have a hash.
+    """
+    resources = []
+    for resource in dataset.get('resources', []):
+        if 'url' in resource:
+            if (not force_update and ('hash' in resource) and (len(resource['hash']) > 0)):
+                logging.info(f'Resource {resource["url"]} already has hash {resource["hash"]}')
+                continue
+            resources.append(resource)
+    return resources
+
+
+class TargetState:
+    """State kept between targeted runs, in a small JSON file. It holds the
+       newest modification time in the catalog when the last completed run
+       started, and the datasets with resources that run could not
+       fingerprint. The next run fetches only those datasets and the ones
+       modified since.
+
+       Outcomes recorded for the resources of a run are passed on to the
+       journal, if there is one.
+    """
+
+    def __init__(self, path, journal=None):
+        self.path = path
+        self.journal = journal
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        self.modified = state.get('modified')
+        self.retry = state.get('retry', [])
+        # Datasets of the resources being worked on, and those with failures in this run.
+        self._datasets = {}
+        self.failed = set()
+
+    def track(self, dataset_resources):
+        """Yield the passed (dataset identifier, resources) pairs, noting the dataset of each resource."""
+        for dataset_id, resources in dataset_resources:
+            for resource in resources:
+                self._datasets[resource['id']] = dataset_id
+            yield dataset_id, resources
+
+    def record(self, key, outcome):
+        dataset_id = self._datasets.pop(key, None)
+        if outcome == 'failed' and dataset_id:
+            self.failed.add(dataset_id)
+        if self.journal:
+            self.journal.record(key, outcome)
+
+    def save(self, modified):
+        """Write the state for the next run, replacing the file in one step."""
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'modified': modified, 'retry': sorted(self.failed)}, f)
+        os.replace(temp, self.path)
+
+
+def iter_targeted_resources(connection, force_update, targets):
+    """Yield the identifier and resources needing a fingerprint for just the
+       datasets with resources modified since the last targeted run, or that
+       failed in it. A field-limited package_search returns only the
+       identifiers of the modified datasets, and the full record is fetched
+       for each of those alone. Datasets whose records cannot be fetched
+       are left for the next run to retry.
+
+       The fingerprints written by a run modify their datasets, so the next
+       run checks those datasets once more, finding nothing to download.
+    """
+    query = {'fq': f'+metadata_modified:[{solr_date(targets.modified)} TO *] +num_resources:[1 TO *]',
+             'fl': 'id', 'include_private': True}
+    modified = (d['id'] for d in iter_datasets(connection, data_dict=query))
+    seen = set()
+    for dataset_id in itertools.chain(modified, targets.retry):
+        if dataset_id in seen:
+            continue
+        seen.add(dataset_id)
+        try:
+            dataset = call_with_retry(connection, 'package_show', {'id': dataset_id})
+        except ckanapi.errors.NotFound:
+            logging.info(f'Dataset {dataset_id} no longer exists')
+            continue
+        except Exception as e:
+            logging.error(e)
+            targets.failed.add(dataset_id)
+            continue
+        if dataset.get('type') == 'dataset':
+            yield dataset_id, resources_to_hash(dataset, force_update)
+
+
+def has_digests(resource, digests):
+    """Return True if the passed resource already records the passed digests."""
+    return all(resource.get(field) == value for field, value in digests.items())
+
+
+def patch_resource_hash(connection, resource, digests):
+    """Record the passed digests in the fields of the passed resource,
+       unless the resource already has those values. Returns the outcome
+       to record in the journal.
     """
+    if has_digests(resource, digests):
+        logging.info(f'Resource {resource["id"]} already has hash {digests["hash"]}')
+        return 'unchanged'
     try:
-        if pkg_id:
-            # Retrieve only the package specified in the pass ID, and update its resources.
-            pkg_result = connection.call_action(action='package_show', data_dict={'id': pkg_id})
-            logging.info(pkg_result)
-            if pkg_result.get('type','') == 'dataset':
-                    if 'resources' in pkg_result:
-                        for resource in pkg_result['resources']:
-                            if 'url' in resource:
-                                logging.info(f'Calulating hash for {resource["url"]}')
-                                res_hash = get_hash(http_pool=http_pool, buffer_size=buffer_size, url=resource['url'])
-                                if res_hash:
-                                    try:
-                                        patch_data_dict = {"id":resource['id'], "hash": res_hash}
-                                        logging.info(f'Patching {resource["id"]} with hash {res_hash}')
-                                        patch_result = connection.call_action(action='resource_patch', data_dict=patch_data_dict)
-                                    except Exception as e:
-                                        logging.error(e)
-                                        continue
+        patch_data_dict = {"id":resource['id'], **digests}
+        logging.info(f'Patching {resource["id"]} with hash {digests["hash"]}')
+        connection.call_action(action='resource_patch', data_dict=patch_data_dict)
+        return 'done'
+    except Exception as e:
+        logging.error(e)
+        return 'failed'
+
+
+def finish_resource(connection, resource, digests, journal=None):
+    """Patch the digests calculated for a resource, if there are any, and
+       record the outcome in the journal.
+    """
+    outcome = patch_resource_hash(connection, resource, digests) if digests else 'failed'
+    if journal:
+        journal.record(resource['id'], outcome)
+
+
+class DatasetWriter:
+    """Collects the digests calculated for the resources of each dataset
+       and writes them all in a single package_revise call once the last
+       resource of the dataset is finished. Each resource write makes CKAN
+       reindex the whole dataset, so this saves a write and a reindex for
+       every other resource in the dataset. If the revision is rejected,
+       for instance by a CKAN version without package_revise, the resources
+       are patched one at a time instead.
+    """
+
+    def __init__(self, connection, journal=None):
+        self._connection = connection
+        self._journal = journal
+        # Dataset identifier for each resource being hashed.
+        self._datasets = {}
+        # Resources of each dataset still being hashed.
+        self._outstanding = {}
+        # Resources of each dataset with their calculated digests.
+        self._finished = collections.defaultdict(list)
+
+    def track(self, dataset_resources):
+        """Yield the resources of the passed (dataset identifier, resources)
+           pairs, noting the resources of each dataset before any is yielded.
+        """
+        for dataset_id, resources in dataset_resources:
+            if not resources:
+                continue
+            self._outstanding[dataset_id] = len(resources)
+            for resource in resources:
+                self._datasets[resource['id']] = dataset_id
+            yield from resources
+
+    def finish(self, resource, digests):
+        """Note the digests calculated for a resource, writing the dataset
+           once they are known for all of its resources.
+        """
+        dataset_id = self._datasets.pop(resource['id'], None)
+        if dataset_id is None:
+            finish_resource(self._connection, resource, digests, self._journal)
             return
+        self._finished[dataset_id].append((resource, digests))
+        self._outstanding[dataset_id] -= 1
+        if not self._outstanding[dataset_id]:
+            del self._outstanding[dataset_id]
+            self.write(dataset_id, self._finished.pop(dataset_id))
+
+    def write(self, dataset_id, finished):
+        changes = {f'update__resources__{resource["id"]}': digests
+                   for resource, digests in finished if digests and not has_digests(resource, digests)}
+        if changes:
+            try:
+                logging.info(f'Revising dataset {dataset_id} with hashes for {len(changes)} resources')
+                self._connection.call_action(action='package_revise',
+                                             data_dict={'match': {'id': dataset_id}, **changes})
+            except Exception as e:
+                logging.warning(f'Patching the resources of dataset {dataset_id} one at a time '
+                                f'after package_revise failed: {e}')
+                for resource, digests in finished:
+                    finish_resource(self._connection, resource, digests, self._journal)
+                return
+        for resource, digests in finished:
+            if not digests:
+                outcome = 'failed'
+            elif f'update__resources__{resource["id"]}' in changes:
+                outcome = 'done'
+            else:
+                logging.info(f'Resource {resource["id"]} already has hash {digests["hash"]}')
+                outcome = 'unchanged'
+            if self._journal:
+                self._journal.record(resource['id'], outcome)
 
-        offset = 0
-        increment = 1000
-        while (True):
-            pass_data_dict = { 'limit': increment, 'offset': offset }
-            pass_result = connection.call_action(action='current_package_list_with_resources', data_dict=pass_data_dict)
-            if len(pass_result) == 0: break
-            offset += increment
-            # Iterate over the retrieved datasets.
-            for dataset in pass_result:
-                if ('type' in dataset and dataset['type'] == 'dataset'):
-                    if 'resources' in dataset:
-                        for resource in dataset['resources']:
-                            if 'url' in resource:
-                                if (not force_update and ('hash' in resource) and (len(resource['hash']) > 0)):
-                                    logging.info(f'Resource {resource["url"]} already has hash {resource["hash"]}')
-                                    continue
-                                logging.info(f'Calulating hash for {resource["url"]}')
-                                res_hash = get_hash(http_pool=http_pool, buffer_size=buffer_size, url=resource['url'])
-                                if res_hash:
-                                    try:
-                                        patch_data_dict = {"id":resource['id'], "hash": res_hash}
-                                        logging.info(f'Patching {resource["id"]} with hash {res_hash}')
-                                        patch_result = connection.call_action(action='resource_patch', data_dict=patch_data_dict)
-                                    except Exception as e:
-                                        logging.error(e)
-                                        continue
+    def close(self):
+        """Write any datasets with resources that were never finished."""
+        for dataset_id in list(self._finished):
+            self.write(dataset_id, self._finished.pop(dataset_id))
+        self._outstanding.clear()
+        self._datasets.clear()
+
+
+def get_host(url):
+    """Return the origin host for a URL, used to cap concurrent downloads per server."""
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def normalize_url(url):
+    """Return the form of a URL used to recognize resources that share a
+       data file. The scheme and host are lowercased, a default port and a
+       fragment are dropped, and an empty path becomes '/'. The path and
+       query are left alone, as servers may treat their case as significant.
+    """
+    try:
+        parts = urllib.parse.urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = parts.hostname or ''
+        if ':' in host:
+            host = f'[{host}]'
+        if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+            host = f'{host}:{parts.port}'
+        if parts.username is not None:
+            host = parts.netloc.rpartition('@')[0] + '@' + host
+    except ValueError:
+        return url
+    return urllib.parse.urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+def share_digests(finish, resource, key, digests):
+    """Finish a resource with the digests calculated for another resource
+       with the same data file. If that hash failed, the resource fails with
+       it, and is not counted as a download saved.
+    """
+    if digests:
+        logging.info(f'Reusing the hash of {key} for resource {resource["id"]}')
+        METRICS.record_download_saved()
+    finish(resource, digests)
+
+
+def hash_concurrently(finish, hash_resource, resources, workers, per_host):
+    """Calculate hashes for the passed resources using a pool of worker threads.
+       At most 'workers' downloads are in flight at once, and at most 'per_host'
+       of those are from the same origin host. Resources waiting on a busy host
+       are held back rather than occupying a worker, so other hosts keep the
+       pool busy. Each resource is passed to 'finish' with its digests as
+       its download completes.
+
+       Each normalized URL is hashed once while resources that share it are
+       waiting. Resources read from the catalog while their URL is waiting
+       or in flight join the resources waiting on its result, and all of
+       them are finished together. The digests are not kept after that, so
+       memory stays bounded by the read-ahead.
+    """
+    # Normalized URLs waiting for a free slot on their host, keyed by host.
+    pending = collections.defaultdict(collections.deque)
+    # Resources waiting on the result for each normalized URL, queued or in flight.
+    sharing = {}
+    # Resources read from the catalog and not yet finished.
+    held = 0
+    # Number of downloads in flight for each host.
+    active = collections.Counter()
+    # Bound how far ahead of the downloads the catalog is read.
+    backlog = workers * 4
+    resources = iter(resources)
+    exhausted = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        while True:
+            # Read ahead in the catalog until the backlog is full.
+            while not exhausted and held < backlog:
+                try:
+                    resource = next(resources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                key = normalize_url(resource['url'])
+                held += 1
+                if key in sharing:
+                    sharing[key].append(resource)
+                else:
+                    sharing[key] = [resource]
+                    pending[get_host(resource['url'])].append(key)
+            # Start downloads for every host that has a free slot.
+            for host in list(pending):
+                queue = pending[host]
+                while queue and active[host] < per_host and len(in_flight) < workers:
+                    key = queue.popleft()
+                    active[host] += 1
+                    future = executor.submit(hash_resource, sharing[key][0])
+                    in_flight[future] = (host, key)
+                if not queue:
+                    del pending[host]
+            if not in_flight:
+                if exhausted and held == 0:
+                    break
+                continue
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                host, key = in_flight.pop(future)
+                active[host] -= 1
+                digests = future.result()
+                first, *others = sharing.pop(key)
+                held -= 1 + len(others)
+                finish(first, digests)
+                for resource in others:
+                    share_digests(finish, resource, key, digests)
+
+
+def set_resource_fingerprints(connection, force_update, buffer_size, http_pool, pkg_id, workers=1, per_host=1, cache=None,
+                              algorithms=ALGORITHMS, storage_path=None, journal=None, ring_size=RING_SIZE, ranges=1,
+                              batch=False, targets=None):
+    """Retrieve the metadata for all datasets in the connected CKAN repository.
+       Update the resource entries for each to contain the fingerprint for
+       the referenced data file. Resources that the journal shows as
+       completed by an earlier run are skipped. A data file referenced by
+       several resources waiting together is only hashed once. With 'batch', the hashes for
+       each dataset are written in one call rather than one per resource.
+
+       When a target state is passed and it records an earlier run, only the
+       datasets modified since that run, or with resources that failed in
+       it, are fetched. The state is updated once the run completes.
+    """
+    hash_resource = functools.partial(get_resource_hash, http_pool, buffer_size, cache=cache,
+                                      algorithms=algorithms, storage_path=storage_path,
+                                      ring_size=ring_size, ranges=ranges)
+    record = journal
+    if targets:
+        # Changes made during the run are found by the next one, so take the mark before the walk.
+        latest = latest_modified(connection)
+        targets.journal = journal
+        record = targets
+    writer = DatasetWriter(connection, record) if batch else None
+    finish = writer.finish if writer else functools.partial(finish_resource, connection, journal=record)
+    try:
+        if targets and targets.modified and not pkg_id:
+            logging.info(f'Fetching datasets modified since {targets.modified} and {len(targets.retry)} to retry')
+            dataset_resources = iter_targeted_resources(connection, force_update, targets)
+        else:
+            dataset_resources = iter_dataset_resources(connection, force_update, pkg_id)
+        if journal:
+            dataset_resources = ((d, [r for r in resources if not journal.completed(r['id'])])
+                                 for d, resources in dataset_resources)
+        if targets:
+            dataset_resources = targets.track(dataset_resources)
+        if writer:
+            resources = writer.track(dataset_resources)
+        else:
+            resources = itertools.chain.from_iterable(resources for _, resources in dataset_resources)
+        if workers > 1:
+            hash_concurrently(finish, hash_resource, resources, workers, per_host)
+        else:
+            # Only the last hash is kept, for resources listed together that share a data file.
+            last_key = last_digests = None
+            for resource in resources:
+                key = normalize_url(resource['url'])
+                if key == last_key:
+                    share_digests(finish, resource, key, last_digests)
+                else:
+                    last_digests = hash_resource(resource)
+                    last_key = key if last_digests else None
+                    finish(resource, last_digests)
 
     except Exception as e:
         logging.error(e)
+        return
+    finally:
+        if writer:
+            writer.close()
+    if targets and latest:
+        targets.save(latest)
     
     
 if __name__ == '__main__':
@@ -122,6 +957,7 @@ if __name__ == '__main__':
         epilog='''The program uses the following environment variables:
   CKAN_URL: The base URL for the API to use (without the trailing "/api/action" text).
   CKAN_KEY: The API key for authentication.
+  CKAN_STORAGE_PATH: The local CKAN storage path (optional).
  ''')
 
     ap.add_argument('-f','--force', help='Force calculation of a hash for every resource that has a URL for a data file.', action="store_true") 
@@ -129,19 +965,58 @@ if __name__ == '__main__':
     ap.add_argument('-c','--connect', type=float, help='Connection timeout for file retrieval requests.', default=CONNECT_TIMEOUT)
     ap.add_argument('-r','--read', type=float, help='Read timeout for file retrieval requests.', default=READ_TIMEOUT) 
     ap.add_argument('-p','--package', type=str, help='Identifier for a single data profile to update', default=None)
+    ap.add_argument('-w','--workers', type=int, help='Number of data files to retrieve concurrently.', default=WORKERS)
+    ap.add_argument('--per-host', type=int, help='Maximum number of concurrent retrievals from the same host.', default=PER_HOST)
+    ap.add_argument('--cache', type=str, help='File for caching validators and hashes of retrieved data files between runs.', default=None)
+    ap.add_argument('-s','--storage', type=str, help='Local CKAN storage path for reading uploaded data files directly.', default=os.getenv('CKAN_STORAGE_PATH', None))
+    ap.add_argument('-t','--tree', type=int, help='Store a sha512 tree hash with chunks of this many bytes, hashed in parallel, instead of a plain sha512 fingerprint.', default=0)
+    ap.add_argument('--ring', type=int, help='Number of buffers per download. With more than one, reading runs ahead of hashing in a separate thread.', default=RING_SIZE)
+    ap.add_argument('--ranges', type=int, help='Number of parallel range requests used to retrieve each large data file.', default=1)
+    ap.add_argument('--batch', help='Write the hashes for all resources of a dataset in one package_revise call, patching resources one at a time if it is rejected.', action='store_true')
+    ap.add_argument('-i','--incremental', type=str, help='File recording the state of the last run, so that only datasets modified since, or with resources that failed, are fetched.', default=None)
+    ap.add_argument('-j','--journal', type=str, help='File recording the resources processed, so an interrupted run can be resumed.', default=None)
+    ap.add_argument('--resume', help='Skip the resources that the journal shows were completed by an earlier run.', action='store_true')
+    ap.add_argument('-d','--digests', type=str, help='Comma-separated list of additional digest algorithms to store, such as sha256,md5.', default='')
     args = ap.parse_args()
-    # Retrieve the URL and API Key from environment variables, if set.
-    url = os.getenv('CKAN_URL', None)
-    api_key = os.getenv('CKAN_KEY', None)
+    if args.workers < 1 or args.per_host < 1 or args.ring < 1 or args.ranges < 1:
+        ap.error('--workers, --per-host, --ring and --ranges must be at least 1.')
+    try:
+        extra = [digest_algorithm(a) for a in args.digests.split(',') if a.strip()]
+    except ValueError as e:
+        ap.error(str(e))
+    algorithms = ALGORITHMS + tuple(dict.fromkeys(a for a in extra if a not in ALGORITHMS))
+    if args.incremental and args.package:
+        ap.error('--incremental cannot be combined with --package.')
+    if args.tree < 0:
+        ap.error('--tree must be a positive chunk size.')
+    if args.tree:
+        algorithms = (tree_algorithm(args.tree),) + algorithms[1:]
+    # Connect using the URL and API key from the environment, prompting for any that are missing.
+    remote = ckan_client.connect(pool_size=2)
 
-    # Prompt for the API connection details if missing.
-    if not url:
-        url = input('Enter CKAN URL:')
-    if not api_key:
-        api_key = getpass.getpass('Enter CKAN API key:')
+    # Keep one connection pool per host, sized to the per-host cap and the
+    # range requests per file, so concurrent retrievals from the same host
+    # reuse their connections.
+    http=urllib3.PoolManager(num_pools=max(10, args.workers), maxsize=args.per_host * args.ranges,
+                             timeout=urllib3.Timeout(connect=args.connect, read=args.read))
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+    cache = ValidatorCache(args.cache) if args.cache else None
 
-    http=urllib3.PoolManager(timeout=urllib3.Timeout(connect=args.connect, read=args.read))
+    journal = None
+    if args.journal or args.resume:
+        try:
+            journal = Journal(args.journal or JOURNAL_FILE,
+                              {'force': args.force, 'package': args.package, 'algorithms': list(algorithms)},
+                              resume=args.resume)
+        except ValueError as e:
+            ap.error(str(e))
 
-    set_resource_fingerprints(connection=remote, force_update=args.force, buffer_size=args.buffer, http_pool=http, pkg_id=args.package)
+    set_resource_fingerprints(connection=remote, force_update=args.force, buffer_size=args.buffer, http_pool=http, pkg_id=args.package,
+                              workers=args.workers, per_host=args.per_host, cache=cache,
+                              algorithms=algorithms, storage_path=args.storage, journal=journal,
+                              ring_size=args.ring, ranges=args.ranges, batch=args.batch,
+                              targets=TargetState(args.incremental) if args.incremental else None)
+    if cache:
+        cache.close()
+    if journal:
+        journal.close()
@@ -0,0 +1,71 @@
+"""Tests of the incremental decoder in ckan_stream, run with pytest or as a script.
+
+ Each response is decoded from blocks split at every byte offset, so that
+ numbers, strings, literals and multi-byte characters are all cut at some
+ point, and the result is compared with that of json.loads.
+"""
+import json
+
+import pytest
+
+from ckan_stream import iter_json_array
+
+RESPONSES = [
+    b'{"success": true, "result": [1.5, 2]}',
+    b'{"success": true, "result": [10, -2.25e+3, 0.5E-2, 1e3, 123456789, -0, 7]}',
+    b'{"help": "x", "result": {"count": 12, "results": [{"n": 1.25}, {"n": -30}]}, "success": true}',
+    b'{"success": true, "result": [true, false, null, "\\u00e9t\\u00e9", "caf\xc3\xa9 \xe2\x82\xac", [1, [2.0]], {}]}',
+    b'{"success": true, "result": []}',
+    b'{"success": false, "error": {"message": "Not found", "__type": "Not Found Error"}}',
+]
+PATHS = {2: ('result', 'results')}
+
+
+def decode(blocks, path):
+    members = {}
+    items = list(iter_json_array(blocks, path, members))
+    return items, members
+
+
+def expected(response, path):
+    data = json.loads(response)
+    members = dict(data)
+    value = data
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    if isinstance(value, list):
+        members.pop(path[0], None)
+        return value, members
+    return [], members
+
+
+@pytest.mark.parametrize('index', range(len(RESPONSES)))
+def test_split_at_every_offset(index):
+    response = RESPONSES[index]
+    path = PATHS.get(index, ('result',))
+    items, members = expected(response, path)
+    for offset in range(len(response) + 1):
+        blocks = [response[:offset], response[offset:]]
+        assert decode(blocks, path) == (items, members), f'split at byte {offset}'
+
+
+@pytest.mark.parametrize('index', range(len(RESPONSES)))
+def test_one_byte_blocks(index):
+    response = RESPONSES[index]
+    path = PATHS.get(index, ('result',))
+    blocks = [response[i:i + 1] for i in range(len(response))]
+    assert decode(blocks, path) == expected(response, path)
+
+
+def test_number_at_end_of_stream():
+    assert decode([b'{"result": [1', b'2]}'], ('result',))[0] == [12]
+    with pytest.raises(ValueError):
+        decode([b'{"result": [1.'], ('result',))
+
+
+if __name__ == '__main__':
+    for index in range(len(RESPONSES)):
+        test_split_at_every_offset(index)
+        test_one_byte_blocks(index)
+    test_number_at_end_of_stream()
+    print('ok')
@@ -0,0 +1,36 @@
+-- Fixture data for checking the '--db' reports of list_user_roles.py and
+-- list_user_accounts.py against a local Postgres database. Only the
+-- columns the reports read are created. test_db_reports.py loads it and
+-- compares the reports with those made through the API:
+--   createdb ckan_fixture
+--   CKAN_FIXTURE_DB=dbname=ckan_fixture python -m pytest test_db_reports.py
+DROP TABLE IF EXISTS "user", "group", member;
+CREATE TABLE "user" (id TEXT PRIMARY KEY, name TEXT, fullname TEXT, email TEXT,
+                     sysadmin BOOLEAN, state TEXT, created TIMESTAMP);
+CREATE TABLE "group" (id TEXT PRIMARY KEY, name TEXT, is_organization BOOLEAN, state TEXT);
+CREATE TABLE member (id TEXT PRIMARY KEY, table_id TEXT, table_name TEXT, group_id TEXT,
+                     capacity TEXT, state TEXT);
+
+INSERT INTO "user" VALUES
+    ('u0', 'default', NULL, NULL, TRUE, 'active', '2020-01-01 00:00:00'),
+    ('u1', 'admin1', 'Site Admin', 'admin1@example.com', TRUE, 'active', '2020-01-02 09:30:00.250000'),
+    ('u2', 'editor1', 'Editor One', 'editor1@example.com', FALSE, 'active', '2020-02-01 10:00:00'),
+    ('u3', 'member1', '', 'member1@example.com', FALSE, 'active', '2020-03-01 11:00:00.000001'),
+    ('u4', 'public1', NULL, 'public1@example.com', FALSE, 'pending', '2020-04-01 12:00:00'),
+    ('u5', 'gone1', 'Deleted User', 'gone1@example.com', FALSE, 'deleted', '2020-05-01 13:00:00'),
+    ('u6', 'blank1', '   ', 'blank1@example.com', FALSE, 'active', '2020-06-01 14:00:00');
+
+INSERT INTO "group" VALUES
+    ('o1', 'org-one', TRUE, 'active'),
+    ('o2', 'org-two', TRUE, 'active'),
+    ('o3', 'org-old', TRUE, 'deleted'),
+    ('g1', 'group-one', FALSE, 'active');
+
+INSERT INTO member VALUES
+    ('m1', 'u2', 'user', 'o1', 'member', 'active'),
+    ('m2', 'u2', 'user', 'o2', 'editor', 'active'),
+    ('m3', 'u3', 'user', 'o1', 'member', 'active'),
+    ('m4', 'u3', 'user', 'o3', 'admin', 'active'),
+    ('m5', 'u4', 'user', 'g1', 'admin', 'active'),
+    ('m6', 'u4', 'user', 'o2', 'admin', 'deleted'),
+    ('m7', 'u6', 'user', 'o2', 'admin', 'active');
@@ -0,0 +1,106 @@
+"""Checks that the '--db' reports match those made through the API, run
+ with pytest or as a script.
+
+ The data in test_db_fixture.sql is loaded into the Postgres database
+ named by a connection string in the 'CKAN_FIXTURE_DB' environment
+ variable, replacing any tables of the same names there. The same users,
+ organizations and memberships are then served by the fake CKAN server
+ in benchmarks/fake_ckan.py, keeping only what CKAN's own actions return,
+ and each report is run both ways and compared with the expected output.
+ The tests are skipped unless psycopg is installed and the variable set.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+import fake_ckan
+
+DSN = os.getenv('CKAN_FIXTURE_DB')
+SITE_ID = 'default'
+
+ROLES = '''account_id,account_name,role,creation_date
+u1,Site Admin,admin,2020-01-02T09:30:00.250000
+u2,Editor One,editor,2020-02-01T10:00:00
+u3,member1,member,2020-03-01T11:00:00.000001
+u4,public1,public,2020-04-01T12:00:00
+u6,blank1,admin,2020-06-01T14:00:00
+'''
+ACCOUNTS = '''User ID,role,account created date
+admin1@example.com,admin,2020-01-02T09:30:00.250000
+editor1@example.com,user,2020-02-01T10:00:00
+member1@example.com,user,2020-03-01T11:00:00.000001
+public1@example.com,user,2020-04-01T12:00:00
+blank1@example.com,user,2020-06-01T14:00:00
+'''
+
+
+def load_fixture(dsn):
+    """Load the fixture into the database and return its tables as lists of rows."""
+    psycopg = pytest.importorskip('psycopg')
+    with open(os.path.join(REPO, 'test_db_fixture.sql')) as f:
+        sql = f.read()
+    with psycopg.connect(dsn) as connection:
+        connection.execute(sql)
+        return {table: connection.execute(f'SELECT * FROM "{table}" ORDER BY id').fetchall()
+                for table in ('user', 'group', 'member')}
+
+
+def fixture_catalog(tables):
+    """Return a fake catalog holding what CKAN's actions would return for the tables.
+       user_list leaves out deleted users and the site user, organization_list
+       and group_list deleted groups, and member_list inactive memberships.
+    """
+    catalog = fake_ckan.Catalog(datasets=0, organizations=0, users=0)
+    catalog.groups.clear()
+    for user_id, name, fullname, email, sysadmin, state, created in tables['user']:
+        if state != 'deleted' and name != SITE_ID:
+            user = {'id': user_id, 'name': name, 'fullname': fullname, 'email': email,
+                    'sysadmin': sysadmin, 'state': state, 'created': created.isoformat()}
+            user['display_name'] = fake_ckan.display_name(user)
+            catalog.users[user_id] = user
+            catalog.user_names[name] = user_id
+    for group_id, name, is_organization, state in tables['group']:
+        if state == 'active':
+            table = catalog.organizations if is_organization else catalog.groups
+            table[group_id] = {'id': group_id, 'name': name, 'title': name, 'is_organization': is_organization,
+                               'type': 'organization' if is_organization else 'group', 'state': state}
+    for _, user_id, table_name, group_id, capacity, state in tables['member']:
+        if table_name == 'user' and state == 'active':
+            catalog.members[group_id][user_id] = capacity
+    return catalog
+
+
+@pytest.fixture(scope='module')
+def server():
+    if not DSN:
+        pytest.skip('CKAN_FIXTURE_DB is not set')
+    server = fake_ckan.FakeCKANServer(fixture_catalog(load_fixture(DSN)))
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_report(script, env, *args):
+    process = subprocess.run([sys.executable, script, *args], cwd=REPO, env=env,
+                             capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    return process.stdout
+
+
+@pytest.mark.parametrize('script, expected', [('list_user_roles.py', ROLES),
+                                              ('list_user_accounts.py', ACCOUNTS)])
+def test_db_matches_api(server, script, expected):
+    env = dict(os.environ, CKAN_URL=server.url, CKAN_KEY='fixture', CKAN_METRICS='off')
+    for variable in ('ED_CKAN_URL', 'ED_CKAN_KEY', 'CKAN_CACHE', 'CKAN_MIRROR', 'CKAN_SITE_ID'):
+        env.pop(variable, None)
+    assert run_report(script, env) == expected
+    assert run_report(script, env, '--db', DSN) == expected
+
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__]))
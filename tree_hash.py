@@ -0,0 +1,139 @@
+"""Parallel Merkle tree hash for fingerprinting very large files.
+
+ A sha512 digest has to be calculated in one sequential pass, so a single
+ large file keeps one core busy for as long as it takes to hash. A tree
+ hash splits the file into fixed-size chunks, hashes the chunks on
+ several cores at once, and combines the chunk (leaf) digests into a
+ single root digest. The fingerprint is written as
+ 'sha512-tree-<chunk size>-<root>', so it cannot be mistaken for a plain
+ sha512 fingerprint, and the chunk size needed to check it is recorded
+ with it.
+
+ Leaves are hashed as sha512(0x00 + chunk) and interior nodes as
+ sha512(0x01 + left + right), so a leaf can never be passed off as an
+ interior node. A node without a partner at the end of a level is carried
+ up to the next level unchanged. An empty file has a single leaf for the
+ empty chunk.
+
+ The leaf digests are kept, so a later run can tell which byte ranges of
+ a file changed.
+"""
+import concurrent.futures
+import functools
+import hashlib
+import os
+
+PREFIX = 'sha512-tree'
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def tree_algorithm(chunk_size=CHUNK_SIZE):
+    """Return the algorithm name used for a tree hash with the passed chunk size."""
+    return f'{PREFIX}-{chunk_size}'
+
+
+def is_tree_algorithm(algorithm):
+    """Return True for a tree hash name, with or without the chunk size, or fingerprint."""
+    return algorithm == PREFIX or algorithm.startswith(PREFIX + '-')
+
+
+def chunk_size_of(algorithm):
+    return int(algorithm[len(PREFIX) + 1:])
+
+
+@functools.cache
+def leaf_executor():
+    """Return the thread pool shared by all tree hashes. hashlib releases the
+       GIL while it hashes a large buffer, so the leaves are hashed on all
+       cores without copying them into other processes.
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                 thread_name_prefix='tree-hash')
+
+
+def merkle_root(leaves):
+    """Combine a list of leaf digests into the root digest."""
+    level = leaves
+    while len(level) > 1:
+        paired = [hashlib.sha512(b'\x01' + level[i] + level[i + 1]).digest()
+                  for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def changed_ranges(old_leaves, new_leaves, chunk_size):
+    """Return the (start, end) byte ranges, end exclusive, whose chunks differ
+       between two lists of leaf digests taken with the same chunk size.
+    """
+    ranges = []
+    for index in range(max(len(old_leaves), len(new_leaves))):
+        old = old_leaves[index] if index < len(old_leaves) else None
+        new = new_leaves[index] if index < len(new_leaves) else None
+        if old != new:
+            start = index * chunk_size
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], start + chunk_size)
+            else:
+                ranges.append((start, start + chunk_size))
+    return ranges
+
+
+class TreeHash:
+    """Hash object with the same update and hexdigest interface as hashlib,
+       so it can be fed by the same read loops. Each call to update hashes
+       the parts of the passed data that belong to different chunks in
+       parallel, and returns once they are done, so the caller can reuse its
+       buffer straight away. Passing buffers several chunks long gives the
+       most parallelism.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.name = PREFIX
+        self.leaves = []
+        self._current = None
+        self._filled = 0
+
+    def update(self, data):
+        tasks = []
+        finished = []
+        with memoryview(data) as view:
+            position = 0
+            while position < len(view):
+                if self._current is None:
+                    self._current = hashlib.sha512(b'\x00')
+                    self._filled = 0
+                length = min(self.chunk_size - self._filled, len(view) - position)
+                tasks.append((self._current, view[position:position + length]))
+                self._filled += length
+                position += length
+                if self._filled == self.chunk_size:
+                    finished.append(self._current)
+                    self._current = None
+            try:
+                if len(tasks) == 1:
+                    tasks[0][0].update(tasks[0][1])
+                else:
+                    list(leaf_executor().map(lambda task: task[0].update(task[1]), tasks))
+            finally:
+                for _, piece in tasks:
+                    piece.release()
+        self.leaves.extend(leaf.digest() for leaf in finished)
+
+    def _all_leaves(self):
+        if self._current is not None or not self.leaves:
+            return self.leaves + [(self._current or hashlib.sha512(b'\x00')).digest()]
+        return self.leaves
+
+    def digest(self):
+        return merkle_root(self._all_leaves())
+
+    def hexdigest(self):
+        """Return the chunk size and root digest, which follow the prefix in the fingerprint."""
+        return f'{self.chunk_size}-{self.digest().hex()}'
+
+    def leaf_digests(self):
+        """Return the digests of every chunk, including a final partial chunk."""
+        return list(self._all_leaves())
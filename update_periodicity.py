@@ -1,10 +1,16 @@
+import argparse
+import concurrent.futures
+import functools
 import json
 import logging
 import os
 import sys
 import re
 
-from ckanapi import RemoteCKAN
+import ckan_client
+from ckan_journal import Journal
+from ckan_paging import iter_datasets
+from ckan_throttle import RETRIES, RateLimiter, call_with_retry
 
 # The name of the metadata field containing the accrual periodicity value.
 ACCRUAL_FIELD = 'update_frequency'
@@ -12,137 +18,178 @@ ACCRUAL_FIELD = 'update_frequency'
 # Syntax for a command line argument to turn off updates.
 DO_UPDATE = '-update'
 
+# Default number of concurrent patch requests.
+WORKERS = 4
+
+# Journal used by --resume when no journal file is named.
+JOURNAL_FILE = 'update_periodicity.journal'
+
 # Flag for whether to actually update or just log what would be updated.
 do_update = False
 
+# Regular expression for any valid value of the accrualPeriodicity field. The literal string "irregular" can be used, or a recurring duration encoded in ISO 8601 format.
+# This matches the regular expression used in the DCAT-US version 1.1 schema.
+PERIODICITY_ISO_8601_PATTERN = re.compile("^irregular|R\\/P(?:\\d+(?:\\.\\d+)?Y)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?W)?(?:\\d+(?:\\.\\d+)?D)?(?:T(?:\\d+(?:\\.\\d+)?H)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?S)?)?$")
+
+# Values expected in the accrualPeridocity field (from before the validation for that field was correctly implemented) with the corresponding ISO 8601 compliant string.
+# The replacements are applied in this order.
+PERIODICITY_LOOKUP = [(re.compile(verbose), iso8601) for verbose, iso8601 in [
+    ("Decennial(ly)*", "R/P10Y"),
+    ("Quadrennial(ly)*", "R/P4Y"),
+    ("Annual(ly)*", "R/P1Y"),
+    ("Bimonthly", "R/P2M"),
+    ("Semiweekly", "R/P3.5D"),
+    ("Daily", "R/P1D"),
+    ("Biweekly", "R/P2W"),
+    ("Semiannual(ly)*", "R/P6M"),
+    ("Biennial(ly)*", "R/P2Y"),
+    ("Biannual(ly)*", "R/P2Y"),
+    ("Triennial(ly)*", "R/P3Y"),
+    ("Triannual(ly)*", "R/P3Y"),
+    ("Three times a week", "R/P0.33W"),
+    ("Three times a month", "R/P0.33M"),
+    ("Continuously updated", "R/PT1S"),
+    ("Monthly", "R/P1M"),
+    ("Quarterly", "R/P3M"),
+    ("Semimonthly", "R/P0.5M"),
+    ("Three times a year", "R/P4M"),
+    ("Weekly", "R/P1W"),
+    ("Hourly", "R/PT1H"),
+    ("Other", "irregular"),
+    ("None", "")
+    ]]
+
 # Function to retrieve the unique identifiers for all datasets in a CKAN instance.
 def retrieve_metadata(ckan_connection):
     metadata = []
-    limit = 1000
-    # Do the initial search of datasets, returning the first batch and the total count 
-    # of matching datasets
     try:
-        result = ckan_connection.call_action(action='package_search', data_dict={
-            'rows': limit,
-            'start': 0,
-            'include_private': True,
-            'include_drafts': True,
-            'fl': ['id','extras_update_frequency']
-            })
-    except:
-        return metadata
-    if not result:
-        return metadata
-
-    for p in result.get('results',[]):
-        metadata.append({'id': p.get('id'), ACCRUAL_FIELD: p.get(ACCRUAL_FIELD, None)})
-        
-    count = result.get('count')
-    if count < limit:
-        return metadata
-    batches = count / limit
-    if count % limit != 0:
-        batches += 1
-    
-    for batch in range(1,batches):
-        try:
-            result = ckan_connection.call_action(action='package_search', data_dict={
-                        'rows': limit,
-                        'start': batch * limit,
-                        'include_private': True,
-                        'include_drafts': True,
-                        'fl': ['id','extras_update_frequency']
-                        })
-            for p in result.get('results',[]):
-                metadata.append({'id': p.get('id'), ACCRUAL_FIELD: p.get(ACCRUAL_FIELD,None)})
-        except:
-            continue
-            
+        for p in iter_datasets(ckan_connection, action='package_search', data_dict={
+                    'include_private': True,
+                    'include_drafts': True,
+                    'fl': ['id','extras_update_frequency']
+                    }):
+            metadata.append({'id': p.get('id'), ACCRUAL_FIELD: p.get(ACCRUAL_FIELD, None)})
+    except Exception as e:
+        logging.error('Could not retrieve dataset metadata.\n Error: %s', e)
+
     return metadata
         
-def fix_periodicity(ckan_connection, meta_dict):
-    # Define a regular expression for any valid value of the accrualPeriodicity field. The literal string "irregular" can be used, or a recurring duration encoded in ISO 8601 format.
-    # This matches the regular expression used in the DCAT-US version 1.1 schema.
-    periodicity_iso_8601_pattern = "^irregular|R\\/P(?:\\d+(?:\\.\\d+)?Y)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?W)?(?:\\d+(?:\\.\\d+)?D)?(?:T(?:\\d+(?:\\.\\d+)?H)?(?:\\d+(?:\\.\\d+)?M)?(?:\\d+(?:\\.\\d+)?S)?)?$"
-    # An array of values expected in the accrualPeridocity field (from before the validation for that field was correctly implemented) with the corresponding ISO 8601 compliant string.
-    periodicity_remove = "None"
-    periodicity_lookup = [
-        {"verbose": "Decennial(ly)*", "iso8601":"R/P10Y"},
-        {"verbose": "Quadrennial(ly)*", "iso8601":"R/P4Y"},
-        {"verbose": "Annual(ly)*", "iso8601":"R/P1Y"},
-        {"verbose": "Bimonthly", "iso8601":"R/P2M"},
-        {"verbose": "Semiweekly", "iso8601":"R/P3.5D"},
-        {"verbose": "Daily", "iso8601":"R/P1D"},
-        {"verbose": "Biweekly", "iso8601":"R/P2W"},
-        {"verbose": "Semiannual(ly)*", "iso8601":"R/P6M"},
-        {"verbose": "Biennial(ly)*", "iso8601":"R/P2Y"},
-        {"verbose": "Biannual(ly)*", "iso8601":"R/P2Y"},
-        {"verbose": "Triennial(ly)*", "iso8601":"R/P3Y"},
-        {"verbose": "Triannual(ly)*", "iso8601":"R/P3Y"},
-        {"verbose": "Three times a week", "iso8601":"R/P0.33W"},
-        {"verbose": "Three times a month", "iso8601":"R/P0.33M"},
-        {"verbose": "Continuously updated", "iso8601":"R/PT1S"},
-        {"verbose": "Monthly", "iso8601":"R/P1M"},
-        {"verbose": "Quarterly", "iso8601":"R/P3M"},
-        {"verbose": "Semimonthly", "iso8601":"R/P0.5M"},
-        {"verbose": "Three times a year", "iso8601":"R/P4M"},
-        {"verbose": "Weekly", "iso8601":"R/P1W"},
-        {"verbose": "Hourly", "iso8601":"R/PT1H"},
-        {"verbose": "Other", "iso8601":"irregular"},
-        {"verbose": "None", "iso8601": "" }
-        ]
-
+@functools.cache
+def is_valid_periodicity(accrual):
+    """Return True if the accrual periodicity value is valid in DCAT-US 1.1."""
+    return PERIODICITY_ISO_8601_PATTERN.search(accrual) is not None
+
+@functools.cache
+def normalize_periodicity(accrual):
+    """Return the ISO 8601 compliant form of an accrual periodicity value.
+       Valid values, and values that no lookup entry matches, are returned unchanged.
+       Results are memoized, since catalogs repeat a small set of distinct values.
+    """
+    if is_valid_periodicity(accrual):
+        return accrual
+    for pattern, iso8601 in PERIODICITY_LOOKUP:
+        accrual = pattern.sub(iso8601, accrual)
+    return accrual
+
+def normalize_periodicities(values):
+    """Return the normalized form of each accrual periodicity value in the passed list.
+       Each distinct value is resolved once, and None values are kept as None.
+    """
+    resolved = {v: normalize_periodicity(v) for v in set(values) if v is not None}
+    return [resolved.get(v) for v in values]
+
+def plan_periodicity(meta_dict):
+    """Return the corrected accrual periodicity for a dataset, or None if
+       the dataset has no value, already has a valid value, or has a value
+       that cannot be corrected.
+    """
     # If the passed meta_dict doesn't have an accrual periodicity value,
     # there is nothing to fix.
     if meta_dict[ACCRUAL_FIELD] is None:
-        return False
+        return None
         
     accrual = meta_dict[ACCRUAL_FIELD]
     # Check the accrual periodicity against the regular expression pattern for valid entries.
-    if re.search(periodicity_iso_8601_pattern, meta_dict[ACCRUAL_FIELD]) is None:
-        # The value didn't match the regular expression, so try to replace it.
-        for repl in periodicity_lookup:
-            accrual = re.sub(repl['verbose'], repl['iso8601'], accrual)
-        if accrual != meta_dict[ACCRUAL_FIELD]:
-            # Patch the package to only update the periodicity field.
-            if do_update:
-                try:
-                    meta_dict[ACCRUAL_FIELD] = accrual
-                    ckan_connection.call_action(action='package_patch', data_dict = meta_dict)
-                    logging.info('Updated periodicity to %s for %s', accrual, meta_dict['id'])
-                    return True
-                except Exception as e:
-                    logging.error('Could not patch dataset %s.\n Error: %s', meta_dict['id'], e)
-                    return False
-            else:
-                logging.debug('Would replace %s with %s', meta_dict[ACCRUAL_FIELD], accrual)
-                return True
-        else:
-            # The accrual periodicity value doesn't match the regular expression,
-            # but also didn't match any of the search patterns for replacement.
-            logging.warning("Uncorrected accrual periodicity %s in %s", accrual, meta_dict['id'])
-            return False
-
-
-	
+    if is_valid_periodicity(accrual):
+        return None
+    # The value didn't match the regular expression, so try to replace it.
+    accrual = normalize_periodicity(accrual)
+    if accrual == meta_dict[ACCRUAL_FIELD]:
+        # The accrual periodicity value doesn't match the regular expression,
+        # but also didn't match any of the search patterns for replacement.
+        logging.warning("Uncorrected accrual periodicity %s in %s", accrual, meta_dict['id'])
+        return None
+    return accrual
+
+def patch_periodicity(ckan_connection, meta_dict, accrual, limiter=None, retries=RETRIES):
+    """Patch the package to only update the periodicity field.
+       Returns True if the patch succeeded.
+    """
+    try:
+        call_with_retry(ckan_connection, 'package_patch', {'id': meta_dict['id'], ACCRUAL_FIELD: accrual},
+                        limiter=limiter, retries=retries)
+        meta_dict[ACCRUAL_FIELD] = accrual
+        logging.info('Updated periodicity to %s for %s', accrual, meta_dict['id'])
+        return True
+    except Exception as e:
+        logging.error('Could not patch dataset %s.\n Error: %s', meta_dict['id'], e)
+        return False
+
+def fix_periodicity(ckan_connection, meta_dict):
+    accrual = plan_periodicity(meta_dict)
+    if accrual is None:
+        return False
+    if do_update:
+        return patch_periodicity(ckan_connection, meta_dict, accrual)
+    logging.debug('Would replace %s with %s', meta_dict[ACCRUAL_FIELD], accrual)
+    return True
+
+def apply_plan(ckan_connection, plan, workers=WORKERS, limiter=None, retries=RETRIES, journal=None):
+    """Patch every dataset in the plan, a list of (meta_dict, accrual) pairs,
+       using a bounded pool of worker threads. Returns the number of datasets
+       updated and the number that failed. The outcome for each dataset is
+       recorded in the journal, if one is passed.
+    """
+    updated = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda p: patch_periodicity(ckan_connection, p[0], p[1], limiter, retries), plan)
+        for (meta_dict, accrual), result in zip(plan, results):
+            updated += result
+            if journal:
+                journal.record(meta_dict['id'], 'done' if result else 'failed')
+    return updated, len(plan) - updated
+
+
 if __name__ == '__main__':
 
-    url = os.getenv('ED_CKAN_URL', None)
-    api_key = os.getenv('ED_CKAN_KEY', None)
+    ap = argparse.ArgumentParser(description='Correct accrual periodicity values in a CKAN instance.',
+        epilog='''Without -update, the program only logs the changes it would make.
+The program uses the following environment variables:
+  CKAN_URL (or ED_CKAN_URL): The web address to use for API calls.
+  CKAN_KEY (or ED_CKAN_KEY): The authentication key value to use for API calls.
+''', formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument(DO_UPDATE, action='store_true', help='Patch the datasets instead of only logging the changes.')
+    ap.add_argument('-w','--workers', type=int, default=WORKERS, help='Number of concurrent patch requests.')
+    ap.add_argument('--rate', type=float, default=None, help='Maximum number of patch requests per second.')
+    ap.add_argument('--retries', type=int, default=RETRIES, help='Number of times to retry a patch after a server error or timeout.')
+    ap.add_argument('-j','--journal', help='File recording the datasets patched, so an interrupted update can be resumed.')
+    ap.add_argument('--resume', action='store_true', help='Skip the datasets that the journal shows were patched by an earlier run.')
+    args = ap.parse_args()
+    if args.workers < 1:
+        ap.error('--workers must be at least 1.')
+
+    # This program does not prompt, so it can run unattended.
+    url, api_key = ckan_client.get_credentials(prompt=False)
 
     errors = []
 
     if not url:
-        errors.append('ED_CKAN_URL environment variable is needed.')
+        errors.append('CKAN_URL (or ED_CKAN_URL) environment variable is needed.')
     if not api_key:
-        errors.append('ED_CKAN_KEY environment variable is needed.')
+        errors.append('CKAN_KEY (or ED_CKAN_KEY) environment variable is needed.')
 
-    for arg in sys.argv:
-        if (arg == DO_UPDATE): 
-            do_update = True
-            log_level = logging.INFO
-        else:
-            log_level = logging.DEBUG
+    do_update = args.update
+    log_level = logging.INFO if do_update else logging.DEBUG
 
     logging.basicConfig(format='%(levelname)s %(message)s',level=log_level)
 
@@ -151,17 +198,40 @@ if __name__ == '__main__':
             logging.error(e)
         sys.exit(1)
 
-    remote_ckan = RemoteCKAN(address=url, apikey=api_key)
+    remote_ckan = ckan_client.connect(url, api_key, pool_size=args.workers)
     logging.info('Processing on CKAN at URL %s', url)
 
     # Retrieve the complete list of package identifiers.
     dataset_list = retrieve_metadata(remote_ckan)
 
     logging.info('Found %d datasets.', len(dataset_list))
-    
-    updated = 0
+
+    # Work out every change before writing any of them, so a dry run
+    # produces the same plan as an update.
+    plan = []
     for d in dataset_list:
-        if fix_periodicity(remote_ckan, d):
-            updated += 1
-            
-    logging.info('Updated %d datasets.', updated)
+        accrual = plan_periodicity(d)
+        if accrual is not None:
+            plan.append((d, accrual))
+    skipped = len(dataset_list) - len(plan)
+
+    if do_update:
+        journal = None
+        if args.journal or args.resume:
+            try:
+                journal = Journal(args.journal or JOURNAL_FILE, {'field': ACCRUAL_FIELD}, resume=args.resume)
+            except ValueError as e:
+                ap.error(str(e))
+            # The search index can lag behind recent patches, so datasets
+            # patched by the interrupted run may still show the old value.
+            resumed = [(d, accrual) for d, accrual in plan if not journal.completed(d['id'])]
+            skipped += len(plan) - len(resumed)
+            plan = resumed
+        updated, failed = apply_plan(remote_ckan, plan, args.workers, RateLimiter(args.rate), args.retries, journal)
+        if journal:
+            journal.close()
+        print(f'Updated {updated} datasets, failed {failed}, skipped {skipped}.')
+    else:
+        for d, accrual in plan:
+            logging.debug('Would replace %s with %s in %s', d[ACCRUAL_FIELD], accrual, d['id'])
+        print(f'Would update {len(plan)} datasets, skipped {skipped}.')